@@ -0,0 +1,2539 @@
+"""Async twin of db.py backed by an asyncpg pool.
+
+Every function here has the same name and return shape as its psycopg2
+counterpart, but is awaitable and never blocks the event loop.  Statements
+are sent with asyncpg's extended protocol, so each connection keeps a cache
+of prepared statements and repeated queries skip the parse/plan step.
+"""
+
+import asyncio
+import base64
+import binascii
+import datetime
+import hashlib
+import json
+import logging
+import random
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+import arq
+import asyncpg
+import aws
+import cache
+import env
+from arq.connections import RedisSettings
+
+# --------------------------------------------------------------------------- #
+# Database connection helpers
+# --------------------------------------------------------------------------- #
+
+_pool = None
+_db_pool: asyncpg.Pool | None = None
+_db_pool_lock = asyncio.Lock()
+
+
+async def _get_arq_pool():
+    """Helper to lazily initialize the arq Redis pool with correct DSN/Host settings."""
+    global _pool
+    if _pool is None:
+        # If it looks like a full DSN (or specifically for Amazon/Production), use from_dsn
+        if (
+            "redis://" in env.REDIS_URL2_DSN
+            or "rediss://" in env.REDIS_URL2_DSN
+            or "amazon" in env.REDIS_URL2_DSN
+        ):
+            redis_settings = RedisSettings.from_dsn(env.REDIS_URL2_DSN)
+        else:
+            # Otherwise treat as a bare host (common in local IP testing)
+            redis_settings = RedisSettings(host=env.REDIS_URL2_DSN)
+
+        _pool = await arq.create_pool(redis_settings)
+    return _pool
+
+
+async def enqueue_delete_key(key: str):
+    pool = await _get_arq_pool()
+    await pool.enqueue_job("delete_s3_object", key)
+
+
+# Keys per delete_s3_objects job: ten full DeleteObjects requests
+DELETE_JOB_KEYS = 10 * aws.DELETE_BATCH_SIZE
+
+
+async def enqueue_delete_keys(keys: list):
+    pool = await _get_arq_pool()
+    await pool.enqueue_job("delete_s3_objects", keys)
+
+
+async def enqueue_cleanup_deleted_photos(age_hours: int = 0):
+    pool = await _get_arq_pool()
+    await pool.enqueue_job("cleanup_deleted_photos", age_hours)
+
+
+async def init_pool(**kwargs) -> None:
+    """Create the asyncpg pool; extra kwargs are passed to asyncpg.create_pool."""
+    global _db_pool
+    async with _db_pool_lock:
+        if _db_pool is None:
+            _db_pool = await asyncpg.create_pool(
+                min_size=1,
+                max_size=20,
+                host=env.DB_HOST,
+                port=int(env.DB_PORT),
+                database=env.DB_NAME,
+                user=env.DB_USER,
+                password=env.DB_PASSWORD,
+                # Per-connection LRU of prepared statements
+                statement_cache_size=256,
+                **kwargs,
+            )
+
+
+async def close_pool() -> None:
+    global _db_pool
+    if _db_pool is not None:
+        await _db_pool.close()
+        _db_pool = None
+
+
+@asynccontextmanager
+async def get_db_connection():
+    if _db_pool is None:
+        await init_pool()
+    assert _db_pool is not None, "Database pool not initialized"
+    async with _db_pool.acquire() as conn:
+        yield conn
+
+
+def _iso(value):
+    """Render timestamps the same way the psycopg2 layer does."""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def _rowcount(status: str) -> int:
+    """Extract the affected row count from an asyncpg command status tag."""
+    try:
+        return int(status.split()[-1])
+    except (AttributeError, IndexError, ValueError):
+        return 0
+
+
+# --------------------------------------------------------------------------- #
+# User CRUD helpers
+# --------------------------------------------------------------------------- #
+
+
+async def setUser(
+    username: str, email: str, password: str, user_class: str = "free"
+) -> None:
+    """Insert a new user into the database."""
+    salt = random.randbytes(16).hex()
+    passhash = hashlib.sha256((password + salt).encode()).hexdigest()
+
+    async with get_db_connection() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                """
+                INSERT INTO users (username, email, passhash, salt, class)
+                VALUES ($1, $2, $3, $4, $5);
+                """,
+                username,
+                email,
+                passhash,
+                salt,
+                user_class,
+            )
+            await _count_users(conn, 1)
+
+
+async def update_user_password(username: str, new_password: str) -> bool:
+    """Update user's password with new hash and salt."""
+    salt = random.randbytes(16).hex()
+    passhash = hashlib.sha256((new_password + salt).encode()).hexdigest()
+
+    async with get_db_connection() as conn:
+        try:
+            status = await conn.execute(
+                "UPDATE users SET passhash = $1, salt = $2 WHERE username = $3",
+                passhash,
+                salt,
+                username,
+            )
+            return _rowcount(status) > 0
+        except Exception as e:
+            logging.error(f"Error updating password for {username}: {e}")
+            return False
+
+
+async def getUser(username: str) -> dict | None:
+    """Retrieve a user from the database by username."""
+    async with get_db_connection() as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT id, username, email, passhash, salt, created_at, class, notify_me
+            FROM users
+            WHERE username = $1;
+            """,
+            username,
+        )
+
+    if row:
+        return {
+            "id": row[0],
+            "username": row[1],
+            "email": row[2],
+            "passhash": row[3],
+            "salt": row[4],
+            "created_at": row[5],
+            "class": row[6],
+            "notify_me": row[7],
+        }
+    else:
+        return None
+
+
+# Who a username is, for the permission checks on nearly every request.
+# Leaves out the password hash, salt and email; see getUserIdentity.
+user_cache = cache.TwoLevelCache(
+    "user",
+    maxsize=getattr(env, "USER_CACHE_SIZE", 10000),
+    ttl=300,
+    local_ttl=30,
+)
+
+
+async def getUserIdentity(username: str | None) -> dict | None:
+    """User id, username, class and notify_me by username, cached.
+
+    Invalidated by setUserData, updateUserPlan and delete_user, each once
+    its change has committed: the invalidation bumps the key's version in
+    Redis, so a load that read the old row in any process is never stored
+    (see TwoLevelCache).  Use getUser when the email or password hash is
+    needed.  The returned dict is shared with the cache, so do not modify it.
+    """
+    if not username:
+        return None
+
+    async def load() -> dict | None:
+        async with get_db_connection() as conn:
+            row = await conn.fetchrow(
+                """
+                SELECT id, username, class, notify_me
+                FROM users
+                WHERE username = $1;
+                """,
+                username,
+            )
+        if row:
+            return {
+                "id": row[0],
+                "username": row[1],
+                "class": row[2],
+                "notify_me": row[3],
+            }
+        return None
+
+    return await user_cache.get(username, load)
+
+
+async def _resolve_user(user: str | dict | None) -> dict | None:
+    """A username, or a user dict the caller already resolved, as a user dict."""
+    if isinstance(user, dict):
+        return user
+    return await getUserIdentity(user)
+
+
+async def get_user_id(username: str | None) -> int | None:
+    """Retrieve only the user ID by username, via the identity cache."""
+    user = await getUserIdentity(username)
+    return user["id"] if user else None
+
+
+async def check_password(username: str, password: str) -> bool:
+    """Check if the provided password matches the stored hash for the user."""
+    user = await getUser(username)
+    if not user:
+        return False
+
+    salt = user["salt"]
+    expected_hash = user["passhash"]
+    provided_hash = hashlib.sha256((password + salt).encode()).hexdigest()
+    return provided_hash == expected_hash
+
+
+async def check_user_has_photos_in_album(user_id: int, album_id: int) -> bool:
+    """Check if the user has any photos in the specified album."""
+    async with get_db_connection() as conn:
+        row = await conn.fetchrow(
+            "SELECT 1 FROM photos WHERE user_id = $1 AND album_id = $2 LIMIT 1",
+            user_id,
+            album_id,
+        )
+    return row is not None
+
+
+async def getAlbum(code: str) -> dict | None:
+    async with get_db_connection() as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT a.id, a.code, a.name, a.user_id, a.open, s.profile, a.private, a.created_at, u.username, a.modified_at, s.opened_at
+            FROM albums a
+            JOIN users u ON a.user_id = u.id
+            LEFT JOIN subscription s ON a.id = s.album_id AND s.user_id = a.user_id
+            WHERE a.code = $1;
+            """,
+            code,
+        )
+
+    if row:
+        return {
+            "id": row[0],
+            "code": row[1],
+            "name": row[2],
+            "user_id": row[3],
+            "open": bool(row[4]),
+            "profile": bool(row[5]) if row[5] is not None else False,
+            "private": bool(row[6]),
+            "created_at": _iso(row[7]),
+            "username": row[8],
+            "modified_at": _iso(row[9]),
+            "opened_at": _iso(row[10]),
+        }
+    return None
+
+
+# Stable album columns by code, for lookups and permission checks.  Kept
+# until a write to one of them invalidates it; see getAlbumMeta.
+album_cache = cache.TwoLevelCache(
+    "album",
+    maxsize=getattr(env, "ALBUM_CACHE_SIZE", 10000),
+    ttl=300,
+    local_ttl=60,
+)
+
+
+async def getAlbumMeta(code: str) -> dict | None:
+    """Album id, name, owner and open/private flags by code, cached.
+
+    Leaves out modified_at, opened_at and the owner's profile flag, which
+    change on every upload or visit; use getAlbum when those are needed.
+    The returned dict is shared with the cache, so do not modify it.
+    """
+
+    async def load() -> dict | None:
+        async with get_db_connection() as conn:
+            row = await conn.fetchrow(
+                """
+                SELECT a.id, a.code, a.name, a.user_id, u.username, a.open,
+                       a.private, a.created_at
+                FROM albums a
+                JOIN users u ON a.user_id = u.id
+                WHERE a.code = $1;
+                """,
+                code,
+            )
+        if row:
+            return {
+                "id": row[0],
+                "code": row[1],
+                "name": row[2],
+                "user_id": row[3],
+                "username": row[4],
+                "open": bool(row[5]),
+                "private": bool(row[6]),
+                "created_at": _iso(row[7]),
+            }
+        return None
+
+    return await album_cache.get(code, load)
+
+
+async def get_upload_context(uploader_username: str, album_code: str) -> dict | None:
+    """
+    Consolidates multiple database calls into one for the get_presigned endpoint.
+    Retrieves album details, owner details, owner's space usage, and uploader's ID.
+    Includes the owner's storage limit from the user_limits table.
+    """
+    async with get_db_connection() as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT
+                a.id, a.code, a.user_id, a.open,
+                uo.username, uo.class,
+                COALESCE(s.space, 0),
+                (SELECT id FROM users WHERE username = $1),
+                COALESCE(ul.max_size, (SELECT max_size FROM user_limits WHERE class = 'free'))
+            FROM albums a
+            JOIN users uo ON a.user_id = uo.id
+            LEFT JOIN spaceused s ON uo.id = s.user_id
+            LEFT JOIN user_limits ul ON LOWER(uo.class) = ul.class
+            WHERE a.code = $2;
+            """,
+            uploader_username,
+            album_code,
+        )
+
+    if row:
+        return {
+            "album_id": row[0],
+            "album_code": row[1],
+            "album_user_id": row[2],
+            "album_open": bool(row[3]),
+            "owner_username": row[4],
+            "owner_class": row[5],
+            "owner_space_used": row[6],
+            "uploader_id": row[7],
+            "owner_limit": row[8],
+        }
+    return None
+
+
+async def getAlbumWithSub(code: str, authuser: str | dict | None) -> dict | None:
+    user = await _resolve_user(authuser)
+    async with get_db_connection() as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT a.id, a.code, a.name, a.user_id, a.open,
+                   COALESCE(s.profile, o_s.profile) AS display_profile,
+                   a.private, a.created_at, u.username,
+                   s.album_id IS NOT NULL AS subscribed,
+                   a.modified_at, o_s.opened_at, s.opened_at AS sub_opened_at,
+                   COALESCE(s.archive, FALSE) AS archived
+            FROM albums a
+            JOIN users u ON a.user_id = u.id
+            LEFT JOIN subscription o_s ON a.id = o_s.album_id AND o_s.user_id = a.user_id
+            LEFT JOIN subscription s ON a.id = s.album_id AND s.user_id = $1
+            WHERE a.code = $2;
+            """,
+            user["id"] if user else None,
+            code,
+        )
+
+    if row:
+        return {
+            "id": row[0],
+            "code": row[1],
+            "name": row[2],
+            "user_id": row[3],
+            "open": bool(row[4]),
+            "profile": bool(row[5]),
+            "private": bool(row[6]),
+            "created_at": _iso(row[7]),
+            "username": row[8],
+            "subscribed": bool(row[9]),
+            "modified_at": _iso(row[10]),
+            "opened_at": _iso(row[11]),
+            "sub_opened_at": _iso(row[12]),
+            "archived": bool(row[13]),
+        }
+    return None
+
+
+# Sort keys for getPhotos.  Each one has a matching (album_id, key, id) index
+# except username, which has to be sorted through the users join.
+_PHOTO_SORT_KEYS = {
+    "created_at": "p.created_at",
+    "filename": "p.filename",
+    "username": "u.username",
+    # Unmeasured photos sort as zero bytes so the key is never NULL.
+    "size": "COALESCE(p.size, 0)",
+}
+
+
+def _encode_cursor(sort_field: str, order: str, value, photo_id: int) -> str:
+    """Pack the sort key and id of the last row into an opaque page cursor."""
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    raw = json.dumps([sort_field, order, value, photo_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str, sort_field: str, order: str) -> tuple | None:
+    """Return (value, id) from a cursor, or None if it is not for this sort."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        field, cursor_order, value, photo_id = json.loads(
+            base64.urlsafe_b64decode(padded)
+        )
+        if field != sort_field or cursor_order != order:
+            return None
+        if sort_field == "created_at":
+            value = datetime.datetime.fromisoformat(value)
+        elif sort_field == "size":
+            value = int(value)
+        else:
+            value = str(value)
+        return value, int(photo_id)
+    except (ValueError, TypeError, binascii.Error):
+        return None
+
+
+async def getPhotos(
+    album_id: int,
+    limit: int = 100,
+    offset: int = 0,
+    sort_field: str = "created_at",
+    sort_order: str = "desc",
+    user_id_filter: int | None = None,
+    cursor: str | None = None,
+    paginate_by_cursor: bool = False,
+) -> dict | None:
+    """Return one page of an album's photos.
+
+    With ``paginate_by_cursor`` the page starts after ``cursor`` (the first
+    page when it is None) and the result carries ``next_cursor`` for the
+    following page; pages are found with an index seek, so deep pages cost
+    the same as the first one.  Otherwise ``offset`` is used as before.
+    """
+    if sort_field not in _PHOTO_SORT_KEYS:
+        sort_field = "created_at"
+    key = _PHOTO_SORT_KEYS[sort_field]
+    order = "asc" if sort_order.lower() == "asc" else "desc"
+    limit = int(limit)
+    offset = int(offset)
+
+    after = None
+    if paginate_by_cursor and cursor:
+        after = _decode_cursor(cursor, sort_field, order)
+        if after is None:
+            logging.info("getPhotos - ignoring cursor for a different sort")
+
+    async with get_db_connection() as conn:
+        # The per-user total is served by idx_photos_user_album; the album
+        # total is the counter kept on albums by the write paths.
+        if user_id_filter:
+            total_count = await conn.fetchval(
+                "SELECT COUNT(*) FROM photos WHERE album_id = $1 AND user_id = $2",
+                album_id,
+                user_id_filter,
+            )
+        else:
+            total_count = await conn.fetchval(
+                "SELECT photo_count FROM albums WHERE id = $1", album_id
+            )
+
+        params = [album_id]
+        conditions = ["p.album_id = $1"]
+        if user_id_filter:
+            params.append(user_id_filter)
+            conditions.append(f"p.user_id = ${len(params)}")
+        if after is not None:
+            params.extend(after)
+            cmp = ">" if order == "asc" else "<"
+            conditions.append(
+                f"({key}, p.id) {cmp} (${len(params) - 1}, ${len(params)})"
+            )
+        params.append(limit)
+        page_clause = f"LIMIT ${len(params)}"
+        if not paginate_by_cursor:
+            params.append(offset)
+            page_clause += f" OFFSET ${len(params)}"
+
+        query = f"""
+            SELECT p.id, p.user_id, p.album_id, p.s3_key, p.thumb_key, p.mid_key, p.filename,
+                   p.created_at, u.username, p.size, p.thumb_size, p.mid_size, {key}
+            FROM photos p
+            JOIN users u ON p.user_id = u.id
+            WHERE {" AND ".join(conditions)}
+            ORDER BY {key} {order}, p.id {order}
+            {page_clause};
+        """
+        rows = await conn.fetch(query, *params)
+
+    photos = []
+    for row in rows:
+        photos.append(
+            {
+                "id": row[0],
+                "user_id": row[1],
+                "album_id": row[2],
+                "s3_key": row[3],
+                "thumb_key": row[4],
+                "mid_key": row[5],
+                "filename": row[6],
+                "created_at": _iso(row[7]),
+                "username": row[8],
+                "size": row[9],
+                "thumb_size": row[10],
+                "mid_size": row[11],
+            }
+        )
+    result = {
+        "photos": photos,
+        "total": total_count,
+        "limit": limit,
+        "offset": offset,
+    }
+    if paginate_by_cursor:
+        result["cursor"] = cursor
+        result["next_cursor"] = (
+            _encode_cursor(sort_field, order, rows[-1][12], rows[-1][0])
+            if len(rows) == limit
+            else None
+        )
+    return result
+
+
+async def recordAlbumVisit(album_code: str, username: str | dict) -> None:
+    """Update opened_at for the database record mapping the album and the user."""
+    user = await _resolve_user(username)
+    if not user:
+        return
+
+    async with get_db_connection() as conn:
+        try:
+            await conn.execute(
+                """
+                UPDATE subscription
+                SET opened_at = CURRENT_TIMESTAMP
+                WHERE album_id = (SELECT id FROM albums WHERE code = $1)
+                  AND user_id = $2;
+                """,
+                album_code,
+                user["id"],
+            )
+        except Exception as e:
+            logging.error(f"Error recording album visit: {e}")
+
+
+async def getDownloadList(
+    album_id: int,
+    user_id_filter: int | None = None,
+) -> dict | None:
+    async with get_db_connection() as conn:
+        filter_clause = "AND p.user_id = $2" if user_id_filter else ""
+        query = f"""
+            SELECT p.s3_key, p.filename, p.id
+            FROM photos p
+            WHERE p.album_id = $1 {filter_clause}
+            ORDER BY p.created_at DESC;
+        """
+        params = (album_id, user_id_filter) if user_id_filter else (album_id,)
+        rows = await conn.fetch(query, *params)
+
+    photos = []
+    for row in rows:
+        photos.append(
+            {
+                "s3_key": row[0],
+                "filename": row[1],
+                "id": row[2],
+            }
+        )
+    return {"photos": photos}
+
+
+async def deleteAlbum(username: str | dict, code: str) -> str:
+    user = await _resolve_user(username)
+    if not user:
+        return "user_not_found"
+
+    async with get_db_connection() as conn:
+        try:
+            async with conn.transaction():
+                album_id = await conn.fetchval(
+                    """
+                    SELECT id FROM albums
+                    WHERE code = $1 AND user_id = $2
+                    """,
+                    code,
+                    user["id"],
+                )
+                if album_id is None:
+                    return "album_not_found"
+
+                # Get total size of all original photos in the album
+                total_size = await conn.fetchval(
+                    "SELECT COALESCE(SUM(size), 0) FROM photos WHERE album_id = $1",
+                    album_id,
+                )
+
+                # Remove that space from spaceused for the album owner
+                if total_size > 0:
+                    await conn.execute(
+                        """
+                        INSERT INTO spaceused (user_id, space)
+                        VALUES ($1, $2)
+                        ON CONFLICT (user_id) DO UPDATE
+                        SET space = spaceused.space - EXCLUDED.space;
+                        """,
+                        user["id"],
+                        total_size,
+                    )
+
+                await _count_photos(conn, -1, "p.album_id = $3", album_id)
+                await _count_albums(conn, user["id"], -1)
+
+                # Soft delete the album's photos and drop their references
+                # on the shared objects, one row per object
+                blob_rows = await conn.fetch(
+                    """
+                    UPDATE photos
+                    SET album_id = NULL, deleted_at = CURRENT_TIMESTAMP
+                    WHERE album_id = $1
+                    RETURNING blob_id;
+                    """,
+                    album_id,
+                )
+                await _release_blobs(conn, [r[0] for r in blob_rows])
+
+                # Delete the album record itself
+                await conn.execute("DELETE FROM albums WHERE id = $1", album_id)
+        except Exception as e:
+            logging.error("Error deleting album: %s", e)
+            return str(e)
+
+    await album_cache.invalidate(code)
+    await enqueue_cleanup_deleted_photos(0)
+    return code
+
+
+# photos.size is an INTEGER column
+MAX_PHOTO_SIZE = 2**31 - 1
+
+
+def _declared_size(size) -> int | None:
+    """A client-declared byte size, or None unless it is a plausible one."""
+    if isinstance(size, int) and 0 < size <= MAX_PHOTO_SIZE:
+        return size
+    return None
+
+
+async def _add_space_used(conn, album_id: int, size: int) -> None:
+    """Charge *size* bytes to the owner of *album_id*, inside the caller's transaction."""
+    await conn.execute(
+        """
+        INSERT INTO spaceused (user_id, space)
+        VALUES ((SELECT user_id FROM albums WHERE id = $1), $2)
+        ON CONFLICT (user_id) DO UPDATE
+        SET space = spaceused.space + EXCLUDED.space;
+        """,
+        album_id,
+        size,
+    )
+
+
+# Rows of storage_stats; each writer adds to a random one
+STATS_SHARDS = 16
+
+
+async def _count_photos(conn, sign: int, where: str, arg) -> None:
+    """Add (*sign* 1) or take away (-1) photos in user_stats and storage_stats.
+
+    *where* picks the photos, as a condition on photos p with *arg* as $3.
+    Only photos in an album are seen, so call this after inserting photos
+    and before soft-deleting them.  The photos are locked in id order, so
+    none can change between being counted and being written.  Runs inside
+    the caller's transaction.
+    """
+    await conn.execute(
+        f"""
+        WITH d AS (
+            SELECT p.user_id AS uploader, a.user_id AS owner,
+                   COALESCE(p.size, 0)::bigint AS size,
+                   COALESCE(p.thumb_size, 0)::bigint AS thumb_size,
+                   COALESCE(p.mid_size, 0)::bigint AS mid_size,
+                   (p.size IS NULL)::int AS unsized
+            FROM photos p
+            JOIN albums a ON p.album_id = a.id
+            WHERE {where}
+            ORDER BY p.id
+            FOR UPDATE OF p
+        ), per_user AS (
+            SELECT user_id, SUM(photos) AS photos, SUM(photos_size) AS photos_size,
+                   SUM(others) AS others, SUM(album_size) AS album_size
+            FROM (
+                SELECT uploader AS user_id, 1 AS photos, size AS photos_size,
+                       0 AS others, 0 AS album_size
+                FROM d
+                WHERE uploader IS NOT NULL
+                UNION ALL
+                SELECT owner, 0, 0, (uploader IS DISTINCT FROM owner)::int, size
+                FROM d
+            ) x
+            GROUP BY user_id
+        ), users_counted AS (
+            INSERT INTO user_stats AS s
+                (user_id, num_photos, size_photos, num_other_photos, size_albums)
+            SELECT user_id, $1::int * photos, $1::int * photos_size,
+                   $1::int * others, $1::int * album_size
+            FROM per_user
+            ORDER BY user_id
+            ON CONFLICT (user_id) DO UPDATE
+            SET num_photos = s.num_photos + EXCLUDED.num_photos,
+                size_photos = s.size_photos + EXCLUDED.size_photos,
+                num_other_photos = s.num_other_photos + EXCLUDED.num_other_photos,
+                size_albums = s.size_albums + EXCLUDED.size_albums
+        )
+        INSERT INTO storage_stats AS s
+            (shard, total, thumbs, mids, no_size_count, total_files)
+        SELECT $2, $1::int * SUM(size), $1::int * SUM(thumb_size),
+               $1::int * SUM(mid_size), $1::int * SUM(unsized), $1::int * COUNT(*)
+        FROM d
+        HAVING COUNT(*) > 0
+        ON CONFLICT (shard) DO UPDATE
+        SET total = s.total + EXCLUDED.total,
+            thumbs = s.thumbs + EXCLUDED.thumbs,
+            mids = s.mids + EXCLUDED.mids,
+            no_size_count = s.no_size_count + EXCLUDED.no_size_count,
+            total_files = s.total_files + EXCLUDED.total_files
+        """,
+        sign,
+        random.randrange(STATS_SHARDS),
+        arg,
+    )
+
+
+async def _count_albums(conn, user_id: int, n: int) -> None:
+    """Add *n* albums (negative to take away) to *user_id*'s and the totals."""
+    await conn.execute(
+        """
+        WITH users_counted AS (
+            INSERT INTO user_stats AS s (user_id, num_albums)
+            VALUES ($1, $2)
+            ON CONFLICT (user_id) DO UPDATE
+            SET num_albums = s.num_albums + EXCLUDED.num_albums
+        )
+        INSERT INTO storage_stats AS s (shard, total_albums)
+        VALUES ($3, $2)
+        ON CONFLICT (shard) DO UPDATE
+        SET total_albums = s.total_albums + EXCLUDED.total_albums
+        """,
+        user_id,
+        n,
+        random.randrange(STATS_SHARDS),
+    )
+
+
+async def _count_users(conn, n: int) -> None:
+    """Add *n* users (negative to take away) to the totals."""
+    await conn.execute(
+        """
+        INSERT INTO storage_stats AS s (shard, total_users)
+        VALUES ($1, $2)
+        ON CONFLICT (shard) DO UPDATE
+        SET total_users = s.total_users + EXCLUDED.total_users
+        """,
+        random.randrange(STATS_SHARDS),
+        n,
+    )
+
+
+async def _acquire_blobs(conn, photos: list[dict]) -> list[int | None]:
+    """Take one blob reference per photo, creating blobs for new keys.
+
+    Returns each photo's blob id in order, None for a photo without an
+    s3_key.  Runs inside the caller's transaction.
+    """
+    rows = await conn.fetch(
+        """
+        INSERT INTO blobs (s3_key, thumb_key, mid_key, size, refcount)
+        SELECT s3_key, MAX(thumb_key), MAX(mid_key), MAX(size), COUNT(*)
+        FROM unnest($1::text[], $2::text[], $3::text[], $4::int[])
+            AS t(s3_key, thumb_key, mid_key, size)
+        WHERE s3_key IS NOT NULL
+        GROUP BY s3_key
+        ON CONFLICT (s3_key) DO UPDATE
+        SET refcount = blobs.refcount + EXCLUDED.refcount,
+            released_at = NULL
+        WHERE blobs.deleting_at IS NULL
+        RETURNING id, s3_key;
+        """,
+        [p.get("s3_key") for p in photos],
+        [p.get("thumb_key") for p in photos],
+        [p.get("mid_key") for p in photos],
+        [p.get("size") for p in photos],
+    )
+    ids = {r[1]: r[0] for r in rows}
+    # A blob claimed by cleanup_deleted_photos is losing its objects
+    missing = {p.get("s3_key") for p in photos if p.get("s3_key")} - ids.keys()
+    if missing:
+        raise ValueError(f"objects are being deleted: {sorted(missing)[:5]}")
+    return [ids.get(p.get("s3_key")) for p in photos]
+
+
+async def _release_blobs(conn, blob_ids: list) -> list[int]:
+    """Drop one reference per entry of *blob_ids* (repeats allowed).
+
+    One row written per blob.  Blobs left with no references are stamped
+    with released_at for cleanup_deleted_photos; their ids are returned.
+    Runs inside the caller's transaction.
+    """
+    rows = await conn.fetch(
+        """
+        UPDATE blobs b
+        SET refcount = b.refcount - g.n,
+            released_at = CASE WHEN b.refcount - g.n <= 0
+                               THEN CURRENT_TIMESTAMP END
+        FROM (
+            SELECT id, COUNT(*) AS n
+            FROM unnest($1::int[]) AS t(id)
+            WHERE id IS NOT NULL
+            GROUP BY id
+        ) g
+        WHERE b.id = g.id
+        RETURNING b.id, b.refcount;
+        """,
+        blob_ids,
+    )
+    return [r[0] for r in rows if r[1] <= 0]
+
+
+async def addPhoto(data: dict) -> dict | None:
+    s3_key = data.get("s3_key")
+    thumb_key = data.get("thumb_key")
+
+    async with get_db_connection() as conn:
+        try:
+            async with conn.transaction():
+                [blob_id] = await _acquire_blobs(conn, [data])
+                row = await conn.fetchrow(
+                    """
+                    INSERT INTO photos (user_id, album_id, s3_key, thumb_key, mid_key, filename, size, thumb_size, mid_size, blob_id)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+                    RETURNING id, user_id, album_id, s3_key, thumb_key, mid_key, filename, created_at, size, thumb_size, mid_size;
+                    """,
+                    data.get("user_id"),
+                    int(data["album_id"]),
+                    s3_key,
+                    thumb_key,
+                    data.get("mid_key"),
+                    data.get("filename"),
+                    _declared_size(data.get("size")),
+                    data.get("thumb_size"),
+                    data.get("mid_size"),
+                    blob_id,
+                )
+                # Update the album's modified_at time, cached photo count and
+                # cover (the newest photo with a thumbnail)
+                album_modified_at = await conn.fetchval(
+                    """
+                    UPDATE albums
+                    SET modified_at = CURRENT_TIMESTAMP,
+                        photo_count = photo_count + 1,
+                        cover_thumb_key = COALESCE($2, cover_thumb_key)
+                    WHERE id = $1
+                    RETURNING modified_at
+                    """,
+                    row[2],  # row[2] is album_id
+                    row[4],  # row[4] is thumb_key
+                )
+                await _count_photos(conn, 1, "p.id = $3", row[0])
+                username = await conn.fetchval(
+                    "SELECT username FROM users WHERE id = $1;",
+                    row[1],  # row[1] is user_id
+                )
+                # A size known at upload (signed into the PUT) counts at once
+                if row[8] and row[8] > 0:
+                    await _add_space_used(conn, row[2], row[8])
+        except Exception as e:
+            logging.error("addPhoto error: %s", e)
+            return None
+
+    return {
+        "id": row[0],
+        "user_id": row[1],
+        "album_id": row[2],
+        "s3_key": aws.create_presigned_url(row[3]),
+        "thumb_key": aws.create_presigned_url(row[4]),
+        "mid_key": aws.create_presigned_url(row[5]),
+        "filename": row[6],
+        "created_at": _iso(row[7]),
+        "size": row[8],
+        "thumb_size": row[9],
+        "mid_size": row[10],
+        "username": username,
+        "album_modified_at": _iso(album_modified_at),
+    }
+
+
+async def addPhotos(
+    user_id: int, album_id: int, username: str, photos: list[dict]
+) -> dict | None:
+    """Insert a batch of uploaded photos with one statement.
+
+    Returns the new photos (shaped like addPhoto's result, in the order
+    given) and the album's new modified_at, or None on error.
+    """
+    if not photos:
+        return {"photos": [], "album_modified_at": None}
+
+    async with get_db_connection() as conn:
+        try:
+            async with conn.transaction():
+                blob_ids = await _acquire_blobs(conn, photos)
+                rows = await conn.fetch(
+                    """
+                    INSERT INTO photos (user_id, album_id, s3_key, thumb_key, mid_key, filename, size, thumb_size, mid_size, blob_id)
+                    SELECT $1, $2, t.*
+                    FROM unnest($3::text[], $4::text[], $5::text[], $6::text[],
+                                $7::int[], $8::int[], $9::int[], $10::int[]) AS t
+                    RETURNING id, user_id, album_id, s3_key, thumb_key, mid_key, filename, created_at, size, thumb_size, mid_size;
+                    """,
+                    user_id,
+                    int(album_id),
+                    [p.get("s3_key") for p in photos],
+                    [p.get("thumb_key") for p in photos],
+                    [p.get("mid_key") for p in photos],
+                    [p.get("filename") for p in photos],
+                    [_declared_size(p.get("size")) for p in photos],
+                    [p.get("thumb_size") for p in photos],
+                    [p.get("mid_size") for p in photos],
+                    blob_ids,
+                )
+                # ids are handed out in unnest order
+                rows = sorted(rows, key=lambda r: r[0])
+                # The whole batch shares one created_at, so the cover is the
+                # last inserted photo that has a thumbnail
+                cover = next((r[4] for r in reversed(rows) if r[4]), None)
+                album_modified_at = await conn.fetchval(
+                    """
+                    UPDATE albums
+                    SET modified_at = CURRENT_TIMESTAMP,
+                        photo_count = photo_count + $2,
+                        cover_thumb_key = COALESCE($3, cover_thumb_key)
+                    WHERE id = $1
+                    RETURNING modified_at
+                    """,
+                    int(album_id),
+                    len(rows),
+                    cover,
+                )
+                await _count_photos(
+                    conn, 1, "p.id = ANY($3::int[])", [r[0] for r in rows]
+                )
+                total_size = sum(r[8] for r in rows if r[8] and r[8] > 0)
+                if total_size > 0:
+                    await _add_space_used(conn, int(album_id), total_size)
+        except Exception as e:
+            logging.error("addPhotos error: %s", e)
+            return None
+
+    return {
+        "photos": [
+            {
+                "id": row[0],
+                "user_id": row[1],
+                "album_id": row[2],
+                "s3_key": aws.create_presigned_url(row[3]),
+                "thumb_key": aws.create_presigned_url(row[4]),
+                "mid_key": aws.create_presigned_url(row[5]),
+                "filename": row[6],
+                "created_at": _iso(row[7]),
+                "size": row[8],
+                "thumb_size": row[9],
+                "mid_size": row[10],
+                "username": username,
+                "album_modified_at": _iso(album_modified_at),
+            }
+            for row in rows
+        ],
+        "album_modified_at": _iso(album_modified_at),
+    }
+
+
+async def importPhotos(
+    photo_ids: list, target_album_id: int, username: str | dict
+) -> list:
+    """Copy photos into another album without copying their objects.
+
+    Set-based: one grouped update of the blob reference counts, one
+    INSERT ... SELECT for every copy, one album update and one spaceused
+    upsert, whatever the number of photos.  Returns the new photos in the
+    order given, shaped like addPhoto's result.
+    """
+    user = await _resolve_user(username)
+    if not user:
+        return []
+
+    ids = []
+    for pid in photo_ids:
+        try:
+            ids.append(int(pid))
+        except (ValueError, TypeError):
+            continue
+    if not ids:
+        return []
+
+    async with get_db_connection() as conn:
+        try:
+            async with conn.transaction():
+                # One reference per copy, one row written per shared object.
+                # Deleted photos are not copied: their object may be going,
+                # and neither are photos whose blob is claimed for deletion.
+                await conn.execute(
+                    """
+                    UPDATE blobs b
+                    SET refcount = b.refcount + g.n, released_at = NULL
+                    FROM (
+                        SELECT p.blob_id, COUNT(*) AS n
+                        FROM unnest($1::int[]) AS i(id)
+                        JOIN photos p ON p.id = i.id
+                        WHERE p.blob_id IS NOT NULL AND p.deleted_at IS NULL
+                        GROUP BY p.blob_id
+                    ) g
+                    WHERE b.id = g.blob_id AND b.deleting_at IS NULL
+                    """,
+                    ids,
+                )
+                rows = await conn.fetch(
+                    """
+                    INSERT INTO photos (user_id, album_id, s3_key, thumb_key, mid_key,
+                                        filename, size, thumb_size, mid_size, blob_id)
+                    SELECT $2, $3, p.s3_key, p.thumb_key, p.mid_key,
+                           p.filename, p.size, p.thumb_size, p.mid_size, p.blob_id
+                    FROM unnest($1::int[]) WITH ORDINALITY AS i(id, ord)
+                    JOIN photos p ON p.id = i.id
+                    LEFT JOIN blobs b ON b.id = p.blob_id
+                    WHERE p.deleted_at IS NULL AND b.deleting_at IS NULL
+                    ORDER BY i.ord
+                    RETURNING id, user_id, album_id, s3_key, thumb_key, mid_key,
+                              filename, created_at, size, thumb_size, mid_size;
+                    """,
+                    ids,
+                    user["id"],
+                    target_album_id,
+                )
+                if not rows:
+                    return []
+                # ids are handed out in insert order
+                rows = sorted(rows, key=lambda r: r[0])
+
+                # The copies share one created_at, so the cover is the last
+                # inserted photo that has a thumbnail
+                cover = next((r[4] for r in reversed(rows) if r[4]), None)
+                album_modified_at = await conn.fetchval(
+                    """
+                    UPDATE albums
+                    SET modified_at = CURRENT_TIMESTAMP,
+                        photo_count = photo_count + $2,
+                        cover_thumb_key = COALESCE($3, cover_thumb_key)
+                    WHERE id = $1
+                    RETURNING modified_at
+                    """,
+                    target_album_id,
+                    len(rows),
+                    cover,
+                )
+                await _count_photos(
+                    conn, 1, "p.id = ANY($3::int[])", [r[0] for r in rows]
+                )
+
+                total_imported_size = sum(r[8] for r in rows if r[8])
+                if total_imported_size > 0:
+                    await _add_space_used(conn, target_album_id, total_imported_size)
+        except Exception as e:
+            logging.error("importPhotos error: %s", e)
+            return []
+
+    return [
+        {
+            "id": row[0],
+            "user_id": row[1],
+            "album_id": row[2],
+            "s3_key": aws.create_presigned_url(row[3]),
+            "thumb_key": aws.create_presigned_url(row[4]),
+            "mid_key": aws.create_presigned_url(row[5]),
+            "filename": row[6],
+            "created_at": _iso(row[7]),
+            "size": row[8],
+            "thumb_size": row[9],
+            "mid_size": row[10],
+            "username": user["username"],
+            "album_modified_at": _iso(album_modified_at),
+        }
+        for row in rows
+    ]
+
+
+async def deletePhoto(id: str, username: str | dict) -> int | bool:
+    user = await _resolve_user(username)
+    if not user:
+        return False
+
+    try:
+        photo_id = int(id)
+    except (ValueError, TypeError):
+        return False
+
+    async with get_db_connection() as conn:
+        try:
+            async with conn.transaction():
+                # Fetch photo details together with the album owner
+                row = await conn.fetchrow(
+                    """
+                    SELECT p.user_id, p.album_id, p.size, a.user_id, p.thumb_key
+                    FROM photos p
+                    JOIN albums a ON p.album_id = a.id
+                    WHERE p.id = $1;
+                    """,
+                    photo_id,
+                )
+                if not row:
+                    return False
+
+                (
+                    photo_owner_id,
+                    album_id,
+                    photo_size,
+                    album_owner_id,
+                    thumb_key,
+                ) = row
+
+                # Only the photo owner or album owner may delete
+                if user["id"] not in (photo_owner_id, album_owner_id):
+                    return False
+
+                await _count_photos(conn, -1, "p.id = $3", photo_id)
+
+                # Soft delete the photo and drop its reference on the object
+                deleted = await conn.fetchrow(
+                    """
+                    UPDATE photos
+                    SET album_id = NULL, deleted_at = CURRENT_TIMESTAMP
+                    WHERE id = $1 AND deleted_at IS NULL
+                    RETURNING blob_id;
+                    """,
+                    photo_id,
+                )
+                if deleted is None:
+                    return False
+                await _release_blobs(conn, [deleted[0]])
+
+                # If this photo was the cover, fall back to the next newest one
+                await conn.execute(
+                    """
+                    UPDATE albums
+                    SET photo_count = photo_count - 1,
+                        cover_thumb_key = CASE
+                            WHEN cover_thumb_key IS DISTINCT FROM $2 THEN cover_thumb_key
+                            ELSE (SELECT p.thumb_key FROM photos p
+                                  WHERE p.album_id = $1 AND p.thumb_key IS NOT NULL
+                                  ORDER BY p.created_at DESC LIMIT 1)
+                        END
+                    WHERE id = $1
+                    """,
+                    album_id,
+                    thumb_key,
+                )
+
+                # Update spaceused: subtract the original photo size from the album owner's total
+                if photo_size and photo_size > 0:
+                    await conn.execute(
+                        """
+                        INSERT INTO spaceused (user_id, space)
+                        VALUES ($1, $2)
+                        ON CONFLICT (user_id) DO UPDATE
+                        SET space = spaceused.space - EXCLUDED.space;
+                        """,
+                        album_owner_id,
+                        photo_size,
+                    )
+
+            return album_id
+        except Exception as e:
+            logging.error("deletePhoto error: %s", e)
+            return False
+
+
+async def getAlbums(username: str | dict, authuser: str | dict | None) -> dict | None:
+    user = await _resolve_user(username)
+    if not user:
+        return None
+
+    auth_user_record = await _resolve_user(authuser)
+    username = user["username"]
+    authuser = auth_user_record["username"] if auth_user_record else None
+
+    # Determine if requester is the profile owner or an admin
+    is_profile_owner = username == authuser
+    is_admin = False
+    if auth_user_record and auth_user_record.get("class") == "admin":
+        is_admin = True
+
+    auth_user_id = auth_user_record.get("id") if auth_user_record else None
+
+    async with get_db_connection() as conn:
+        try:
+            # Include owned and subscribed albums (owned by the user whose profile is being viewed)
+            # The thumbnail is the cover kept on the album row by the write paths
+            rows = await conn.fetch(
+                """
+                SELECT a.id, a.code, a.name, a.user_id, a.open,
+                       s_prof.profile AS display_profile,
+                       a.private, a.created_at, u.username,
+                       a.cover_thumb_key AS thumb_key,
+                       a.modified_at,
+                       CASE WHEN a.user_id = $1 THEN s_prof.opened_at ELSE NULL END,
+                       s_auth.opened_at AS sub_opened_at,
+                       EXISTS (SELECT 1 FROM photos p
+                               WHERE p.album_id = a.id AND p.user_id = $2) AS auth_has_photos
+                FROM albums a
+                JOIN users u ON a.user_id = u.id
+                JOIN subscription s_prof ON a.id = s_prof.album_id AND s_prof.user_id = $1
+                LEFT JOIN subscription s_auth ON a.id = s_auth.album_id AND s_auth.user_id = $2
+                WHERE COALESCE(s_prof.archive, FALSE) = FALSE
+                ORDER BY a.modified_at DESC;
+                """,
+                user["id"],
+                auth_user_id,
+            )
+        except Exception as e:
+            logging.error("Error fetching albums: %s", e)
+            rows = []
+
+    if not rows:
+        return None
+
+    albums = []
+    for row in rows:
+        # Permissions check
+        album_owner = row[8]
+        is_owner = authuser == album_owner
+        is_profile = bool(row[5])
+        is_private = bool(row[6])
+
+        # Contributor check comes from the same query (false when not logged in)
+        has_photos = bool(row[13])
+
+        # Allow if: admin OR profile owner OR album owner OR profile OR has photos
+        if not (is_admin or is_profile_owner or is_owner or is_profile or has_photos):
+            continue
+
+        # Privacy rule for thumbnails: only owners see thumbnails for private albums
+        thumb_key = row[9]
+        if is_private and not is_owner:
+            thumb_key = None
+
+        thumb_url = aws.create_presigned_url(thumb_key) if thumb_key else None
+
+        albums.append(
+            {
+                "id": row[0],
+                "code": row[1],
+                "name": row[2],
+                "username": row[8],
+                "open": bool(row[4]),
+                "profile": is_profile,
+                "private": is_private,
+                "created_at": _iso(row[7]),
+                "thumbnail": thumb_url,
+                "modified_at": _iso(row[10]),
+                "opened_at": _iso(row[11]),
+                "sub_opened_at": _iso(row[12]),
+            }
+        )
+    return {"albums": albums}
+
+
+async def getAlbumsWithUserPhotos(authuser: str | dict) -> dict | None:
+    user = await _resolve_user(authuser)
+    if not user:
+        return None
+
+    async with get_db_connection() as conn:
+        try:
+            # Find albums where this user has photos, with the album's cover thumbnail
+            rows = await conn.fetch(
+                """
+                SELECT a.id, a.code, a.name, a.user_id, a.open, o_s.profile, a.private, a.created_at, u.username,
+                       a.cover_thumb_key AS thumb_key,
+                       a.modified_at,
+                       CASE WHEN a.user_id = $1 THEN o_s.opened_at ELSE NULL END,
+                       s.opened_at AS sub_opened_at,
+                       COALESCE(s.archive, FALSE) AS archived
+                FROM albums a
+                JOIN users u ON a.user_id = u.id
+                LEFT JOIN subscription o_s ON a.id = o_s.album_id AND o_s.user_id = a.user_id
+                LEFT JOIN subscription s ON a.id = s.album_id AND s.user_id = $1
+                WHERE (EXISTS (SELECT 1 FROM photos p WHERE p.album_id = a.id AND p.user_id = $1)
+                       OR s.archive = TRUE)
+                  AND NOT (s.user_id IS NOT NULL AND COALESCE(s.archive, FALSE) = FALSE)
+                ORDER BY a.modified_at DESC;
+                """,
+                user["id"],
+            )
+        except Exception as e:
+            logging.error("Error fetching albums with user photos: %s", e)
+            rows = []
+
+    if not rows:
+        return {"albums": []}
+
+    albums = []
+    for row in rows:
+        is_owner = user["username"] == row[8]
+        is_private = bool(row[6])
+        thumb_key = row[9]
+        if is_private and not is_owner:
+            thumb_key = None
+
+        thumb_url = aws.create_presigned_url(thumb_key) if thumb_key else None
+
+        albums.append(
+            {
+                "id": row[0],
+                "code": row[1],
+                "name": row[2],
+                "username": row[8],
+                "open": bool(row[4]),
+                "profile": bool(row[5]),
+                "private": is_private,
+                "created_at": _iso(row[7]),
+                "thumbnail": thumb_url,
+                "modified_at": _iso(row[10]),
+                "opened_at": _iso(row[11]),
+                "sub_opened_at": _iso(row[12]),
+                "archived": bool(row[13]),
+            }
+        )
+    return {"albums": albums}
+
+
+async def createAlbum(username: str | dict, album_name: str) -> str | None:
+    user = await _resolve_user(username)
+    if not user:
+        return None
+    user_id = user["id"]
+
+    async with get_db_connection() as conn:
+        try:
+            async with conn.transaction():
+                album_code = uuid.uuid4().hex
+
+                album_id = await conn.fetchval(
+                    """
+                    INSERT INTO albums (name, user_id, code)
+                    VALUES ($1, $2, $3)
+                    RETURNING id;
+                    """,
+                    album_name,
+                    user_id,
+                    album_code,
+                )
+
+                await conn.execute(
+                    """
+                    INSERT INTO subscription (user_id, album_id, profile)
+                    VALUES ($1, $2, FALSE);
+                    """,
+                    user_id,
+                    album_id,
+                )
+                await _count_albums(conn, user_id, 1)
+            return album_code
+        except Exception as e:
+            logging.error("createAlbum error: %s", e)
+            return None
+
+
+async def subscribe(username: str | dict, albumcode: str) -> bool:
+    user = await _resolve_user(username)
+    album = await getAlbumMeta(albumcode)
+    if not user or not album:
+        return False
+
+    async with get_db_connection() as conn:
+        try:
+            await conn.execute(
+                """
+                INSERT INTO subscription (user_id, album_id)
+                VALUES ($1, $2)
+                ON CONFLICT (user_id, album_id) DO NOTHING;
+                """,
+                user["id"],
+                album["id"],
+            )
+            return True
+        except Exception as e:
+            logging.error(
+                "Error subscribing user %s to album %s: %s",
+                user["username"],
+                albumcode,
+                e,
+            )
+            return False
+
+
+async def unsubscribe(username: str | dict, albumcode: str) -> bool:
+    user = await _resolve_user(username)
+    album = await getAlbumMeta(albumcode)
+    if not user or not album:
+        return False
+
+    async with get_db_connection() as conn:
+        try:
+            await conn.execute(
+                """
+                DELETE FROM subscription
+                WHERE user_id = $1 AND album_id = $2;
+                """,
+                user["id"],
+                album["id"],
+            )
+            return True
+        except Exception as e:
+            logging.error(
+                "Error unsubscribing user %s from album %s: %s",
+                user["username"],
+                albumcode,
+                e,
+            )
+            return False
+
+
+async def toggleOpen(id: str, username: str | dict) -> dict | None:
+    user = await _resolve_user(username)
+    if user is None:
+        return None
+
+    try:
+        album_id = int(id)
+    except (ValueError, TypeError):
+        return None
+
+    async with get_db_connection() as conn:
+        try:
+            # Toggle the `open` flag, but only for the album's owner.
+            album_code = await conn.fetchval(
+                """
+                UPDATE albums
+                SET open = NOT open
+                WHERE id = $1 AND user_id = $2
+                RETURNING code;
+                """,
+                album_id,
+                user["id"],
+            )
+        except Exception as e:
+            logging.error("Error toggling open: %s", e)
+            return None
+
+    if album_code is None:
+        return None
+    await album_cache.invalidate(album_code)
+    return await getAlbum(album_code)
+
+
+async def toggleArchive(id: str, username: str | dict) -> dict | None:
+    user = await _resolve_user(username)
+    if user is None:
+        return None
+
+    try:
+        album_id = int(id)
+    except (ValueError, TypeError):
+        return None
+
+    async with get_db_connection() as conn:
+        try:
+            # Toggle the `archive` flag for the user's subscription.
+            album_code = await conn.fetchval(
+                """
+                UPDATE subscription s
+                SET archive = NOT COALESCE(s.archive, FALSE)
+                FROM albums a
+                WHERE s.user_id = $1 AND s.album_id = $2 AND a.id = s.album_id
+                RETURNING a.code;
+                """,
+                user["id"],
+                album_id,
+            )
+        except Exception as e:
+            logging.error("Error toggling archive: %s", e)
+            return None
+
+    # Return the updated album object to the client
+    if album_code is None:
+        return None
+    return await getAlbumWithSub(album_code, user)
+
+
+async def toggleProfile(id: str, username: str | dict) -> dict | None:
+    user = await _resolve_user(username)
+    if user is None:
+        return None
+
+    try:
+        album_id = int(id)
+    except (ValueError, TypeError):
+        return None
+
+    async with get_db_connection() as conn:
+        try:
+            # Toggle the `profile` flag for the user's subscription.
+            row = await conn.fetchrow(
+                """
+                UPDATE subscription s
+                SET profile = NOT COALESCE(s.profile, FALSE)
+                FROM albums a
+                WHERE s.user_id = $1 AND s.album_id = $2 AND a.id = s.album_id
+                RETURNING a.code, s.profile;
+                """,
+                user["id"],
+                album_id,
+            )
+        except Exception as e:
+            logging.error("Error toggling profile: %s", e)
+            return None
+
+    if row is None:
+        return None
+
+    # Return the updated album object to the client
+    album_obj = await getAlbum(row[0])
+    # Note: since getAlbum returns the owner's profile by default, if the current user isn't the owner,
+    # we need to inject the sub_profile so the UI shows the modified profile properly
+    if album_obj:
+        album_obj["profile"] = row[1]
+    return album_obj
+
+
+async def togglePrivate(id: str, username: str | dict) -> dict | None:
+    user = await _resolve_user(username)
+    if user is None:
+        return None
+
+    try:
+        album_id = int(id)
+    except (ValueError, TypeError):
+        return None
+
+    async with get_db_connection() as conn:
+        try:
+            # Toggle the `private` flag, but only for the album's owner.
+            album_code = await conn.fetchval(
+                """
+                UPDATE albums
+                SET private = NOT private
+                WHERE id = $1 AND user_id = $2
+                RETURNING code;
+                """,
+                album_id,
+                user["id"],
+            )
+        except Exception as e:
+            logging.error("Error toggling private: %s", e)
+            return None
+
+    if album_code is None:
+        return None
+    await album_cache.invalidate(album_code)
+    return await getAlbum(album_code)
+
+
+async def search(term: str) -> str:
+    # 1. Check for a matching username.
+    user = await getUserIdentity(term)
+    if user:
+        return f"/user/{user['username']}"
+
+    # 2. Check for a matching album code.
+    album = await getAlbumMeta(term)
+    if album:
+        return f"/album/{album['code']}"
+
+    # 3. Nothing matched.
+    return ""
+
+
+async def setAlbumName(albumcode: str, albumname: str, username: str | dict) -> bool:
+    user = await _resolve_user(username)
+    if user is None:
+        return False
+
+    async with get_db_connection() as conn:
+        try:
+            album_id = await conn.fetchval(
+                """
+                UPDATE albums
+                SET name = $1
+                WHERE code = $2 AND user_id = $3
+                RETURNING id;
+                """,
+                albumname,
+                albumcode,
+                user["id"],
+            )
+        except Exception as e:
+            logging.error("Error setting album name: %s", e)
+            return False
+
+    if album_id is None:
+        return False
+    await album_cache.invalidate(albumcode)
+    return True
+
+
+async def setUserData(
+    username: str,
+    newusername: str | None = None,
+    email: str | None = None,
+    password: str | None = None,
+    user_class: str | None = None,
+    notify_me: str | None = None,
+) -> str:
+    """Update user information (username, email, password, or class) conditionally."""
+    user = await getUser(username)
+    if not user:
+        return "error"
+
+    update_fields = []
+    params = []
+    renamed = False
+
+    # Helper to check if a value is valid for update (not None and length >= 3)
+    def is_valid(val):
+        return val is not None and len(str(val)) >= 3
+
+    def add_field(column, value):
+        params.append(value)
+        update_fields.append(f"{column} = ${len(params)}")
+
+    # Check newusername
+    if is_valid(newusername) and newusername != user["username"]:
+        # Check if new username is already taken
+        assert newusername is not None  # Ensured by is_valid check
+        if await getUserIdentity(newusername) is not None:
+            return "username taken"
+        add_field("username", newusername)
+        renamed = True
+
+    # Check email
+    if is_valid(email) and email != user["email"]:
+        assert email is not None  # Ensured by is_valid check
+        add_field("email", email)
+
+    # Check password
+    if is_valid(password):
+        assert password is not None  # Ensured by is_valid check
+        salt = random.randbytes(16).hex()
+        passhash = hashlib.sha256((password + salt).encode()).hexdigest()
+        add_field("passhash", passhash)
+        add_field("salt", salt)
+
+    # Check class
+    if user_class is not None and user_class != user["class"]:
+        add_field("class", user_class)
+
+    # Check notify_me
+    if notify_me is not None and notify_me != user.get("notify_me"):
+        add_field("notify_me", notify_me)
+
+    if not update_fields:
+        return "no changes"  # Nothing to update, but not an error
+
+    params.append(user["id"])
+    query = f"UPDATE users SET {', '.join(update_fields)} WHERE id = ${len(params)}"
+
+    async with get_db_connection() as conn:
+        try:
+            await conn.execute(query, *params)
+            # Cached albums carry the owner's username
+            codes = []
+            if renamed:
+                codes = [
+                    row[0]
+                    for row in await conn.fetch(
+                        "SELECT code FROM albums WHERE user_id = $1", user["id"]
+                    )
+                ]
+        except Exception as e:
+            logging.error("Error updating user data: %s", e)
+            return "error"
+
+    # A rename changes who both names resolve to
+    await user_cache.invalidate(username, *([newusername] if renamed else []))
+    await album_cache.invalidate(*codes)
+    return "success"
+
+
+async def getEmail(username: str) -> str | None:
+    async with get_db_connection() as conn:
+        try:
+            return await conn.fetchval(
+                "SELECT email FROM users WHERE username = $1", username
+            )
+        except Exception:
+            return None
+
+
+async def getAccountData(username: str) -> dict | None:
+    """
+    Consolidates getEmail, getUser, and getUsage into one call.
+    Returns a dictionary with comprehensive account and usage data.
+    The counts come from user_stats, kept up to date by the writers.
+    """
+    async with get_db_connection() as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT
+                u.id, u.username, u.email, u.class, u.notify_me,
+                COALESCE(st.num_photos, 0) as num_photos,
+                COALESCE(st.num_albums, 0) as num_albums,
+                COALESCE(st.num_other_photos, 0) as num_other_photos,
+                st.size_photos as total_size_photos,
+                st.size_albums as total_size_albums,
+                (SELECT space FROM spaceused WHERE user_id = u.id) as space_used_table,
+                COALESCE(ul.max_size, (SELECT max_size FROM user_limits WHERE class = 'free')) as max_size
+            FROM users u
+            LEFT JOIN user_stats st ON st.user_id = u.id
+            LEFT JOIN user_limits ul ON LOWER(u.class) = ul.class
+            WHERE u.username = $1;
+            """,
+            username,
+        )
+
+    if not row:
+        return None
+
+    (
+        user_id,
+        uname,
+        email,
+        uclass,
+        notify_me,
+        num_photos,
+        num_albums,
+        num_other_photos,
+        total_size_photos,
+        total_size_albums,
+        space_used_table,
+        max_size,
+    ) = row
+
+    # Calculate remaining space
+    remaining_space = max(0, max_size - (space_used_table or 0))
+
+    return {
+        "userInfo": {
+            "username": uname,
+            "email": email,
+            "class": uclass,
+            "notify_me": notify_me,
+        },
+        "usage": {
+            "number of photos": num_photos,
+            "number of albums": num_albums,
+            "number of other peoples photos in users albums": num_other_photos,
+            "total size of photos": int(total_size_photos or 0),
+            "total size in user albums": int(total_size_albums or 0),
+            "spaceused_table": int(space_used_table or 0),
+            "remaining space": int(remaining_space),
+        },
+        "email": email,
+    }
+
+
+# --------------------------------------------------------------------------- #
+# Admin functions
+# --------------------------------------------------------------------------- #
+
+
+# Keys per known-key query while reconciling the bucket
+RECONCILE_DB_BATCH = 5000
+# Orphan keys kept in the cleanup2 report
+RECONCILE_SAMPLE = 100
+# Last bucket key reconciled, so an interrupted run resumes after it,
+# saved every RECONCILE_CHECKPOINT_PAGES listing pages
+RECONCILE_CHECKPOINT_KEY = "cleanup2:checkpoint"
+RECONCILE_CHECKPOINT_PAGES = 10
+RECONCILE_CHECKPOINT_TTL = 7 * 24 * 3600
+# Held by the deleting run so sweeps and admin runs never overlap;
+# refreshed at every checkpoint
+RECONCILE_LOCK_KEY = "cleanup2:lock"
+RECONCILE_LOCK_TTL = 15 * 60
+# Objects younger than this are never orphans: their photo may still be
+# on its way to add-photo-metadata or an upload-session commit
+ORPHAN_GRACE_SECONDS = getattr(env, "ORPHAN_GRACE_SECONDS", 24 * 3600)
+# Orphans deleted per second at most; 0 lifts the limit
+ORPHAN_DELETE_RATE = getattr(env, "ORPHAN_DELETE_RATE", 200)
+# Sorted set of keys handed out for upload but not yet registered, each
+# scored by the Unix time its reservation lapses; cleanup2 skips them
+PENDING_UPLOADS_KEY = "pending-uploads"
+# blobs columns holding a bucket key
+_BLOB_KEY_COLUMNS = ("s3_key", "thumb_key", "mid_key")
+
+
+async def _known_keys(column: str, after: str):
+    """Yield the keys in one of _BLOB_KEY_COLUMNS after *after*, in bucket order.
+
+    Object stores list keys in byte order, which is "C" collation here,
+    and each column has a "C" index to read them from in that order.
+    Each batch is its own short query continuing from the last key seen,
+    so a long run neither holds a snapshot open (and vacuum back) for its
+    whole length nor misses blobs committed while it is running.
+    """
+    while True:
+        async with get_db_connection() as conn:
+            rows = await conn.fetch(
+                f"""
+                SELECT {column} FROM blobs
+                WHERE {column} COLLATE "C" > $1
+                ORDER BY {column} COLLATE "C"
+                LIMIT $2
+                """,
+                after,
+                RECONCILE_DB_BATCH,
+            )
+        for r in rows:
+            yield r[0]
+        if len(rows) < RECONCILE_DB_BATCH:
+            return
+        after = rows[-1][0]
+
+
+async def cleanup2(
+    ctx=None, dry_run: bool = False, max_pages: int | None = None
+) -> dict:
+    """
+    Synchronise the S3 bucket with the database.
+
+    Bucket listing pages and each key column of the blobs table are read
+    in key order and walked in lockstep, so album prefixes are reconciled
+    one after another and memory is one listing page plus one batch of
+    keys per column, however large the bucket.  Objects the database does
+    not know are deleted, or with *dry_run* only counted and sampled,
+    unless they are younger than ORPHAN_GRACE_SECONDS or still reserved
+    in PENDING_UPLOADS_KEY.  Deletes are paced to ORPHAN_DELETE_RATE.
+
+    Every RECONCILE_CHECKPOINT_PAGES pages the deleter is drained and the
+    last key listed is checkpointed in Redis, so a run that dies resumes
+    after it without skipping an orphan; a finished run clears it.  With
+    *max_pages* a run stops after that many pages and the next one picks
+    up where it left off, so the bucket can be swept in small slices.
+    """
+    redis_client = cache.redis_client
+    lock = None
+    if not dry_run:
+        lock = uuid.uuid4().hex
+        if not await redis_client.set(
+            RECONCILE_LOCK_KEY, lock, nx=True, ex=RECONCILE_LOCK_TTL
+        ):
+            logging.info("Bucket reconciliation already running; skipped")
+            return {"skipped": "already running"}
+
+    try:
+        return await _reconcile_bucket(dry_run, max_pages, lock)
+    finally:
+        if lock is not None and await redis_client.get(RECONCILE_LOCK_KEY) == lock:
+            await redis_client.delete(RECONCILE_LOCK_KEY)
+
+
+async def _reconcile_bucket(dry_run: bool, max_pages: int | None, lock) -> dict:
+    redis_client = cache.redis_client
+    checkpoint_key = RECONCILE_CHECKPOINT_KEY + (":dry-run" if dry_run else "")
+    start_after = await redis_client.get(checkpoint_key) or ""
+    if start_after:
+        logging.info("Resuming bucket reconciliation after %s", start_after)
+    # Reservations that have lapsed no longer protect anything
+    await redis_client.zremrangebyscore(PENDING_UPLOADS_KEY, "-inf", time.time())
+
+    s3 = await asyncio.to_thread(aws.get_s3_client)
+    deleter = None if dry_run else aws.BulkDeleter()
+    pace = aws.TokenBucket(ORPHAN_DELETE_RATE)
+    known = [_known_keys(column, start_after) for column in _BLOB_KEY_COLUMNS]
+    heads = [await anext(stream, None) for stream in known]
+    report = {
+        "dry_run": dry_run,
+        "resumed_after": start_after or None,
+        "complete": False,
+        "pages": 0,
+        "listed": 0,
+        "recent": 0,
+        "pending": 0,
+        "orphans": 0,
+        "orphan_bytes": 0,
+        "sample": [],
+    }
+    continuation_token = None
+
+    while True:
+
+        def list_objects():
+            params = {"Bucket": aws.BUCKET_NAME, "MaxKeys": 1000}
+            if continuation_token:
+                params["ContinuationToken"] = continuation_token
+            elif start_after:
+                params["StartAfter"] = start_after
+            return s3.list_objects_v2(**params)
+
+        page = await asyncio.to_thread(list_objects)
+        contents = page.get("Contents", [])
+
+        if not contents:
+            report["complete"] = True
+            break
+
+        report["pages"] += 1
+        report["listed"] += len(contents)
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            seconds=ORPHAN_GRACE_SECONDS
+        )
+        unknown = []
+        for obj in contents:
+            key = obj["Key"]
+
+            # Catch each column up to this key; a match means it is in use
+            in_use = False
+            for i, stream in enumerate(known):
+                while heads[i] is not None and heads[i] < key:
+                    heads[i] = await anext(stream, None)
+                in_use = in_use or heads[i] == key
+            if in_use:
+                continue
+
+            # Safeguard: Skip directory markers if they exist in R2
+            if key.endswith("/"):
+                continue
+
+            if obj["LastModified"] > cutoff:
+                report["recent"] += 1
+                continue
+            unknown.append(obj)
+
+        if unknown:
+            # One registry lookup for the page's candidates
+            lapses = await redis_client.zmscore(
+                PENDING_UPLOADS_KEY, [obj["Key"] for obj in unknown]
+            )
+            now = time.time()
+            for obj, lapse in zip(unknown, lapses):
+                if lapse is not None and lapse > now:
+                    report["pending"] += 1
+                    continue
+                key = obj["Key"]
+                report["orphans"] += 1
+                report["orphan_bytes"] += obj.get("Size", 0)
+                if len(report["sample"]) < RECONCILE_SAMPLE:
+                    report["sample"].append(key)
+                if deleter is not None:
+                    # Deleted in full 1,000-key requests, several at a time
+                    await pace.acquire()
+                    await deleter.add(key)
+
+        report["complete"] = not page.get("IsTruncated")
+        last_page = report["complete"] or report["pages"] == max_pages
+        if last_page or report["pages"] % RECONCILE_CHECKPOINT_PAGES == 0:
+            # Everything up to here is deleted before it is skipped on resume
+            if deleter is not None:
+                await deleter.drain()
+            if not report["complete"]:
+                await redis_client.set(
+                    checkpoint_key, contents[-1]["Key"], ex=RECONCILE_CHECKPOINT_TTL
+                )
+            if lock is not None:
+                await redis_client.expire(RECONCILE_LOCK_KEY, RECONCILE_LOCK_TTL)
+        if last_page:
+            break
+
+        continuation_token = page.get("NextContinuationToken")
+        # Yield control between pages
+        await asyncio.sleep(0.05)
+
+    for stream in known:
+        await stream.aclose()
+    if deleter is not None:
+        report.update(await deleter.close())
+    if report["complete"]:
+        # The next run starts over from the top of the bucket
+        await redis_client.delete(checkpoint_key)
+
+    logging.info(
+        "Cleanup %s%s: %d objects listed, %d orphaned (%d bytes), "
+        "%d too recent, %d pending, %d deleted, %d failed.",
+        "completed" if report["complete"] else "stopped",
+        " (dry run)" if dry_run else "",
+        report["listed"],
+        report["orphans"],
+        report["orphan_bytes"],
+        report["recent"],
+        report["pending"],
+        report.get("deleted", 0),
+        report.get("failed", 0),
+    )
+    return report
+
+
+# Last R2 usage figure from the Cloudflare API, refreshed by the worker
+R2_USAGE_KEY = "r2-usage"
+R2_USAGE_TTL = 24 * 3600
+
+
+async def refreshBucketUsage() -> int | None:
+    """Fetch the bucket's size from Cloudflare and cache it for totalSpaceUsed."""
+    r2_usage = await asyncio.to_thread(aws.get_bucket_usage)
+    if not r2_usage:
+        return None
+    size = int(r2_usage.get("result", {}).get("payloadSize", 0) or 0)
+    await cache.redis_client.set(
+        R2_USAGE_KEY,
+        json.dumps(
+            {
+                "size": size,
+                "fetched_at": _iso(datetime.datetime.now(datetime.timezone.utc)),
+            }
+        ),
+        ex=R2_USAGE_TTL,
+    )
+    return size
+
+
+async def totalSpaceUsed() -> dict:
+    """Get storage usage statistics including the cached R2 bucket size.
+
+    The totals are the sum of the storage_stats shards and the R2 figure
+    is the last one the worker fetched, so this is a few row reads.
+    """
+    async with get_db_connection() as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT COALESCE(SUM(total), 0)::bigint,
+                   COALESCE(SUM(thumbs), 0)::bigint,
+                   COALESCE(SUM(mids), 0)::bigint,
+                   COALESCE(SUM(no_size_count), 0)::bigint,
+                   COALESCE(SUM(total_files), 0)::bigint,
+                   COALESCE(SUM(total_albums), 0)::bigint,
+                   COALESCE(SUM(total_users), 0)::bigint
+            FROM storage_stats
+            """
+        )
+    result = dict(
+        zip(
+            (
+                "total",
+                "thumbs",
+                "mids",
+                "no_size_count",
+                "total_files",
+                "total_albums",
+                "total_users",
+            ),
+            row,
+        )
+    )
+
+    try:
+        r2_usage = await cache.redis_client.get(R2_USAGE_KEY)
+    except Exception as e:
+        logging.error("Could not read cached R2 usage: %s", e)
+        r2_usage = None
+    if r2_usage:
+        r2_usage = json.loads(r2_usage)
+        result["totalr2"] = r2_usage["size"]
+        result["totalr2_fetched_at"] = r2_usage["fetched_at"]
+
+    return result
+
+
+async def updatePhotoSizes(
+    photo_id: int, size: int, thumb_size: int | None = None, mid_size: int | None = None
+):
+    # Update the photo sizes in the database - this is called by the worker
+    await updatePhotoSizesBatch([(photo_id, size, thumb_size, mid_size)])
+
+
+async def updatePhotoSizesBatch(rows: list[tuple]) -> int:
+    """updatePhotoSizes for many (photo_id, size, thumb_size, mid_size) rows.
+
+    One UPDATE for the whole batch, plus one spaceused upsert per owner
+    and the stats moved from the old sizes to the new.
+    Rows with no size (a failed probe) are left alone.  A photo whose
+    size was already known, e.g. declared at upload, is corrected and
+    its owner's spaceused moved by the difference.  Returns the number
+    of photos updated.
+    """
+    if not rows:
+        return 0
+    ids, sizes, thumb_sizes, mid_sizes = (list(col) for col in zip(*rows))
+    # The photos the UPDATE below changes
+    sized_ids = [i for i, size in zip(ids, sizes) if size and size > 0]
+
+    async with get_db_connection() as conn:
+        try:
+            async with conn.transaction():
+                # Lock the rows first (in id order, so concurrent batches
+                # cannot deadlock): no other writer can change a size
+                # between it being counted out here and rewritten below
+                await conn.execute(
+                    """
+                    SELECT 1 FROM photos
+                    WHERE id = ANY($1::int[])
+                    ORDER BY id
+                    FOR UPDATE
+                    """,
+                    ids,
+                )
+                # Count them out at their old sizes and back in at the new
+                await _count_photos(conn, -1, "p.id = ANY($3::int[])", sized_ids)
+                # Read the size each one had before
+                updated = await conn.fetch(
+                    """
+                    WITH v AS (
+                        SELECT *
+                        FROM unnest($1::int[], $2::int[], $3::int[], $4::int[])
+                            AS v(id, size, thumb_size, mid_size)
+                    ), locked AS (
+                        SELECT p.id, p.size AS old_size, a.user_id
+                        FROM photos p
+                        JOIN albums a ON p.album_id = a.id
+                        WHERE p.id IN (SELECT id FROM v)
+                        ORDER BY p.id
+                        FOR UPDATE OF p
+                    )
+                    UPDATE photos p
+                    SET size = v.size,
+                        thumb_size = COALESCE(v.thumb_size, p.thumb_size),
+                        mid_size = COALESCE(v.mid_size, p.mid_size)
+                    FROM v
+                    JOIN locked l ON l.id = v.id
+                    WHERE p.id = v.id AND v.size > 0
+                    RETURNING p.id, l.user_id, l.old_size, v.size, p.blob_id
+                    """,
+                    ids,
+                    sizes,
+                    thumb_sizes,
+                    mid_sizes,
+                )
+
+                # Charge only the change from the stored size, so a retried
+                # batch never counts a photo twice.
+                grown = {}
+                for photo_id, owner_id, old_size, size, _ in updated:
+                    if old_size is not None and old_size != size:
+                        logging.warning(
+                            "Photo %s size was %s, object is %s",
+                            photo_id,
+                            old_size,
+                            size,
+                        )
+                    if size != old_size:
+                        grown[owner_id] = (
+                            grown.get(owner_id, 0) + size - (old_size or 0)
+                        )
+                # Keep the shared object's size in step
+                sized = [(r[4], r[3]) for r in updated if r[4] is not None]
+                if sized:
+                    await conn.execute(
+                        """
+                        UPDATE blobs b SET size = v.size
+                        FROM unnest($1::int[], $2::int[]) AS v(id, size)
+                        WHERE b.id = v.id AND b.size IS DISTINCT FROM v.size
+                        """,
+                        [blob_id for blob_id, _ in sized],
+                        [size for _, size in sized],
+                    )
+                if grown:
+                    await conn.execute(
+                        """
+                        INSERT INTO spaceused (user_id, space)
+                        SELECT * FROM unnest($1::int[], $2::bigint[])
+                        ON CONFLICT (user_id) DO UPDATE
+                        SET space = spaceused.space + EXCLUDED.space;
+                        """,
+                        list(grown),
+                        list(grown.values()),
+                    )
+                await _count_photos(conn, 1, "p.id = ANY($3::int[])", sized_ids)
+        except Exception as e:
+            logging.error("Error updating photo sizes for %s photos: %s", len(ids), e)
+            return 0
+    return len(updated)
+
+
+async def uncountedPhotos(after_id: int = 0, limit: int | None = None) -> list:
+    """Photos with no size yet, in id order after *after_id*."""
+    async with get_db_connection() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT id, s3_key, thumb_key, mid_key
+            FROM photos
+            WHERE size IS NULL AND id > $1
+            ORDER BY id
+            LIMIT $2
+            """,
+            after_id,
+            limit,
+        )
+    return [tuple(r) for r in rows]
+
+
+async def claim_released_blobs(age_hours: int = 0) -> list:
+    """Claim blobs with no references since more than *age_hours* ago.
+
+    Marks them deleting, so no upload or import can take a reference
+    while their objects are removed, and returns (id, s3_key, thumb_key,
+    mid_key) for each.  Blobs claimed by an earlier run that did not
+    finish are returned again.
+    """
+    async with get_db_connection() as conn:
+        try:
+            rows = await conn.fetch(
+                """
+                UPDATE blobs b
+                SET deleting_at = COALESCE(b.deleting_at, NOW())
+                FROM (
+                    SELECT id FROM blobs
+                    WHERE refcount <= 0
+                      AND released_at < NOW() - make_interval(hours => $1)
+                    ORDER BY id
+                    FOR UPDATE SKIP LOCKED
+                ) c
+                WHERE b.id = c.id
+                RETURNING b.id, b.s3_key, b.thumb_key, b.mid_key
+                """,
+                age_hours,
+            )
+        except Exception as e:
+            logging.error("Error claiming released blobs: %s", e)
+            return []
+    return [tuple(r) for r in rows]
+
+
+async def delete_released_blobs(blob_ids: list[int]) -> int:
+    """Remove claimed blobs whose objects are gone, with their soft-deleted photos.
+
+    Returns the number of blobs removed.
+    """
+    if not blob_ids:
+        return 0
+
+    async with get_db_connection() as conn:
+        try:
+            status = await conn.execute(
+                """
+                DELETE FROM blobs
+                WHERE id = ANY($1::int[]) AND deleting_at IS NOT NULL
+                """,
+                blob_ids,
+            )
+        except Exception as e:
+            logging.error("Error deleting released blobs: %s", e)
+            return 0
+    return _rowcount(status)
+
+
+async def backfillAlbumCovers(after_id: int = 0, batch_size: int = 500) -> int | None:
+    """Recompute cover_thumb_key and photo_count for the next batch of albums.
+
+    Returns the last album id handled, or None once every album is done.
+    """
+    async with get_db_connection() as conn:
+        return await conn.fetchval(
+            """
+            WITH batch AS (
+                SELECT id FROM albums WHERE id > $1 ORDER BY id LIMIT $2
+            ), updated AS (
+                UPDATE albums a
+                SET cover_thumb_key = (
+                        SELECT p.thumb_key FROM photos p
+                        WHERE p.album_id = a.id AND p.thumb_key IS NOT NULL
+                        ORDER BY p.created_at DESC LIMIT 1
+                    ),
+                    photo_count = (SELECT COUNT(*) FROM photos p WHERE p.album_id = a.id)
+                FROM batch
+                WHERE a.id = batch.id
+                RETURNING a.id
+            )
+            SELECT MAX(id) FROM updated
+            """,
+            after_id,
+            batch_size,
+        )
+
+
+async def albumCoversMissing() -> bool:
+    """True if some album with photos has no cover yet (e.g. right after migrating)."""
+    async with get_db_connection() as conn:
+        return await conn.fetchval(
+            """
+            SELECT EXISTS (
+                SELECT 1 FROM albums a
+                WHERE a.cover_thumb_key IS NULL AND a.photo_count > 0
+                  AND EXISTS (SELECT 1 FROM photos p
+                              WHERE p.album_id = a.id AND p.thumb_key IS NOT NULL)
+            )
+            """
+        )
+
+
+# --------------------------------------------------------------------------- #
+# Stripe helpers
+# --------------------------------------------------------------------------- #
+
+
+async def getStripeCustomerId(username: str) -> str | None:
+    """Retrieve the Stripe customer ID for a given username."""
+    async with get_db_connection() as conn:
+        try:
+            return await conn.fetchval(
+                "SELECT stripe_customer_id FROM users WHERE username = $1", username
+            )
+        except Exception as e:
+            logging.error("Error getting stripe customer id for %s: %s", username, e)
+            return None
+
+
+async def updateUserStripeCustomerId(username: str, customer_id: str) -> None:
+    """Update the Stripe customer ID for a given username."""
+    async with get_db_connection() as conn:
+        try:
+            await conn.execute(
+                """
+                UPDATE users
+                SET stripe_customer_id = $1
+                WHERE username = $2;
+                """,
+                customer_id,
+                username,
+            )
+        except Exception as e:
+            logging.error("Error updating stripe customer id for %s: %s", username, e)
+
+
+async def updateUserPlan(
+    customer_id: str, plan: str, event_id: str | None = None
+) -> None:
+    """Update the user's plan (class) based on their Stripe customer ID and log the event."""
+    async with get_db_connection() as conn:
+        try:
+            async with conn.transaction():
+                # Update users table (the 'class' column represents the plan level)
+                usernames = await conn.fetch(
+                    """
+                    UPDATE users
+                    SET class = $1
+                    WHERE stripe_customer_id = $2
+                    RETURNING username;
+                    """,
+                    plan,
+                    customer_id,
+                )
+
+                # Log to stripe1 table for transaction/plan history
+                await conn.execute(
+                    """
+                    INSERT INTO stripe1 (customer_id, plan, event_id)
+                    VALUES ($1, $2, $3);
+                    """,
+                    customer_id,
+                    plan,
+                    event_id,
+                )
+        except Exception as e:
+            logging.error("Error updating plan for customer %s: %s", customer_id, e)
+            return
+
+    await user_cache.invalidate(*(row[0] for row in usernames))
+
+
+async def dumpStripeEvent(event_id: str, event: dict) -> None:
+    """Store the raw Stripe event data in the stripedump table."""
+    customer_id = event.get("data", {}).get("object", {}).get("customer")
+    async with get_db_connection() as conn:
+        try:
+            await conn.execute(
+                """
+                INSERT INTO stripedump (event_id, customer_id, data)
+                VALUES ($1, $2, $3::jsonb)
+                ON CONFLICT (event_id) DO NOTHING;
+                """,
+                event_id,
+                customer_id,
+                json.dumps(event),
+            )
+        except Exception as e:
+            logging.error("Error dumping stripe event %s: %s", event_id, e)
+
+
+async def delete_user(username: str) -> None:
+    """Delete a user and all associated data from the database."""
+    async with get_db_connection() as conn:
+        try:
+            async with conn.transaction():
+                user_id = await conn.fetchval(
+                    "SELECT id FROM users WHERE username = $1", username
+                )
+                if user_id is None:
+                    return
+
+                # The cascade removes every live photo in this user's albums
+                # and every one they added elsewhere; drop their references.
+                # Objects still shared through other users' imports stay.
+                blob_rows = await conn.fetch(
+                    """
+                    SELECT p.blob_id
+                    FROM photos p
+                    WHERE p.deleted_at IS NULL
+                      AND (p.user_id = $1
+                           OR p.album_id IN (SELECT id FROM albums WHERE user_id = $1))
+                    """,
+                    user_id,
+                )
+                released = await _release_blobs(conn, [r[0] for r in blob_rows])
+                # Objects nobody references any more go straight away
+                killed_keys = []
+                for s3_key, thumb_key, mid_key in await conn.fetch(
+                    """
+                    DELETE FROM blobs
+                    WHERE id = ANY($1::int[]) AND refcount <= 0
+                    RETURNING s3_key, thumb_key, mid_key
+                    """,
+                    released,
+                ):
+                    killed_keys.extend(k for k in (s3_key, thumb_key, mid_key) if k)
+
+                # The cascade also removes this user's photos from other people's
+                # albums, so take them off those albums' cached counts and covers.
+                await conn.execute(
+                    """
+                    UPDATE albums a
+                    SET photo_count = a.photo_count - c.n,
+                        cover_thumb_key = (
+                            SELECT p.thumb_key FROM photos p
+                            WHERE p.album_id = a.id AND p.thumb_key IS NOT NULL
+                              AND p.user_id <> $1
+                            ORDER BY p.created_at DESC LIMIT 1
+                        )
+                    FROM (
+                        SELECT album_id, COUNT(*) AS n
+                        FROM photos
+                        WHERE user_id = $1 AND album_id IS NOT NULL
+                        GROUP BY album_id
+                    ) c
+                    WHERE a.id = c.album_id AND a.user_id <> $1
+                    """,
+                    user_id,
+                )
+
+                # Their own stats row goes with the cascade; other users'
+                # lose the photos that go with it
+                await _count_photos(
+                    conn,
+                    -1,
+                    "p.user_id = $3 OR p.album_id IN "
+                    "(SELECT id FROM albums WHERE user_id = $3)",
+                    user_id,
+                )
+
+                # Delete user record (cascades to albums, photos, subscriptions, etc.)
+                codes = await conn.fetch(
+                    "SELECT code FROM albums WHERE user_id = $1", user_id
+                )
+                await _count_albums(conn, user_id, -len(codes))
+                await _count_users(conn, -1)
+                await conn.execute("DELETE FROM users WHERE id = $1", user_id)
+        except Exception as e:
+            logging.error("Error deleting user %s: %s", username, e)
+            return
+
+    await user_cache.invalidate(username)
+    await album_cache.invalidate(*(row[0] for row in codes))
+
+    # Each job sends its keys as concurrent 1,000-key requests
+    for i in range(0, len(killed_keys), DELETE_JOB_KEYS):
+        await enqueue_delete_keys(killed_keys[i : i + DELETE_JOB_KEYS])
@@ -1,18 +1,24 @@
+import asyncio
 import datetime
-import json
 import logging
 import os
+import random
+import time
 import uuid
+from typing import Literal
 
+import adb
 import aws
+import codec
 import db
 import env
 import redis.asyncio as redis
 import stripe_endpoint
 import watcher
+import wsrouter
+import wssession
 from arq import create_pool
 from arq.connections import RedisSettings
-from botocore.exceptions import ClientError
 from fastapi import (
     Depends,
     FastAPI,
@@ -107,8 +113,8 @@ async def health_check():
 
 
 @app.post("/api/login")
-def login(user: User, response: Response, Authorize: AuthJWT = Depends()):
-    db_user = db.check_password(user.username, user.password)
+async def login(user: User, response: Response, Authorize: AuthJWT = Depends()):
+    db_user = await adb.check_password(user.username, user.password)
     if not db_user:
         raise HTTPException(status_code=401, detail="Bad username or password")
 
@@ -141,11 +147,11 @@ async def register(
     parses it into the RegisterRequest model.
     """
 
-    prev_id = await get_user_id(request.username)
+    prev_id = await adb.get_user_id(request.username)
     if prev_id is not None:
         raise HTTPException(status_code=400, detail="Username already exists")
 
-    db.setUser(request.username, request.email, request.password)
+    await adb.setUser(request.username, request.email, request.password)
 
     logging.info("Registering user: %s, email: %s, ", request.username, request.email)
     access_token = Authorize.create_access_token(subject=request.username)
@@ -191,12 +197,12 @@ def logout(response: Response, Authorize: AuthJWT = Depends()):
 
 
 @app.get("/api/protected")
-def protected(Authorize: AuthJWT = Depends()):
+async def protected(Authorize: AuthJWT = Depends()):
     Authorize.jwt_required()
 
     current_user = Authorize.get_jwt_subject()
 
-    user_info = db.getUser(current_user)
+    user_info = await adb.getUser(current_user)
     return {"user_info": user_info}
 
 
@@ -211,26 +217,6 @@ async def generate_wssecret_endpoint(Authorize: AuthJWT = Depends()):
     return {"wssecret": wssecret}
 
 
-async def get_user_id(username: str) -> int | None:
-    """
-    Retrieve user ID by username.
-    Checks Redis cache first, then the database, then caches for 5 minutes.
-    """
-    if not username:
-        return None
-    cache_key = f"user_id:{username}"
-    user_id = await redis_client.get(cache_key)
-    if user_id:
-        return int(user_id)
-
-    user_id = db.get_user_id(username)
-    if user_id is not None:
-        await redis_client.set(cache_key, user_id, ex=300)
-        return user_id
-
-    return None
-
-
 class ContactRequest(BaseModel):
     email: str
     subject: str
@@ -258,27 +244,20 @@ async def contact_endpoint(request: ContactRequest):
 # --------------------------------------------------------------------------- #
 
 
-@app.post("/api/s3-presigned")
-async def get_presigned(
-    filename: str = Form(...),
-    album_code: str = Form(...),
-    Authorize: AuthJWT = Depends(),
-):
-    # Authorize.jwt_required()
-
-    current_user = Authorize.get_jwt_subject()
-    if not current_user:
-        # return
-        current_user = "anonymous"
-
-    ctx = db.get_upload_context(str(current_user), album_code)
+async def check_upload(current_user: str, album_code: str) -> dict | None:
+    """
+    Check that current_user may upload to the album.
+    Returns the upload context with the owner's free space as space_remaining.
+    """
+    ctx = await adb.get_upload_context(current_user, album_code)
     if not ctx:
-        return
+        return None
 
     # Calculate space remaining for the album owner
     owner_limit = ctx["owner_limit"]
     space_used = ctx["owner_space_used"]
     space_remaining = max(0, owner_limit - space_used)
+    ctx["space_remaining"] = space_remaining
 
     if space_remaining <= 0:
         raise HTTPException(
@@ -291,45 +270,305 @@ async def get_presigned(
             logging.info("get_presigned - not allowed")
             raise HTTPException(status_code=403, detail="Not Allowed")
 
+    return ctx
+
+
+# Share of uploads with a declared size whose objects are still HEADed by
+# the worker, to catch clients that declare one size and store another
+SIZE_RECONCILE_SAMPLE = getattr(env, "SIZE_RECONCILE_SAMPLE", 0.01)
+
+
+def presign_upload(album_code: str, size: int | None = None) -> dict:
+    """Reserve keys for one upload and presign a PUT for each rendition.
+
+    With a declared *size* the original's PUT only succeeds for exactly
+    that many bytes, so the size can be recorded without a HEAD.
+    """
     file_id = uuid.uuid4().hex
     s3_key = f"{album_code}/{file_id}"
     thumb_key = f"{album_code}/thumb_{file_id}"
     mid_key = f"{album_code}/mid_{file_id}"
 
-    s3_client = aws.get_s3_client()
-    try:
-        # Generate presigned PUT for original
-        original_presigned = s3_client.generate_presigned_url(
-            ClientMethod="put_object",
-            Params={"Bucket": aws.BUCKET_NAME, "Key": s3_key},
-            ExpiresIn=3600,
+    # Signed locally with a cached key; same URLs as boto3's generate_presigned_url
+    return {
+        "s3_key": s3_key,
+        "presigned": aws.presign_url(s3_key, "PUT", 3600, content_length=size),
+        "thumb_key": thumb_key,
+        "thumb_presigned": aws.presign_url(thumb_key, "PUT", 3600),
+        "mid_key": mid_key,
+        "mid_presigned": aws.presign_url(mid_key, "PUT", 3600),
+    }
+
+
+def reserve_upload_keys(pipe, presigns: list[dict]) -> None:
+    """Queue on *pipe* the registration of each upload's keys as pending.
+
+    cleanup2 leaves a pending key alone until its reservation lapses,
+    even if its photo has not been registered yet.
+    """
+    lapses = time.time() + UPLOAD_SESSION_TTL
+    pipe.zadd(
+        adb.PENDING_UPLOADS_KEY,
+        {
+            presign[kind]: lapses
+            for presign in presigns
+            for kind in ("s3_key", "thumb_key", "mid_key")
+        },
+    )
+
+
+def check_upload_size(size: int | None) -> None:
+    """Reject a declared byte size that no real upload could have."""
+    if size is not None and not 0 < size <= adb.MAX_PHOTO_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"size must be between 1 and {adb.MAX_PHOTO_SIZE}",
         )
-        # Generate presigned PUT for thumbnail
-        thumb_presigned = s3_client.generate_presigned_url(
-            ClientMethod="put_object",
-            Params={"Bucket": aws.BUCKET_NAME, "Key": thumb_key},
-            ExpiresIn=3600,
+
+
+def size_check_needed(photo: dict) -> bool:
+    """Whether a new photo's objects should be HEADed for their sizes."""
+    return photo["size"] is None or random.random() < SIZE_RECONCILE_SAMPLE
+
+
+@app.post("/api/s3-presigned")
+async def get_presigned(
+    filename: str = Form(...),
+    album_code: str = Form(...),
+    size: int | None = Form(None),
+    Authorize: AuthJWT = Depends(),
+):
+    # Authorize.jwt_required()
+    check_upload_size(size)
+
+    current_user = Authorize.get_jwt_subject()
+    if not current_user:
+        # return
+        current_user = "anonymous"
+
+    ctx = await check_upload(str(current_user), album_code)
+    if not ctx:
+        return
+
+    presign = presign_upload(album_code, size)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        reserve_upload_keys(pipe, [presign])
+        if size is not None:
+            # Picked up by add-photo-metadata once the upload is done
+            pipe.set(f"upload-size:{presign['s3_key']}", size, ex=UPLOAD_SESSION_TTL)
+        await pipe.execute()
+    return {**presign, "space_remaining": ctx["space_remaining"]}
+
+
+# --------------------------------------------------------------------------- #
+# Batch upload sessions: reserve keys for many files, then register them all
+# with one commit instead of one add-photo-metadata call per file.
+# --------------------------------------------------------------------------- #
+
+MAX_UPLOAD_BATCH = 100
+# Presigned URLs last an hour; keep the reservation a little longer
+UPLOAD_SESSION_TTL = 3600 + 600
+
+
+class UploadSessionRequest(BaseModel):
+    album_code: str
+    filenames: list[str]
+    # Byte size of each file, in filenames order; signed into its PUT
+    sizes: list[int | None] | None = None
+
+
+class UploadedPhoto(BaseModel):
+    s3_key: str
+    filename: str
+    thumb_key: str | None = None
+    mid_key: str | None = None
+    thumb_size: int | None = None
+    mid_size: int | None = None
+
+
+class UploadCommitRequest(BaseModel):
+    photos: list[UploadedPhoto]
+
+
+@app.post("/api/upload-session")
+async def create_upload_session(
+    request: UploadSessionRequest,
+    Authorize: AuthJWT = Depends(),
+):
+    """Presign uploads for up to MAX_UPLOAD_BATCH files and remember the keys."""
+    current_user = Authorize.get_jwt_subject()
+    if not current_user:
+        current_user = "anonymous"
+
+    if len(request.filenames) > MAX_UPLOAD_BATCH:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_UPLOAD_BATCH} files per upload session",
         )
-        # Generate presigned PUT for mid-sized
-        mid_presigned = s3_client.generate_presigned_url(
-            ClientMethod="put_object",
-            Params={"Bucket": aws.BUCKET_NAME, "Key": mid_key},
-            ExpiresIn=3600,
+
+    sizes = request.sizes or [None] * len(request.filenames)
+    if len(sizes) != len(request.filenames):
+        raise HTTPException(
+            status_code=400, detail="sizes must match filenames one to one"
         )
-    except ClientError as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    for size in sizes:
+        check_upload_size(size)
+
+    ctx = await check_upload(str(current_user), request.album_code)
+    if not ctx:
+        return
+
+    session_id = uuid.uuid4().hex
+    files = [
+        {"filename": filename, **presign_upload(request.album_code, size)}
+        for filename, size in zip(request.filenames, sizes)
+    ]
+    session = {
+        "user": str(current_user),
+        "user_id": ctx["uploader_id"],
+        "album_id": ctx["album_id"],
+        "album_code": request.album_code,
+    }
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.set(f"upload-session:{session_id}", codec.dumps(session))
+        pipe.expire(f"upload-session:{session_id}", UPLOAD_SESSION_TTL)
+        if files:
+            # s3_key -> declared size, "" when none was given
+            keys_key = f"upload-session:{session_id}:keys"
+            pipe.hset(
+                keys_key,
+                mapping={
+                    f["s3_key"]: "" if size is None else size
+                    for f, size in zip(files, sizes)
+                },
+            )
+            pipe.expire(keys_key, UPLOAD_SESSION_TTL)
+            reserve_upload_keys(pipe, files)
+        await pipe.execute()
 
     return {
-        "s3_key": s3_key,
-        "presigned": original_presigned,
-        "thumb_key": thumb_key,
-        "thumb_presigned": thumb_presigned,
-        "mid_key": mid_key,
-        "mid_presigned": mid_presigned,
-        "space_remaining": space_remaining,
+        "session_id": session_id,
+        "files": files,
+        "space_remaining": ctx["space_remaining"],
     }
 
 
+@app.post("/api/upload-session/{session_id}/commit")
+async def commit_upload_session(
+    session_id: str,
+    request: UploadCommitRequest,
+    Authorize: AuthJWT = Depends(),
+):
+    """Register the files of a session that finished uploading."""
+    current_user = Authorize.get_jwt_subject()
+    if not current_user:
+        current_user = "anonymous"
+
+    raw = await redis_client.get(f"upload-session:{session_id}")
+    if raw is None:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    session = codec.loads(raw)
+    if session["user"] != str(current_user):
+        raise HTTPException(status_code=403, detail="Not Allowed")
+    album_code = session["album_code"]
+
+    # The renditions must be the ones reserved alongside the original;
+    # a photo that fails this keeps its reservation so it can be retried
+    candidates = []
+    for photo in request.photos:
+        file_id = photo.s3_key.rsplit("/", 1)[-1]
+        if photo.thumb_key not in (None, f"{album_code}/thumb_{file_id}"):
+            logging.info("commit_upload_session - bad thumb_key %s", photo.thumb_key)
+            continue
+        if photo.mid_key not in (None, f"{album_code}/mid_{file_id}"):
+            logging.info("commit_upload_session - bad mid_key %s", photo.mid_key)
+            continue
+        candidates.append(photo)
+
+    # Each reserved key can be committed once; HGET + HDEL in one MULTI
+    # claims it atomically along with its declared size
+    keys_key = f"upload-session:{session_id}:keys"
+    results = []
+    if candidates:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            for photo in candidates:
+                pipe.hget(keys_key, photo.s3_key)
+                pipe.hdel(keys_key, photo.s3_key)
+            results = await pipe.execute()
+
+    photos = []
+    claimed = {}
+    for photo, declared, ok in zip(candidates, results[::2], results[1::2]):
+        if not ok:
+            logging.info("commit_upload_session - unknown key %s", photo.s3_key)
+            continue
+        claimed[photo.s3_key] = declared
+        photos.append(
+            {
+                "s3_key": photo.s3_key,
+                "thumb_key": photo.thumb_key,
+                "mid_key": photo.mid_key,
+                "filename": photo.filename,
+                "size": int(declared) if declared else None,
+                "thumb_size": photo.thumb_size,
+                "mid_size": photo.mid_size,
+            }
+        )
+
+    result = await adb.addPhotos(
+        session["user_id"], session["album_id"], session["user"], photos
+    )
+    if result is None:
+        # Nothing was saved: hand the claimed keys back, for as long as
+        # the session has left, so the commit can be retried
+        ttl = await redis_client.ttl(f"upload-session:{session_id}")
+        if claimed and ttl > 0:
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.hset(keys_key, mapping=claimed)
+                pipe.expire(keys_key, ttl)
+                await pipe.execute()
+        raise HTTPException(status_code=500, detail="Could not save photos")
+    if not result["photos"]:
+        return {"photos": []}
+    # In blobs now, so no longer pending
+    await redis_client.zrem(
+        adb.PENDING_UPLOADS_KEY,
+        *(
+            p[kind]
+            for p in photos
+            for kind in ("s3_key", "thumb_key", "mid_key")
+            if p[kind]
+        ),
+    )
+
+    # One size-check job for the photos that need one
+    to_check = [
+        (new["id"], p["s3_key"], p["thumb_key"], p["mid_key"])
+        for new, p in zip(result["photos"], photos)
+        if size_check_needed(p)
+    ]
+    if to_check:
+        await app.state.redis.enqueue_job(
+            "check_photo_sizes_batch", to_check, _expires=3600
+        )
+
+    message = {
+        "action": "addPhotos",
+        "payload": {"album_id": session["album_id"], "photos": result["photos"]},
+    }
+    await redis_client.publish(f"albumadd-{album_code}", codec.dumps(message))
+    mod_message = {
+        "action": "albumModified",
+        "payload": {
+            "code": album_code,
+            "modified_at": result["album_modified_at"],
+        },
+    }
+    await redis_client.publish(f"album-{album_code}", codec.dumps(mod_message))
+
+    return {"photos": result["photos"]}
+
+
 @app.post("/api/add-photo-metadata")
 async def add_photo_metadata(
     payload: dict,
@@ -340,25 +579,37 @@ async def add_photo_metadata(
     if not current_user:
         current_user = "anonymous"
 
-    user_id = await get_user_id(str(current_user))
+    user_id = await adb.get_user_id(str(current_user))
     if user_id is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    photo_resp = db.addPhoto(
-        {
-            "user_id": user_id,
-            "album_id": payload["album_id"],
-            "filename": payload["filename"],
-            "s3_key": payload["s3_key"],
-            "thumb_key": payload.get("thumb_key"),
-            "mid_key": payload.get("mid_key"),
-            "size": None,
-            "thumb_size": payload.get("thumb_size"),
-            "mid_size": payload.get("mid_size"),
-        }
-    )
+    # The size declared to get_presigned, if any; each can be used once
+    declared = await redis_client.getdel(f"upload-size:{payload['s3_key']}")
+    photo = {
+        "user_id": user_id,
+        "album_id": payload["album_id"],
+        "filename": payload["filename"],
+        "s3_key": payload["s3_key"],
+        "thumb_key": payload.get("thumb_key"),
+        "mid_key": payload.get("mid_key"),
+        "size": int(declared) if declared else None,
+        "thumb_size": payload.get("thumb_size"),
+        "mid_size": payload.get("mid_size"),
+    }
+    photo_resp = await adb.addPhoto(photo)
 
     if photo_resp:
+        # In blobs now, so no longer pending
+        await redis_client.zrem(
+            adb.PENDING_UPLOADS_KEY,
+            *(
+                photo[kind]
+                for kind in ("s3_key", "thumb_key", "mid_key")
+                if photo[kind]
+            ),
+        )
+
+    if photo_resp and size_check_needed(photo):
         await app.state.redis.enqueue_job(
             "check_photo_sizes",
             photo_resp["id"],
@@ -371,7 +622,7 @@ async def add_photo_metadata(
     if photo_resp:
         message = {"action": "addPhoto", "payload": photo_resp}
         await redis_client.publish(
-            f"albumadd-{payload['albumcode']}", json.dumps(message)
+            f"albumadd-{payload['albumcode']}", codec.dumps(message)
         )
 
         # Also publish the updated modified_at time to general album subscribers
@@ -384,21 +635,22 @@ async def add_photo_metadata(
                 },
             }
             await redis_client.publish(
-                f"album-{payload['albumcode']}", json.dumps(mod_message)
+                f"album-{payload['albumcode']}", codec.dumps(mod_message)
             )
 
     return {"photo_id": photo_resp}
 
 
 @app.post("/api/cleanup")
-async def cleanup_endpoint(Authorize: AuthJWT = Depends()):
+async def cleanup_endpoint(dry_run: bool = False, Authorize: AuthJWT = Depends()):
     Authorize.jwt_required()
     current_user = Authorize.get_jwt_subject()
     if current_user != "admin":
         raise HTTPException(status_code=403, detail="Unauthorized")
 
-    await app.state.redis.enqueue_job("cleanup2")
-    return {"status": "cleanup task enqueued"}
+    # A dry run only reports the orphans; its result is kept with the job
+    job = await app.state.redis.enqueue_job("cleanup2", dry_run=dry_run)
+    return {"status": "cleanup task enqueued", "job_id": job.job_id if job else None}
 
 
 @app.post("/api/recount-sizes")
@@ -419,10 +671,40 @@ async def space_used_endpoint(Authorize: AuthJWT = Depends()):
     if current_user != "admin":
         raise HTTPException(status_code=403, detail="Unauthorized")
 
-    data = db.totalSpaceUsed()
+    data = await adb.totalSpaceUsed()
     return data
 
 
+@app.get("/api/watcher-stats")
+async def watcher_stats_endpoint(Authorize: AuthJWT = Depends()):
+    Authorize.jwt_required()
+    current_user = Authorize.get_jwt_subject()
+    if current_user != "admin":
+        raise HTTPException(status_code=403, detail="Unauthorized")
+
+    return manager.metrics()
+
+
+@app.get("/api/cache-stats")
+async def cache_stats_endpoint(Authorize: AuthJWT = Depends()):
+    Authorize.jwt_required()
+    current_user = Authorize.get_jwt_subject()
+    if current_user != "admin":
+        raise HTTPException(status_code=403, detail="Unauthorized")
+
+    return {c.name: c.metrics() for c in (adb.album_cache, adb.user_cache)}
+
+
+@app.get("/api/ws-stats")
+async def ws_stats_endpoint(Authorize: AuthJWT = Depends()):
+    Authorize.jwt_required()
+    current_user = Authorize.get_jwt_subject()
+    if current_user != "admin":
+        raise HTTPException(status_code=403, detail="Unauthorized")
+
+    return ws_router.metrics()
+
+
 class ResetCodeRequest(BaseModel):
     username: str
 
@@ -431,7 +713,7 @@ class ResetCodeRequest(BaseModel):
 async def send_reset_code_endpoint(request: ResetCodeRequest):
     import random
 
-    user_email = db.getEmail(request.username)
+    user_email = await adb.getEmail(request.username)
     if not user_email:
         logging.warning(
             f"Reset code requested for unknown or email-less user: {request.username}"
@@ -460,7 +742,7 @@ async def reset_password_endpoint(request: ResetPasswordRequest):
     if not stored_code or int(stored_code) != request.code:
         raise HTTPException(status_code=400, detail="Invalid code or user not found")
 
-    success = db.update_user_password(request.username, request.new_password)
+    success = await adb.update_user_password(request.username, request.new_password)
     if not success:
         raise HTTPException(status_code=400, detail="User not found")
 
@@ -469,24 +751,94 @@ async def reset_password_endpoint(request: ResetPasswordRequest):
     return {"msg": "Password reset successful"}
 
 
-async def createAlbum(websocket, data, username):
-    album_name = data["payload"]["album_name"]
+class CreateAlbumPayload(BaseModel):
+    album_name: str
+
 
-    result = db.createAlbum(username, album_name)
+class TargetPayload(BaseModel):
+    target: str
+
+
+class AlbumCodePayload(BaseModel):
+    albumcode: str
+
+
+class AlbumIdPayload(BaseModel):
+    album_id: int
+
+
+class GetPhotosPayload(BaseModel):
+    albumcode: str
+    limit: int = 100
+    offset: int = 0
+    sortField: str = "created_at"
+    sortOrder: str = "desc"
+    cursor: str | None = None
+
+
+class DeletePhotoPayload(BaseModel):
+    album_code: str
+    photo_id: int
+
+
+class ImportPhotosPayload(BaseModel):
+    photo_ids: list[int]
+    target_album_code: str
+
+
+class SearchPayload(BaseModel):
+    term: str
+
+
+class SetAlbumNamePayload(BaseModel):
+    albumcode: str
+    name: str
+
+
+class SetUserDataPayload(BaseModel):
+    newusername: str | None = None
+    email: str | None = None
+    password: str | None = None
+    notify_me: Literal["never", "daily", "always"] | None = None
+
+
+class RecordVisitPayload(BaseModel):
+    albumcode: str | None = None
+
+
+class KeepAlivePayload(BaseModel):
+    subjects: list[str] = []
+
+
+ws_router = wsrouter.Router(adb.getUserIdentity)
+
+
+async def album_lane(code: str | None) -> str | None:
+    """Lane of the album *code*, keyed by id like the toggles that carry one."""
+    album = await adb.getAlbumMeta(code) if code else None
+    return f"album:{album['id']}" if album else None
+
+
+@ws_router.action("createAlbum", CreateAlbumPayload)
+async def createAlbum(websocket, data, user):
+    album_name = data.payload.album_name
+
+    result = await adb.createAlbum(user, album_name)
     if not result:
         logging.error("createAlbum error")
         return
     message = {"action": "newAlbum", "payload": {"type": "update"}}
-    await redis_client.publish(f"user-{username}", json.dumps(message))
+    await redis_client.publish(f"user-{user['username']}", codec.dumps(message))
     message2 = {"action": "createAlbum", "payload": result}
-    await websocket.send_json(message2)
+    await codec.send(websocket, message2)
 
 
-async def getAlbums(websocket, data, username):
-    target = data["payload"]["target"]
-    result = db.getAlbums(target, username)
+@ws_router.action("getAlbums", TargetPayload)
+async def getAlbums(websocket, data, user):
+    target = data.payload.target
+    result = await adb.getAlbums(target, user)
     message = {"action": "getAlbums", "payload": result}
-    await websocket.send_json(message)
+    await codec.send(websocket, message)
     # Subscribe to the user's personal channel
     await manager.subscribe(websocket, f"user-{target}")
     # Subscribe to each individual album channel
@@ -495,35 +847,39 @@ async def getAlbums(websocket, data, username):
             await manager.subscribe(websocket, f"album-{album['code']}")
 
 
-async def deleteAlbum(websocket, data, username):
-    albumcode = data["payload"]["albumcode"]
-    result = await db.deleteAlbum(username, albumcode)
+@ws_router.action(
+    "deleteAlbum", AlbumCodePayload, lane=lambda p: album_lane(p.albumcode)
+)
+async def deleteAlbum(websocket, data, user):
+    albumcode = data.payload.albumcode
+    result = await adb.deleteAlbum(user, albumcode)
     message = {"action": "deleteAlbum", "payload": result}
-    await websocket.send_json(message)
+    await codec.send(websocket, message)
 
     if result == albumcode:
         message = {"action": "newAlbum", "payload": {"type": "update"}}
-        await redis_client.publish(f"user-{username}", json.dumps(message))
+        await redis_client.publish(f"user-{user['username']}", codec.dumps(message))
 
         message = {"action": "deleteAlbum", "payload": albumcode}
-        await redis_client.publish(f"album-{albumcode}", json.dumps(message))
+        await redis_client.publish(f"album-{albumcode}", codec.dumps(message))
 
 
-async def getAlbum(websocket, data, username):
-    albumcode = data["payload"]["albumcode"]
-    album = db.getAlbumWithSub(albumcode, username)
+@ws_router.action("getAlbum", AlbumCodePayload)
+async def getAlbum(websocket, data, user):
+    albumcode = data.payload.albumcode
+    album = await adb.getAlbumWithSub(albumcode, user)
     if not album:
         logging.info("getAlbum - no album found")
         message = {"action": "getAlbum", "payload": None}
-        await websocket.send_json(message)
+        await codec.send(websocket, message)
         return
     message = {"action": "getAlbum", "payload": album}
-    await websocket.send_json(message)
+    await codec.send(websocket, message)
 
     await manager.subscribe(websocket, f"album-{albumcode}")
+    username = user["username"] if user else None
     if album["private"] and album["username"] != username:
-        user_id = await get_user_id(username)
-        if user_id and db.check_user_has_photos_in_album(user_id, album["id"]):
+        if user and await adb.check_user_has_photos_in_album(user["id"], album["id"]):
             pass
         else:
             return
@@ -549,59 +905,66 @@ async def attach_presigned_urls(photos_data: dict):
     return photos_data
 
 
-async def getPhotos(websocket, data, username):
-    albumcode = data["payload"]["albumcode"]
-    limit = data["payload"].get("limit", 100)
-    offset = data["payload"].get("offset", 0)
-    sort_field = data["payload"].get("sortField", "created_at")
-    sort_order = data["payload"].get("sortOrder", "desc")
+@ws_router.action("getPhotos", GetPhotosPayload)
+async def getPhotos(websocket, data, user):
+    albumcode = data.payload.albumcode
+    limit = data.payload.limit
+    offset = data.payload.offset
+    sort_field = data.payload.sortField
+    sort_order = data.payload.sortOrder
+    # Clients that send a cursor key (null for the first page) get keyset pages
+    paginate_by_cursor = "cursor" in data.payload.model_fields_set
+    cursor = data.payload.cursor
 
-    album = db.getAlbum(albumcode)
+    album = await adb.getAlbumMeta(albumcode)
     if not album:
         logging.info("getPhotos - no album found")
         return
     user_id_filter = None
+    username = user["username"] if user else None
     if album["private"] and album["username"] != username:
-        user_id = await get_user_id(username)
-        if user_id and db.check_user_has_photos_in_album(user_id, album["id"]):
-            user_id_filter = user_id
+        if user and await adb.check_user_has_photos_in_album(user["id"], album["id"]):
+            user_id_filter = user["id"]
         else:
             logging.info("getPhotos - not allowed")
             return
 
-    photos_data = db.getPhotos(
+    photos_data = await adb.getPhotos(
         album["id"],
         limit=limit,
         offset=offset,
         sort_field=sort_field,
         sort_order=sort_order,
         user_id_filter=user_id_filter,
+        cursor=cursor,
+        paginate_by_cursor=paginate_by_cursor,
     )
 
     if photos_data:
         photos_data = await attach_presigned_urls(photos_data)
 
     message = {"action": "getPhotos", "payload": photos_data}
-    await websocket.send_json(message)
+    await codec.send(websocket, message)
 
 
-async def getDownloadList(websocket, data, username):
-    albumcode = data["payload"]["albumcode"]
+@ws_router.action("getDownloadList", AlbumCodePayload)
+async def getDownloadList(websocket, data, user):
+    albumcode = data.payload.albumcode
 
-    album = db.getAlbum(albumcode)
+    album = await adb.getAlbumMeta(albumcode)
     if not album:
         logging.info("getDownloadList - no album found")
         return
     user_id_filter = None
+    username = user["username"] if user else None
     if album["private"] and album["username"] != username:
-        user_id = await get_user_id(username)
-        if user_id and db.check_user_has_photos_in_album(user_id, album["id"]):
-            user_id_filter = user_id
+        if user and await adb.check_user_has_photos_in_album(user["id"], album["id"]):
+            user_id_filter = user["id"]
         else:
             logging.info("getDownloadList - not allowed")
             return
 
-    photos_data = db.getDownloadList(
+    photos_data = await adb.getDownloadList(
         album["id"],
         user_id_filter=user_id_filter,
     )
@@ -610,35 +973,42 @@ async def getDownloadList(websocket, data, username):
         photos_data = await attach_presigned_urls(photos_data)
 
     message = {"action": "getDownloadList", "payload": photos_data}
-    await websocket.send_json(message)
+    await codec.send(websocket, message)
 
 
-async def deletePhoto(websocket, data, username):
-    albumcode = data["payload"]["album_code"]
-    photo_id = data["payload"]["photo_id"]
-    result = await db.deletePhoto(photo_id, username)
+@ws_router.action(
+    "deletePhoto", DeletePhotoPayload, lane=lambda p: album_lane(p.album_code)
+)
+async def deletePhoto(websocket, data, user):
+    albumcode = data.payload.album_code
+    photo_id = data.payload.photo_id
+    result = await adb.deletePhoto(photo_id, user)
     if result:
         message = {
             "action": "deletePhoto",
             "payload": {"id": photo_id, "album_id": result},
         }
-        await redis_client.publish(f"album-{albumcode}", json.dumps(message))
+        await redis_client.publish(f"album-{albumcode}", codec.dumps(message))
     else:
         logging.info("not deleted %s", photo_id)
 
 
-async def importPhotos(websocket, data, username):
-    photo_ids = data["payload"]["photo_ids"]
-    target_album_code = data["payload"]["target_album_code"]
+@ws_router.action(
+    "importPhotos", ImportPhotosPayload, lane=lambda p: album_lane(p.target_album_code)
+)
+async def importPhotos(websocket, data, user):
+    photo_ids = data.payload.photo_ids
+    target_album_code = data.payload.target_album_code
 
     # Get target album id
-    target_album = db.getAlbum(target_album_code)
+    target_album = await adb.getAlbumMeta(target_album_code)
     if not target_album:
         logging.warning("importPhotos: target album %s not found", target_album_code)
         return
 
     # Verify the user has permissions to the target album here.
     # They must be the owner, or the album is open and user can upload.
+    username = user["username"] if user else None
     if target_album["username"] != username and not target_album["open"]:
         logging.warning(
             "importPhotos: User %s lacks permission to import to album %s",
@@ -647,16 +1017,21 @@ async def importPhotos(websocket, data, username):
         )
         return
 
-    result = db.importPhotos(photo_ids, target_album["id"], username)
+    result = await adb.importPhotos(photo_ids, target_album["id"], user)
     if isinstance(result, list):
         message = {"action": "importSuccess", "payload": len(result)}
-        await websocket.send_json(message)
-
-        # publish to target album so the new photos show up
-        for photo in result:
-            # mimic addPhoto output
-            msg = {"action": "addPhoto", "payload": photo}
-            await redis_client.publish(f"albumadd-{target_album_code}", json.dumps(msg))
+        await codec.send(websocket, message)
+
+        # publish to target album so the new photos show up, in one message
+        # like an upload session commit
+        if result:
+            msg = {
+                "action": "addPhotos",
+                "payload": {"album_id": target_album["id"], "photos": result},
+            }
+            await redis_client.publish(
+                f"albumadd-{target_album_code}", codec.dumps(msg)
+            )
 
         # Also update modified_at
         if len(result) > 0 and result[0].get("album_modified_at"):
@@ -668,41 +1043,49 @@ async def importPhotos(websocket, data, username):
                 },
             }
             await redis_client.publish(
-                f"album-{target_album_code}", json.dumps(mod_msg)
+                f"album-{target_album_code}", codec.dumps(mod_msg)
             )
 
 
-async def search(websocket, data, username):
-    term = data["payload"]["term"]
+@ws_router.action("search", SearchPayload)
+async def search(websocket, data, user):
+    term = data.payload.term
     logging.info("search %s", term)
-    result = db.search(term)
+    result = await adb.search(term)
     message = {"action": "search", "payload": result}
-    await websocket.send_json(message)
+    await codec.send(websocket, message)
 
 
-async def setAlbumName(websocket, data, username):
-    albumcode = data["payload"]["albumcode"]
-    name = data["payload"]["name"]
-    ok = db.setAlbumName(albumcode, name, username)
+@ws_router.action(
+    "setAlbumName", SetAlbumNamePayload, lane=lambda p: album_lane(p.albumcode)
+)
+async def setAlbumName(websocket, data, user):
+    albumcode = data.payload.albumcode
+    name = data.payload.name
+    ok = await adb.setAlbumName(albumcode, name, user)
     if ok:
         message = {
             "action": "setAlbumName",
             "payload": {"albumcode": albumcode, "name": name},
         }
-        await redis_client.publish(f"album-{albumcode}", json.dumps(message))
+        await redis_client.publish(f"album-{albumcode}", codec.dumps(message))
         message = {"action": "newAlbum", "payload": {"type": "update"}}
-        await redis_client.publish(f"user-{username}", json.dumps(message))
+        await redis_client.publish(f"user-{user['username']}", codec.dumps(message))
     else:
         logging.error("not set album name %s", albumcode)
 
 
-async def setUserData(websocket, data, username):
-    newusername = data["payload"].get("newusername")
-    email = data["payload"].get("email")
-    password = data["payload"].get("password")
-    notify_me = data["payload"].get("notify_me")
-    wssecret = data.get("wssecret")
-    ok = db.setUserData(username, newusername, email, password, notify_me=notify_me)
+@ws_router.action("setUserData", SetUserDataPayload, lane=lambda p: "account")
+async def setUserData(websocket, data, user):
+    username = user["username"] if user else None
+    newusername = data.payload.newusername
+    email = data.payload.email
+    password = data.payload.password
+    notify_me = data.payload.notify_me
+    wssecret = data.wssecret
+    ok = await adb.setUserData(
+        username, newusername, email, password, notify_me=notify_me
+    )
 
     if ok == "success":
         # Determine what the effective username is now
@@ -718,185 +1101,156 @@ async def setUserData(websocket, data, username):
                 "message": ok,
             },
         }
-        await websocket.send_json(message)
+        await codec.send(websocket, message)
         if wssecret:
             await redis_client.set(f"wssecret:{wssecret}", effective_username, ex=1200)
+            await wssession.invalidate(wssecret)
     else:
         message = {
             "action": "setUserData",
             "payload": {"email": email, "username": username, "message": ok},
         }
-        await websocket.send_json(message)
+        await codec.send(websocket, message)
         logging.error("setUserData status/error: %s for user %s", ok, username)
 
 
-async def getEmail(websocket, data, username):
-    email = db.getEmail(username)
+@ws_router.action("getEmail")
+async def getEmail(websocket, data, user):
+    email = await adb.getEmail(user["username"]) if user else None
     message = {"action": "getEmail", "payload": email}
-    await websocket.send_json(message)
+    await codec.send(websocket, message)
 
 
-async def getAccountData(websocket, data, username):
-    account_data = db.getAccountData(username)
+@ws_router.action("getAccountData")
+async def getAccountData(websocket, data, user):
+    account_data = await adb.getAccountData(user["username"]) if user else None
     if account_data:
         message = {"action": "getAccountData", "payload": account_data}
-        await websocket.send_json(message)
+        await codec.send(websocket, message)
 
 
-async def subscribe(websocket, data, username):
-    albumcode = data["payload"]["albumcode"]
-    ok = db.subscribe(username, albumcode)
+@ws_router.action("subscribe", AlbumCodePayload, lane=lambda p: album_lane(p.albumcode))
+async def subscribe(websocket, data, user):
+    albumcode = data.payload.albumcode
+    ok = await adb.subscribe(user, albumcode)
     message = {"action": "subscribe", "payload": ok}
-    await websocket.send_json(message)
+    await codec.send(websocket, message)
 
 
-async def unsubscribe(websocket, data, username):
-    albumcode = data["payload"]["albumcode"]
-    ok = db.unsubscribe(username, albumcode)
+@ws_router.action(
+    "unsubscribe", AlbumCodePayload, lane=lambda p: album_lane(p.albumcode)
+)
+async def unsubscribe(websocket, data, user):
+    albumcode = data.payload.albumcode
+    ok = await adb.unsubscribe(user, albumcode)
     message = {"action": "unsubscribe", "payload": ok}
-    await websocket.send_json(message)
+    await codec.send(websocket, message)
 
 
-async def recordVisit(websocket, data, username):
-    albumcode = data["payload"].get("albumcode")
-    if albumcode and username:
-        db.recordAlbumVisit(albumcode, username)
+@ws_router.action(
+    "recordVisit", RecordVisitPayload, lane=lambda p: album_lane(p.albumcode)
+)
+async def recordVisit(websocket, data, user):
+    albumcode = data.payload.albumcode
+    if albumcode and user:
+        await adb.recordAlbumVisit(albumcode, user)
         # Notify subscribers that the album has been "read"
         msg = {
             "action": "albumOpened",
             "payload": {
                 "code": albumcode,
-                "viewer": username,
+                "viewer": user["username"],
                 "opened_at": datetime.datetime.now().isoformat(),
             },
         }
-        await redis_client.publish(f"album-{albumcode}", json.dumps(msg))
+        await redis_client.publish(f"album-{albumcode}", codec.dumps(msg))
 
 
-async def toggleOpen(websocket, data, username):
-    album_id = data["payload"]["album_id"]
-    updated_album = db.toggleOpen(album_id, username)
+@ws_router.action("toggleOpen", AlbumIdPayload, lane=lambda p: f"album:{p.album_id}")
+async def toggleOpen(websocket, data, user):
+    album_id = data.payload.album_id
+    updated_album = await adb.toggleOpen(album_id, user)
     if updated_album:
         message = {"action": "toggleOpen", "payload": updated_album}
         await redis_client.publish(
-            f"album-{updated_album['code']}", json.dumps(message)
+            f"album-{updated_album['code']}", codec.dumps(message)
         )
 
 
-async def toggleArchive(websocket, data, username):
-    album_id = data["payload"]["album_id"]
-    updated_album = db.toggleArchive(album_id, username)
+@ws_router.action("toggleArchive", AlbumIdPayload, lane=lambda p: f"album:{p.album_id}")
+async def toggleArchive(websocket, data, user):
+    album_id = data.payload.album_id
+    updated_album = await adb.toggleArchive(album_id, user)
     if updated_album:
         message = {"action": "toggleArchive", "payload": updated_album}
-        await websocket.send_json(message)
+        await codec.send(websocket, message)
         message = {"action": "newAlbum", "payload": {"type": "update"}}
-        await redis_client.publish(f"user-{username}", json.dumps(message))
+        await redis_client.publish(f"user-{user['username']}", codec.dumps(message))
 
 
-async def toggleProfile(websocket, data, username):
-    album_id = data["payload"]["album_id"]
-    updated_album = db.toggleProfile(album_id, username)
+@ws_router.action("toggleProfile", AlbumIdPayload, lane=lambda p: f"album:{p.album_id}")
+async def toggleProfile(websocket, data, user):
+    album_id = data.payload.album_id
+    updated_album = await adb.toggleProfile(album_id, user)
     if updated_album:
         message = {"action": "toggleProfile", "payload": updated_album}
         # await redis_client.publish(
-        #     f"album-{updated_album['code']}", json.dumps(message)
+        #     f"album-{updated_album['code']}", codec.dumps(message)
         # )
-        await websocket.send_json(message)
+        await codec.send(websocket, message)
         message = {"action": "newAlbum", "payload": {"type": "update"}}
-        await redis_client.publish(f"user-{username}", json.dumps(message))
+        await redis_client.publish(f"user-{user['username']}", codec.dumps(message))
 
 
-async def togglePrivate(websocket, data, username):
-    album_id = data["payload"]["album_id"]
-    updated_album = db.togglePrivate(album_id, username)
+@ws_router.action("togglePrivate", AlbumIdPayload, lane=lambda p: f"album:{p.album_id}")
+async def togglePrivate(websocket, data, user):
+    album_id = data.payload.album_id
+    updated_album = await adb.togglePrivate(album_id, user)
     if updated_album:
         message = {"action": "togglePrivate", "payload": updated_album}
         await redis_client.publish(
-            f"album-{updated_album['code']}", json.dumps(message)
+            f"album-{updated_album['code']}", codec.dumps(message)
         )
         message = {"action": "newAlbum", "payload": {"type": "update"}}
-        await redis_client.publish(f"user-{username}", json.dumps(message))
+        await redis_client.publish(f"user-{user['username']}", codec.dumps(message))
+
+
+@ws_router.action("getAlbumsWithUserPhotos")
+async def getAlbumsWithUserPhotos(websocket, data, user):
+    result = await adb.getAlbumsWithUserPhotos(user)
+    message = {"action": "getAlbums", "payload": result}
+    await codec.send(websocket, message)
+
+
+@ws_router.action("keepAlive", KeepAlivePayload)
+async def keepAlive(websocket, data, user):
+    await manager.keep_alive(websocket, data.payload.subjects)
 
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
+    session = wssession.WsSession()
+    connection = wsrouter.Connection(ws_router, websocket)
 
     try:
         try:
             while True:
                 data = await websocket.receive_text()
                 try:
-                    payload = json.loads(data)
-                except json.JSONDecodeError:
-                    # Bad payload – let the client know and terminate
+                    payload = codec.loads(data)
+                except codec.JSONDecodeError:
+                    payload = None
+                if not isinstance(payload, dict):
+                    # Bad payload – let the client know and carry on
                     logging.error("websocket - bad message")
-                    await websocket.close(code=1008)
-                    return
-
-                username = None
-                wssecret = payload.get("wssecret")
-                if wssecret:
-                    username = await redis_client.get(f"wssecret:{wssecret}")
-
-                logging.info("%s %s", username, payload)
-
-                action = payload.get("action")
-                if action == "createAlbum":
-                    await createAlbum(websocket, payload, username)
-                elif action == "getAlbums":
-                    await getAlbums(websocket, payload, username)
-                elif action == "deleteAlbum":
-                    await deleteAlbum(websocket, payload, username)
-                elif action == "getPhotos":
-                    await getPhotos(websocket, payload, username)
-                elif action == "getDownloadList":
-                    await getDownloadList(websocket, payload, username)
-                elif action == "getAlbum":
-                    await getAlbum(websocket, payload, username)
-                elif action == "deletePhoto":
-                    await deletePhoto(websocket, payload, username)
-                elif action == "importPhotos":
-                    await importPhotos(websocket, payload, username)
-                elif action == "search":
-                    await search(websocket, payload, username)
-                elif action == "setAlbumName":
-                    await setAlbumName(websocket, payload, username)
-                elif action == "setUserData":
-                    await setUserData(websocket, payload, username)
-                elif action == "getEmail":
-                    await getEmail(websocket, payload, username)
-                # elif action == "getUsage":
-                #     await getUsage(websocket, payload, username)
-                # elif action == "getUserInfo":
-                #     await getUserInfo(websocket, payload, username)
-                elif action == "getAccountData":
-                    await getAccountData(websocket, payload, username)
-                elif action == "subscribe":
-                    await subscribe(websocket, payload, username)
-                elif action == "unsubscribe":
-                    await unsubscribe(websocket, payload, username)
-                elif action == "toggleArchive":
-                    await toggleArchive(websocket, payload, username)
-                elif action == "recordVisit":
-                    await recordVisit(websocket, payload, username)
-                elif action == "getAlbumsWithUserPhotos":
-                    result = db.getAlbumsWithUserPhotos(username)
-                    message = {"action": "getAlbums", "payload": result}
-                    await websocket.send_json(message)
-                elif action == "toggleOpen":
-                    await toggleOpen(websocket, payload, username)
-                elif action == "toggleProfile":
-                    await toggleProfile(websocket, payload, username)
-                elif action == "togglePrivate":
-                    await togglePrivate(websocket, payload, username)
-                elif action == "keepAlive":
-                    subjects = payload.get("payload", {}).get("subjects", [])
-                    await manager.keep_alive(websocket, subjects)
-                else:
-                    logging.error("websocket - unknown action")
-                    await websocket.close(code=1008)
-                    return
+                    await wsrouter.send_error(websocket, None, "invalid_message")
+                    continue
+
+                username = await session.resolve(payload.get("wssecret"))
+                logging.debug("%s %s", username, payload.get("action"))
+
+                await connection.submit(payload, username)
 
         # Handle normal client disconnects cleanly
         except WebSocketDisconnect as e:
@@ -908,6 +1262,7 @@ async def websocket_endpoint(websocket: WebSocket):
             except Exception:
                 pass
     finally:
+        await connection.drain()
         await manager.unsubscribe(websocket)
 
 
@@ -934,12 +1289,30 @@ async def serve_spa(request: Request, full_path: str):
 # 1️⃣ Serve the Vite build under “/” (but don’t use html=True)
 @app.on_event("startup")
 async def startup():
+    # Schema setup runs once through the synchronous layer, then the request
+    # path switches to the asyncpg pool.
     db.init_pool()
     db.init_db()
+    db.close_pool()
+    await adb.init_pool()
     # create pool for arq workers
     if "amazon" in env.REDIS_URL2_DSN:
         redis_settings = RedisSettings.from_dsn(env.REDIS_URL2_DSN)
     else:
         redis_settings = RedisSettings(env.REDIS_URL2_DSN)
     app.state.redis = await create_pool(redis_settings)
+    # Pub/sub listeners that keep this process's caches in step with the others
+    app.state.listeners = [
+        asyncio.create_task(wssession.listen_invalidations()),
+        asyncio.create_task(adb.album_cache.listen()),
+        asyncio.create_task(adb.user_cache.listen()),
+    ]
     # app.state.redis = await create_pool(RedisSettings(host=env.REDIS_URL2, port=6379))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in app.state.listeners:
+        task.cancel()
+    await manager.close()
+    await adb.close_pool()
@@ -1,9 +1,16 @@
+import asyncio
 import base64
 import datetime
+import functools
+import hashlib
+import hmac
 import json
 import logging
 import os
+import threading
 import time
+from contextlib import AsyncExitStack
+from urllib.parse import quote, urlsplit
 
 import boto3
 import env
@@ -11,6 +18,11 @@ import requests
 from botocore.config import Config
 from botocore.exceptions import ClientError
 
+try:
+    from aiobotocore.session import get_session as get_aio_session
+except ImportError:  # optional; the async helpers fall back to worker threads
+    get_aio_session = None
+
 # Removed CloudFront and Cryptography imports as they are no longer needed for R2
 
 
@@ -19,16 +31,154 @@ from botocore.exceptions import ClientError
 BUCKET_NAME = env.R2_BUCKET_NAME
 
 
-def get_s3_client():
-    """Helper for Cloudflare R2"""
-    return boto3.client(
-        "s3",
+# One client per process: boto3 clients are thread-safe once built, and
+# sharing one keeps its HTTP connections alive between calls.
+S3_MAX_POOL_CONNECTIONS = getattr(env, "S3_MAX_POOL_CONNECTIONS", 50)
+S3_MAX_ATTEMPTS = getattr(env, "S3_MAX_ATTEMPTS", 5)
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+_async_s3_client = None
+_async_s3_stack = None
+
+
+def _s3_client_kwargs():
+    return dict(
         endpoint_url=env.R2_ENDPOINT_URL,
         aws_access_key_id=env.R2_ACCESS_KEY_ID,
         aws_secret_access_key=env.R2_SECRET_ACCESS_KEY,
         region_name="auto",
-        config=Config(signature_version="s3v4"),
+        config=Config(
+            signature_version="s3v4",
+            max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+            retries={"max_attempts": S3_MAX_ATTEMPTS, "mode": "standard"},
+            connect_timeout=5,
+            read_timeout=30,
+            tcp_keepalive=True,
+        ),
+    )
+
+
+def get_s3_client():
+    """Helper for Cloudflare R2; returns the shared client, creating it once."""
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                # A private session: the boto3 default session is not thread-safe
+                _s3_client = boto3.session.Session().client("s3", **_s3_client_kwargs())
+    return _s3_client
+
+
+async def open_async_s3_client():
+    """Open the shared aiobotocore client, if aiobotocore is installed."""
+    global _async_s3_client, _async_s3_stack
+    if get_aio_session is None or _async_s3_client is not None:
+        return
+    stack = AsyncExitStack()
+    _async_s3_client = await stack.enter_async_context(
+        get_aio_session().create_client("s3", **_s3_client_kwargs())
+    )
+    _async_s3_stack = stack
+
+
+async def close_async_s3_client():
+    global _async_s3_client, _async_s3_stack
+    if _async_s3_stack is not None:
+        await _async_s3_stack.aclose()
+    _async_s3_client = None
+    _async_s3_stack = None
+
+
+class TokenBucket:
+    """Paces S3 requests to *rate* per second on average.
+
+    Up to *burst* requests may go at once after a quiet spell; a rate of 0
+    disables the limit.  Waiters are served in arrival order.
+    """
+
+    def __init__(self, rate: float, burst: int | None = None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if not self.rate:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# --------------------------------------------------------------------------- #
+# SigV4 query-string presigning without botocore's request pipeline.
+# Produces the same path-style URLs as generate_presigned_url on the client
+# above, with the derived signing key cached per day.
+# --------------------------------------------------------------------------- #
+
+R2_REGION = "auto"
+_endpoint = urlsplit(env.R2_ENDPOINT_URL)
+_endpoint_host = _endpoint.netloc
+if (_endpoint.scheme, _endpoint.port) in (("https", 443), ("http", 80)):
+    _endpoint_host = _endpoint.hostname
+
+
+@functools.lru_cache(maxsize=4)
+def _signing_key(date_stamp, region=R2_REGION, service="s3"):
+    key = ("AWS4" + env.R2_SECRET_ACCESS_KEY).encode()
+    for part in (date_stamp, region, service, "aws4_request"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    return key
+
+
+def presign_url(
+    object_name, method="PUT", expiration=3600, now=None, content_length=None
+):
+    """
+    Presigned URL for a single object, e.g. a browser PUT upload.
+    :param now: signing time (UTC); defaults to the current time
+    :param content_length: if given, signed in, so a PUT of any other size
+        is rejected by the bucket
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    date_stamp = amz_date[:8]
+    scope = f"{date_stamp}/{R2_REGION}/s3/aws4_request"
+
+    path = quote(f"{_endpoint.path.rstrip('/')}/{BUCKET_NAME}/{object_name}", safe="/~")
+    query = (
+        "X-Amz-Algorithm=AWS4-HMAC-SHA256"
+        f"&X-Amz-Credential={quote(f'{env.R2_ACCESS_KEY_ID}/{scope}', safe='-_.~')}"
+        f"&X-Amz-Date={amz_date}"
+        f"&X-Amz-Expires={int(expiration)}"
+    )
+    headers = f"host:{_endpoint_host}\n"
+    signed_headers = "host"
+    if content_length is not None:
+        headers = f"content-length:{int(content_length)}\n" + headers
+        signed_headers = "content-length;host"
+    query += f"&X-Amz-SignedHeaders={quote(signed_headers, safe='')}"
+    canonical_request = (
+        f"{method}\n{path}\n{query}\n{headers}\n{signed_headers}\nUNSIGNED-PAYLOAD"
+    )
+    string_to_sign = (
+        f"AWS4-HMAC-SHA256\n{amz_date}\n{scope}\n"
+        + hashlib.sha256(canonical_request.encode()).hexdigest()
     )
+    signature = hmac.new(
+        _signing_key(date_stamp), string_to_sign.encode(), hashlib.sha256
+    ).hexdigest()
+    return f"{_endpoint.scheme}://{_endpoint.netloc}{path}?{query}&X-Amz-Signature={signature}"
 
 
 def upload_bytes_to_s3(bytes_data, object_name):
@@ -50,7 +200,6 @@ def create_presigned_url(object_name, expiration=86400):
         return None
     return f"https://media.shareshot.eu/{object_name}"
 
-    
     s3_client = get_s3_client()
     try:
         response = s3_client.generate_presigned_url(
@@ -124,6 +273,154 @@ def delete_files_from_s3(keys):
         return False
 
 
+async def s3size_async(key):
+    """s3size for the event loop; runs in a thread without aiobotocore."""
+    if _async_s3_client is None:
+        return await asyncio.to_thread(s3size, key)
+    if key is None:
+        return 0
+    try:
+        response = await _async_s3_client.head_object(Bucket=BUCKET_NAME, Key=key)
+        return response.get("ContentLength", 0)
+    except ClientError as e:
+        logging.error("Error getting s3 size for %s: %s", key, e)
+        return 0
+
+
+async def delete_file_from_s3_async(object_name):
+    if _async_s3_client is None:
+        return await asyncio.to_thread(delete_file_from_s3, object_name)
+    if object_name is None:
+        return False
+    try:
+        await _async_s3_client.delete_object(Bucket=BUCKET_NAME, Key=object_name)
+        logging.info("Deleted %s from S3 bucket %s", object_name, BUCKET_NAME)
+    except ClientError as e:
+        logging.error("Error deleting file: %s", e)
+        return False
+    return True
+
+
+async def delete_files_from_s3_async(keys):
+    """Delete *keys* with bulk_delete; True if every key went."""
+    result = await bulk_delete(keys)
+    return result["failed"] == 0
+
+
+# Keys per DeleteObjects request (the API maximum), requests in flight at
+# once per deleter, and attempts for keys a response lists under Errors
+DELETE_BATCH_SIZE = 1000
+DELETE_CONCURRENCY = getattr(env, "S3_DELETE_CONCURRENCY", 4)
+DELETE_MAX_ATTEMPTS = getattr(env, "S3_DELETE_MAX_ATTEMPTS", 3)
+
+
+async def _delete_objects(keys: list[str]) -> list[dict]:
+    """One quiet DeleteObjects request; returns the per-key Errors."""
+    delete = {"Objects": [{"Key": key} for key in keys], "Quiet": True}
+    if _async_s3_client is None:
+        response = await asyncio.to_thread(
+            get_s3_client().delete_objects, Bucket=BUCKET_NAME, Delete=delete
+        )
+    else:
+        response = await _async_s3_client.delete_objects(
+            Bucket=BUCKET_NAME, Delete=delete
+        )
+    return response.get("Errors", [])
+
+
+class BulkDeleter:
+    """Deletes keys from the bucket in full DeleteObjects requests.
+
+    add() buffers keys and sends every DELETE_BATCH_SIZE of them as one
+    request, with up to *concurrency* requests in flight; add() waits for
+    a free slot, so a producer cannot run ahead of the deletes.  Keys a
+    response reports under Errors are retried on their own, with backoff,
+    up to DELETE_MAX_ATTEMPTS times.  A request that fails outright has
+    already been retried by the client and counts all its keys as failed.
+    drain() sends the rest and waits for them; close() drains and returns
+    the deleted/failed counts.
+    """
+
+    def __init__(self, concurrency: int = DELETE_CONCURRENCY):
+        self._slots = asyncio.Semaphore(concurrency)
+        self._buffer: list[str] = []
+        self._tasks: set[asyncio.Task] = set()
+        self.requests = 0
+        self.deleted = 0
+        self.failed_keys: list[str] = []
+
+    async def add(self, key: str | None) -> None:
+        if not key:
+            return
+        self._buffer.append(key)
+        if len(self._buffer) >= DELETE_BATCH_SIZE:
+            await self._flush()
+
+    async def _flush(self) -> None:
+        batch, self._buffer = self._buffer, []
+        await self._slots.acquire()
+        task = asyncio.create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, keys: list[str]) -> None:
+        try:
+            for attempt in range(1, DELETE_MAX_ATTEMPTS + 1):
+                self.requests += 1
+                try:
+                    errors = await _delete_objects(keys)
+                except Exception as e:
+                    logging.error("Error deleting %s files: %s", len(keys), e)
+                    self.failed_keys.extend(keys)
+                    return
+                self.deleted += len(keys) - len(errors)
+                if not errors:
+                    return
+                keys = [error["Key"] for error in errors]
+                if attempt < DELETE_MAX_ATTEMPTS:
+                    logging.info(
+                        "Retrying %s keys, e.g. %s: %s",
+                        len(keys),
+                        keys[0],
+                        errors[0].get("Code"),
+                    )
+                    # Back off without holding up other requests
+                    self._slots.release()
+                    try:
+                        await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+                    finally:
+                        await self._slots.acquire()
+            logging.error("Could not delete %s keys: %s", len(keys), errors[:5])
+            self.failed_keys.extend(keys)
+        finally:
+            self._slots.release()
+
+    async def drain(self) -> None:
+        """Send the buffered keys and wait until every request has finished."""
+        if self._buffer:
+            await self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    async def close(self) -> dict:
+        await self.drain()
+        return {
+            "deleted": self.deleted,
+            "failed": len(self.failed_keys),
+            "requests": self.requests,
+        }
+
+
+async def bulk_delete(keys) -> dict:
+    """Delete every key in *keys* with one BulkDeleter; see its counts."""
+    deleter = BulkDeleter()
+    for key in keys:
+        await deleter.add(key)
+    result = await deleter.close()
+    result["failed_keys"] = deleter.failed_keys
+    return result
+
+
 def get_bucket_usage():
     """
     Fetch the total bucket usage from Cloudflare R2 API.
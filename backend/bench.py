@@ -0,0 +1,869 @@
+"""Performance checks against a throwaway copy of the schema.
+
+Run from the backend directory with env.py pointing at a development
+database:
+
+    python bench.py explain        # report hot queries still using a Seq Scan
+    python bench.py albums         # getAlbums latency vs. number of albums
+    python bench.py s3             # presign/HEAD throughput against env.R2_*
+    python bench.py presign        # local SigV4 signer vs. botocore, per URL
+    python bench.py watcher        # pub/sub fan-out load test against env.REDIS_URL
+    python bench.py encode         # getPhotos payload for 5,000 photos, json vs. orjson
+    python bench.py import         # importPhotos of 10/1,000/10,000 photos, loop vs. set-based
+
+Everything happens inside a scratch ``bench`` schema that is created from
+db.init_db and dropped afterwards, so application tables are never touched.
+"""
+
+import asyncio
+import datetime
+import json
+import logging
+import random
+import statistics
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import adb
+import aws
+import boto3
+import botocore.auth
+import codec
+import db
+import env
+import psycopg2
+import watcher
+from botocore.config import Config
+
+SCHEMA = "bench"
+
+# --------------------------------------------------------------------------- #
+# Scratch schema helpers
+# --------------------------------------------------------------------------- #
+
+
+def _admin_connection():
+    conn = psycopg2.connect(
+        host=env.DB_HOST,
+        port=env.DB_PORT,
+        dbname=env.DB_NAME,
+        user=env.DB_USER,
+        password=env.DB_PASSWORD,
+    )
+    conn.autocommit = True
+    return conn
+
+
+def create_schema() -> None:
+    """Recreate the scratch schema and build the application tables in it."""
+    with _admin_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+            cursor.execute(f"CREATE SCHEMA {SCHEMA}")
+    db.init_pool(options=f"-c search_path={SCHEMA}")
+    db.init_db()
+
+
+def drop_schema() -> None:
+    db.close_pool()
+    with _admin_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+
+
+def seed(users: int = 200, albums: int = 2000, photos: int = 50000) -> None:
+    """Fill the scratch schema with a dataset shaped like production."""
+    with db.get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO users (username, email, passhash, salt)
+                SELECT 'user' || g, 'user' || g || '@example.com', 'x', 'x'
+                FROM generate_series(1, %s) g;
+
+                INSERT INTO albums (code, name, user_id, private, modified_at)
+                SELECT md5('album' || g), 'Album ' || g,
+                       (SELECT id FROM users ORDER BY id OFFSET (g %% %s) LIMIT 1),
+                       g %% 10 = 0,
+                       NOW() - (g || ' minutes')::interval
+                FROM generate_series(1, %s) g;
+
+                INSERT INTO subscription (user_id, album_id, profile)
+                SELECT user_id, id, id %% 3 = 0 FROM albums;
+
+                INSERT INTO subscription (user_id, album_id)
+                SELECT u.id, a.id
+                FROM albums a
+                JOIN users u ON u.id = (SELECT MIN(id) FROM users) + a.id %% 7
+                ON CONFLICT DO NOTHING;
+
+                INSERT INTO photos (user_id, album_id, s3_key, thumb_key, mid_key,
+                                    filename, size, thumb_size, mid_size, created_at)
+                SELECT a.user_id + (g %% 3),
+                       a.id,
+                       a.code || '/' || md5(g::text),
+                       a.code || '/thumb_' || md5(g::text),
+                       a.code || '/mid_' || md5(g::text),
+                       'IMG_' || g || '.jpg',
+                       CASE WHEN g %% 50 = 0 THEN NULL ELSE 2000000 + g END,
+                       20000, 200000,
+                       NOW() - (g || ' seconds')::interval
+                FROM generate_series(1, %s) g
+                JOIN albums a ON a.id = (SELECT MIN(id) FROM albums) + g %% %s
+                WHERE a.user_id + (g %% 3) IN (SELECT id FROM users);
+
+                UPDATE photos SET deleted_at = NOW() - interval '2 days', count = 0,
+                                  album_id = NULL
+                WHERE id %% 97 = 0;
+
+                INSERT INTO blobs (s3_key, thumb_key, mid_key, size, refcount,
+                                   released_at)
+                SELECT s3_key, thumb_key, mid_key, size,
+                       CASE WHEN deleted_at IS NULL THEN 1 ELSE 0 END, deleted_at
+                FROM photos;
+                UPDATE photos p SET blob_id = b.id FROM blobs b
+                WHERE b.s3_key = p.s3_key;
+
+                UPDATE albums a
+                SET photo_count = (
+                        SELECT COUNT(*) FROM photos p WHERE p.album_id = a.id
+                    ),
+                    cover_thumb_key = (
+                        SELECT p.thumb_key FROM photos p
+                        WHERE p.album_id = a.id AND p.thumb_key IS NOT NULL
+                        ORDER BY p.created_at DESC LIMIT 1
+                    );
+
+                ANALYZE;
+                """,
+                (users, users, albums, photos, albums),
+            )
+            conn.commit()
+
+
+async def init_adb(**kwargs) -> None:
+    await adb.init_pool(server_settings={"search_path": SCHEMA}, **kwargs)
+
+    # Jobs would be enqueued on the real worker queue; keep the bench local.
+    async def no_enqueue(*args, **kwargs):
+        return None
+
+    adb.enqueue_cleanup_deleted_photos = no_enqueue
+    adb.enqueue_delete_keys = no_enqueue
+
+
+# --------------------------------------------------------------------------- #
+# explain: make sure every hot query can be served by an index
+# --------------------------------------------------------------------------- #
+
+
+async def _request_path_scenario() -> None:
+    """Call each request-path function in adb once, as the app would."""
+    async with adb.get_db_connection() as conn:
+        owner, other = await conn.fetchval(
+            "SELECT ARRAY[MIN(username), MAX(username)] FROM users"
+        )
+        code = await conn.fetchval(
+            "SELECT code FROM albums a JOIN users u ON a.user_id = u.id "
+            "WHERE u.username = $1 LIMIT 1",
+            owner,
+        )
+        photo_ids = [
+            r[0]
+            for r in await conn.fetch(
+                "SELECT id FROM photos WHERE album_id IS NOT NULL LIMIT 5"
+            )
+        ]
+
+    album = await adb.getAlbum(code)
+    album_id = album["id"]
+    await adb.user_cache.invalidate(owner, other)
+    other_id = await adb.get_user_id(other)
+    await adb.getUserIdentity(owner)
+
+    await adb.check_password(owner, "x")
+    # Seeded codes repeat between runs; make sure the lookup reaches the database
+    await adb.album_cache.invalidate(code)
+    await adb.getAlbumMeta(code)
+    await adb.get_upload_context(other, code)
+    await adb.getAlbumWithSub(code, other)
+    for field in ("created_at", "filename", "username", "size"):
+        for order in ("asc", "desc"):
+            await adb.getPhotos(album_id, 100, 0, field, order)
+            page = await adb.getPhotos(
+                album_id, 100, 0, field, order, paginate_by_cursor=True
+            )
+            await adb.getPhotos(
+                album_id,
+                100,
+                0,
+                field,
+                order,
+                cursor=page["next_cursor"],
+                paginate_by_cursor=True,
+            )
+    await adb.getPhotos(album_id, 100, 0, user_id_filter=other_id)
+    await adb.check_user_has_photos_in_album(other_id, album_id)
+    await adb.getDownloadList(album_id)
+    await adb.getDownloadList(album_id, user_id_filter=other_id)
+    await adb.getAlbums(owner, owner)
+    await adb.getAlbums(owner, other)
+    await adb.getAlbumsWithUserPhotos(other)
+    await adb.getAccountData(owner)
+    await adb.getEmail(owner)
+    await adb.search(code)
+    await adb.recordAlbumVisit(code, owner)
+    await adb.subscribe(other, code)
+    await adb.unsubscribe(other, code)
+    await adb.toggleOpen(album_id, owner)
+    await adb.togglePrivate(album_id, owner)
+    await adb.toggleProfile(album_id, owner)
+    await adb.toggleArchive(album_id, owner)
+    await adb.setAlbumName(code, "renamed", owner)
+    await adb.getStripeCustomerId(owner)
+    await adb.updateUserPlan("cus_missing", "free")
+
+    photo = await adb.addPhoto(
+        {
+            "user_id": other_id,
+            "album_id": album_id,
+            "filename": "bench.jpg",
+            "s3_key": f"{code}/bench",
+            "thumb_key": f"{code}/thumb_bench",
+            "mid_key": f"{code}/mid_bench",
+        }
+    )
+    await adb.updatePhotoSizes(photo["id"], 1000, 10, 100)
+    await adb.addPhotos(
+        other_id,
+        album_id,
+        other,
+        [{"filename": f"batch{i}.jpg", "s3_key": f"{code}/batch{i}"} for i in range(3)],
+    )
+    new_code = await adb.createAlbum(other, "bench import")
+    new_album = await adb.getAlbum(new_code)
+    await adb.importPhotos(photo_ids, new_album["id"], other)
+    await adb.deletePhoto(photo["id"], other)
+    await adb.deleteAlbum(other, new_code)
+    await adb.uncountedPhotos(0, 500)
+    await adb.claim_released_blobs(0)
+    # The reconciler's first batch of byte-ordered keys from each column
+    for column in adb._BLOB_KEY_COLUMNS:
+        await anext(adb._known_keys(column, ""), None)
+    await adb.albumCoversMissing()
+    # totalSpaceUsed is left out: it is an admin report that sums whole tables.
+
+
+def _seq_scans(plan: dict) -> list[str]:
+    found = []
+    if plan.get("Node Type") == "Seq Scan":
+        found.append(plan.get("Relation Name", "?"))
+    for child in plan.get("Plans", []):
+        found.extend(_seq_scans(child))
+    return found
+
+
+async def explain() -> int:
+    """Log every statement the request path issues and EXPLAIN each one.
+
+    Sequential scans are disabled for the EXPLAIN session, so the planner only
+    falls back to one when no index can answer the query at all.
+    """
+    logged: dict[str, tuple] = {}
+
+    def record(query):
+        # Skip asyncpg's own multi-statement connection reset.
+        if ";" not in query.query.strip().rstrip(";"):
+            logged.setdefault(query.query, query.args)
+
+    async def log_queries(conn):
+        conn.add_query_logger(record)
+
+    await init_adb(init=log_queries)
+    await _request_path_scenario()
+    await adb.close_pool()
+    await init_adb()
+
+    offenders = 0
+    async with adb.get_db_connection() as conn:
+        await conn.execute("SET enable_seqscan = off")
+        for query, args in logged.items():
+            head = query.lstrip().split(None, 1)[0].upper()
+            if head not in ("SELECT", "WITH", "UPDATE", "DELETE", "INSERT"):
+                continue
+            plan = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {query}", *args)
+            tables = _seq_scans(json.loads(plan)[0]["Plan"])
+            if tables:
+                offenders += 1
+                print(f"SEQ SCAN on {', '.join(sorted(set(tables)))}:")
+                print("    " + " ".join(query.split())[:300])
+    await adb.close_pool()
+
+    print(f"{len(logged)} statements checked, {offenders} with sequential scans")
+    return offenders
+
+
+# --------------------------------------------------------------------------- #
+# albums: getAlbums latency as a profile grows
+# --------------------------------------------------------------------------- #
+
+
+async def _median_ms(fn, repeat: int = 30) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+async def _get_albums_per_album_check(username: str, authuser: str) -> int:
+    """The pre-batching getAlbums shape: one contributor query per album."""
+    profile_id = await adb.get_user_id(username)
+    auth_id = await adb.get_user_id(authuser)
+    async with adb.get_db_connection() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT a.id, a.user_id
+            FROM albums a
+            JOIN subscription s ON a.id = s.album_id AND s.user_id = $1
+            WHERE COALESCE(s.archive, FALSE) = FALSE
+            ORDER BY a.modified_at DESC
+            """,
+            profile_id,
+        )
+    visible = 0
+    for album_id, owner_id in rows:
+        if owner_id == auth_id or await adb.check_user_has_photos_in_album(
+            auth_id, album_id
+        ):
+            visible += 1
+    return visible
+
+
+async def albums() -> int:
+    """Time getAlbums for a visitor against profiles of increasing size."""
+    await init_adb()
+    await adb.setUser("bench_owner", "owner@example.com", "x")
+    await adb.setUser("bench_viewer", "viewer@example.com", "x")
+    owner_id = await adb.get_user_id("bench_owner")
+    viewer_id = await adb.get_user_id("bench_viewer")
+
+    created = 0
+    print(f"{'albums':>8} {'per-album ms':>14} {'batched ms':>12} {'speedup':>8}")
+    for count in (10, 50, 100, 300, 1000):
+        async with adb.get_db_connection() as conn:
+            # Grow the profile to `count` albums; the viewer contributed to
+            # every third one, none of them are on the public profile.
+            await conn.execute(
+                """
+                WITH new AS (
+                    INSERT INTO albums (code, name, user_id)
+                    SELECT md5('bench' || g), 'Bench ' || g, $1
+                    FROM generate_series($2::int + 1, $3::int) g
+                    RETURNING id
+                ), subs AS (
+                    INSERT INTO subscription (user_id, album_id, profile)
+                    SELECT $1, id, FALSE FROM new
+                )
+                INSERT INTO photos (user_id, album_id, filename, s3_key)
+                SELECT $4, id, 'viewer.jpg', 'bench/' || id
+                FROM new WHERE id % 3 = 0
+                """,
+                owner_id,
+                created,
+                count,
+                viewer_id,
+            )
+            await conn.execute("ANALYZE")
+        created = count
+
+        before = await _median_ms(
+            lambda: _get_albums_per_album_check("bench_owner", "bench_viewer")
+        )
+        after = await _median_ms(lambda: adb.getAlbums("bench_owner", "bench_viewer"))
+        print(f"{count:>8} {before:>14.2f} {after:>12.2f} {before / after:>7.1f}x")
+
+    await adb.close_pool()
+    return 0
+
+
+# --------------------------------------------------------------------------- #
+# s3: presign and HEAD throughput, fresh client per call vs. shared client
+# --------------------------------------------------------------------------- #
+
+
+def _fresh_s3_client():
+    """How aws.get_s3_client used to behave: a new client on every call."""
+    return boto3.client(
+        "s3",
+        endpoint_url=env.R2_ENDPOINT_URL,
+        aws_access_key_id=env.R2_ACCESS_KEY_ID,
+        aws_secret_access_key=env.R2_SECRET_ACCESS_KEY,
+        region_name="auto",
+        config=Config(signature_version="s3v4"),
+    )
+
+
+def _ops_per_second(fn, items, threads: int = 1) -> float:
+    start = time.perf_counter()
+    if threads == 1:
+        for item in items:
+            fn(item)
+    else:
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(fn, items))
+    return len(items) / (time.perf_counter() - start)
+
+
+def _presign_with(client_factory):
+    def presign(key):
+        return client_factory().generate_presigned_url(
+            "put_object", Params={"Bucket": aws.BUCKET_NAME, "Key": key}, ExpiresIn=600
+        )
+
+    return presign
+
+
+def _head_with(client_factory):
+    def head(key):
+        return client_factory().head_object(Bucket=aws.BUCKET_NAME, Key=key)
+
+    return head
+
+
+async def s3() -> int:
+    """Point env.R2_* at a local S3 stand-in (moto_server, minio) to run this."""
+    keys = [f"bench/{i:05d}" for i in range(200)]
+    client = aws.get_s3_client()
+    for key in keys:
+        client.put_object(Bucket=aws.BUCKET_NAME, Key=key, Body=b"x" * 1024)
+
+    presign_keys = [f"bench/presign/{i}" for i in range(2000)]
+    results = [
+        (
+            "presign, fresh client",
+            _presign_with(_fresh_s3_client),
+            presign_keys[:200],
+            1,
+        ),
+        ("presign, shared client", _presign_with(aws.get_s3_client), presign_keys, 1),
+        ("HEAD x16 threads, fresh client", _head_with(_fresh_s3_client), keys, 16),
+        ("HEAD x16 threads, shared client", _head_with(aws.get_s3_client), keys, 16),
+    ]
+    print(f"{'operation':<36} {'ops/s':>10}")
+    for label, fn, items, threads in results:
+        rate = await asyncio.to_thread(_ops_per_second, fn, items, threads)
+        print(f"{label:<36} {rate:>10.0f}")
+
+    await aws.open_async_s3_client()
+    if aws.get_aio_session is not None:
+        limit = asyncio.Semaphore(16)
+
+        async def head(key):
+            async with limit:
+                await aws.s3size_async(key)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(head(key) for key in keys))
+        rate = len(keys) / (time.perf_counter() - start)
+        print(f"{'HEAD x16 async, aiobotocore client':<36} {rate:>10.0f}")
+    await aws.close_async_s3_client()
+
+    aws.delete_files_from_s3(keys)
+    return 0
+
+
+# --------------------------------------------------------------------------- #
+# presign: local SigV4 signer vs. botocore, per URL
+# --------------------------------------------------------------------------- #
+
+
+async def presign() -> int:
+    """Compare per-URL presign cost and check both produce the same URL."""
+    client = aws.get_s3_client()
+    keys = [f"bench/{uuid.uuid4().hex}" for _ in range(5000)]
+
+    def with_boto3(key):
+        return client.generate_presigned_url(
+            "put_object", Params={"Bucket": aws.BUCKET_NAME, "Key": key}, ExpiresIn=3600
+        )
+
+    def with_signer(key):
+        return aws.presign_url(key, "PUT", 3600)
+
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    with mock.patch.object(
+        botocore.auth, "get_current_datetime", return_value=now.replace(tzinfo=None)
+    ):
+        mismatches = sum(
+            with_boto3(key) != aws.presign_url(key, "PUT", 3600, now=now)
+            for key in keys[:500]
+        )
+        # Uploads with a declared size sign their Content-Length too
+        mismatches += sum(
+            client.generate_presigned_url(
+                "put_object",
+                Params={"Bucket": aws.BUCKET_NAME, "Key": key, "ContentLength": n},
+                ExpiresIn=3600,
+            )
+            != aws.presign_url(key, "PUT", 3600, now=now, content_length=n)
+            for n, key in enumerate(keys[:500])
+        )
+
+    print(f"{'signer':<10} {'us/URL':>8}")
+    timings = {}
+    for label, fn in (("boto3", with_boto3), ("local", with_signer)):
+        rate = _ops_per_second(fn, keys)
+        timings[label] = 1e6 / rate
+        print(f"{label:<10} {timings[label]:>8.1f}")
+    print(
+        f"speedup {timings['boto3'] / timings['local']:.1f}x, {mismatches} mismatches"
+    )
+    return mismatches
+
+
+# --------------------------------------------------------------------------- #
+# import: importPhotos, the old per-photo loop vs. the set-based statements
+# --------------------------------------------------------------------------- #
+
+
+async def _import_photos_loop(photo_ids: list, album_id: int, user_id: int) -> list:
+    """The per-photo importPhotos this replaced: four statements per photo."""
+    rows = []
+    async with adb.get_db_connection() as conn:
+        async with conn.transaction():
+            for pid in photo_ids:
+                src = await conn.fetchrow(
+                    "SELECT s3_key, thumb_key, mid_key, filename, size, thumb_size, "
+                    "mid_size FROM photos WHERE id = $1",
+                    pid,
+                )
+                rows.append(
+                    await conn.fetchrow(
+                        "INSERT INTO photos (user_id, album_id, s3_key, thumb_key, "
+                        "mid_key, filename, size, thumb_size, mid_size) "
+                        "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9) RETURNING *",
+                        user_id,
+                        album_id,
+                        *src,
+                    )
+                )
+                await conn.execute(
+                    "UPDATE photos SET count = count + 1 WHERE s3_key = $1", src[0]
+                )
+                await conn.execute(
+                    "UPDATE albums SET modified_at = CURRENT_TIMESTAMP, "
+                    "photo_count = photo_count + 1, "
+                    "cover_thumb_key = COALESCE($2, cover_thumb_key) "
+                    "WHERE id = $1",
+                    album_id,
+                    src[1],
+                )
+    return rows
+
+
+async def import_photos(sizes: tuple = (10, 1000, 10000)) -> int:
+    """Time importPhotos and its addPhoto(s) broadcast for growing imports."""
+    await init_adb()
+    await adb.setUser("bench_import", "import@example.com", "x")
+    user = await adb.getUserIdentity("bench_import")
+    async with adb.get_db_connection() as conn:
+        source_id = await conn.fetchval(
+            """
+            INSERT INTO albums (code, name, user_id)
+            VALUES (md5('bench_import'), 'Bench import', $1)
+            RETURNING id
+            """,
+            user["id"],
+        )
+        photo_ids = [
+            r[0]
+            for r in await conn.fetch(
+                """
+                INSERT INTO photos (user_id, album_id, s3_key, thumb_key, mid_key,
+                                    filename, size, thumb_size, mid_size)
+                SELECT $1, $2, 'imp/' || md5(g::text), 'imp/thumb_' || md5(g::text),
+                       'imp/mid_' || md5(g::text), 'IMG_' || g || '.jpg',
+                       2000000 + g, 40000, 400000
+                FROM generate_series(1, $3::int) g
+                RETURNING id
+                """,
+                user["id"],
+                source_id,
+                max(sizes),
+            )
+        ]
+        await conn.execute(
+            """
+            INSERT INTO blobs (s3_key, thumb_key, mid_key, size, refcount)
+            SELECT s3_key, thumb_key, mid_key, size, 1 FROM photos WHERE album_id = $1;
+            """,
+            source_id,
+        )
+        await conn.execute(
+            """
+            UPDATE photos p SET blob_id = b.id FROM blobs b
+            WHERE b.s3_key = p.s3_key AND p.album_id = $1
+            """,
+            source_id,
+        )
+
+    print(
+        f"{'photos':>8} {'loop ms':>10} {'loop msgs':>10} "
+        f"{'set ms':>10} {'set msgs':>10} {'speedup':>8}"
+    )
+    for n in sizes:
+        ids = photo_ids[:n]
+        loop_code = await adb.createAlbum("bench_import", f"loop {n}")
+        set_code = await adb.createAlbum("bench_import", f"set {n}")
+
+        start = time.perf_counter()
+        rows = await _import_photos_loop(
+            ids, (await adb.getAlbumMeta(loop_code))["id"], user["id"]
+        )
+        # One addPhoto message per imported photo
+        for row in rows:
+            codec.dumps({"action": "addPhoto", "payload": dict(row)})
+        loop_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        album_id = (await adb.getAlbumMeta(set_code))["id"]
+        result = await adb.importPhotos(ids, album_id, user)
+        codec.dumps(
+            {"action": "addPhotos", "payload": {"album_id": album_id, "photos": result}}
+        )
+        set_ms = (time.perf_counter() - start) * 1000
+        if len(result) != n:
+            print(f"importPhotos returned {len(result)} of {n} photos")
+            return 1
+
+        print(
+            f"{n:>8} {loop_ms:>10.1f} {len(rows):>10} "
+            f"{set_ms:>10.1f} {1:>10} {loop_ms / set_ms:>7.1f}x"
+        )
+
+    await adb.close_pool()
+    return 0
+
+
+# --------------------------------------------------------------------------- #
+# watcher: many sockets over many albums through one Watcher
+# --------------------------------------------------------------------------- #
+
+
+class _BenchSocket:
+    """Stands in for a WebSocket; records publish-to-delivery latency.
+
+    A socket with a `delay` plays a slow mobile client and records nothing.
+    """
+
+    def __init__(self, latencies: list, delay: float = 0.0):
+        self._latencies = latencies
+        self._delay = delay
+
+    async def send_text(self, data: str) -> None:
+        if self._delay:
+            await asyncio.sleep(self._delay)
+            return
+        self._latencies.append(time.time() - json.loads(data)["sent"])
+
+    async def close(self, code: int = 1000) -> None:
+        pass
+
+
+async def watcher_load(
+    sockets: int = 5000, albums: int = 2000, messages: int = 2000, slow: int = 100
+) -> int:
+    """Subscribe `sockets` fake sockets across `albums` albums, then publish.
+
+    The first `slow` sockets take a second per message; the others should
+    see the same latency as if they were not there.
+    """
+    random.seed(1)
+    manager = watcher.Watcher()
+    latencies: list[float] = []
+    expected = 0
+    members: dict[str, int] = {}
+    all_sockets = []
+
+    start = time.perf_counter()
+    for i in range(sockets):
+        ws = _BenchSocket(latencies, delay=1.0 if i < slow else 0.0)
+        all_sockets.append(ws)
+        subjects = [f"user-bench{i % 500}"]
+        for album in random.sample(range(albums), 3):
+            subjects += [f"album-bench{album}", f"albumadd-bench{album}"]
+        for subject in subjects:
+            await manager.subscribe(ws, subject)
+            members.setdefault(subject, 0)
+            if i >= slow:
+                members[subject] += 1
+    print(f"subscribed {sockets} sockets in {time.perf_counter() - start:.1f}s")
+
+    try:
+        clients = await watcher.redis_client.client_list()
+        pubsub_clients = sum(1 for c in clients if int(c.get("sub", 0)) > 0)
+        print(f"redis pub/sub connections: {pubsub_clients}")
+    except Exception as e:  # CLIENT LIST is often disabled on managed Redis
+        print(f"redis pub/sub connections: unavailable ({e})")
+
+    channels = list(members)
+    # SUBSCRIBE is fire-and-forget; wait until Redis has registered them all
+    deadline = time.perf_counter() + 30
+    while time.perf_counter() < deadline:
+        active = await watcher.redis_client.pubsub_channels("*bench*")
+        if len(active) >= len(channels):
+            break
+        await asyncio.sleep(0.1)
+
+    start = time.perf_counter()
+    for _ in range(messages):
+        channel = random.choice(channels)
+        expected += members[channel]
+        await watcher.redis_client.publish(channel, json.dumps({"sent": time.time()}))
+    deadline = time.perf_counter() + 30
+    while len(latencies) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(
+        f"{len(latencies)}/{expected} deliveries in {elapsed:.2f}s "
+        f"({len(latencies) / elapsed:.0f}/s)"
+    )
+    if latencies:
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000
+        print(f"publish-to-delivery p50 {p50:.1f} ms, p99 {p99:.1f} ms")
+    print(json.dumps(manager.metrics(), indent=2))
+
+    for ws in all_sockets:
+        await manager.unsubscribe(ws)
+    await manager.close()
+    return 0 if len(latencies) == expected else 1
+
+
+# --------------------------------------------------------------------------- #
+# encode: build and send a getPhotos payload for one large album
+# --------------------------------------------------------------------------- #
+
+
+class _NullSocket:
+    """Stands in for a WebSocket; starlette's send_json encodes like this."""
+
+    async def send_json(self, data) -> None:
+        await self.send_text(
+            json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+        )
+
+    async def send_text(self, data: str) -> None:
+        self.size = len(data)
+
+
+async def encode(photos: int = 5000) -> int:
+    """Time getPhotos + presign + encode + send, stdlib json vs. codec."""
+    await init_adb()
+    await adb.setUser("bench_encode", "encode@example.com", "x")
+    user_id = await adb.get_user_id("bench_encode")
+    async with adb.get_db_connection() as conn:
+        album_id = await conn.fetchval(
+            """
+            INSERT INTO albums (code, name, user_id)
+            VALUES (md5('bench_encode'), 'Bench encode', $1)
+            RETURNING id
+            """,
+            user_id,
+        )
+        await conn.execute(
+            """
+            INSERT INTO photos (user_id, album_id, s3_key, thumb_key, mid_key,
+                                filename, size, created_at)
+            SELECT $1, $2, 'enc/' || md5(g::text), 'enc/thumb_' || md5(g::text),
+                   'enc/mid_' || md5(g::text), 'IMG_' || g || '.jpg', 2000000 + g,
+                   NOW() - (g || ' seconds')::interval
+            FROM generate_series(1, $3::int) g
+            """,
+            user_id,
+            album_id,
+            photos,
+        )
+        await conn.execute(
+            "UPDATE albums SET photo_count = $2 WHERE id = $1", album_id, photos
+        )
+
+    async def build() -> dict:
+        result = await adb.getPhotos(album_id, limit=photos)
+        for p in result["photos"]:
+            for key_type in ("s3_key", "thumb_key", "mid_key"):
+                if p.get(key_type):
+                    p[key_type] = aws.create_presigned_url(p[key_type])
+        return {"action": "getPhotos", "payload": result}
+
+    message = await build()
+    socket = _NullSocket()
+
+    async def stdlib_send():
+        await socket.send_json(message)
+
+    async def codec_send():
+        await codec.send(socket, message)
+
+    build_ms = await _median_ms(build, repeat=10)
+    stdlib_ms = await _median_ms(stdlib_send, repeat=10)
+    codec_ms = await _median_ms(codec_send, repeat=10)
+    print(f"{photos} photos, {socket.size / 1e6:.1f} MB frame")
+    print(f"{'':>10} {'build ms':>10} {'send ms':>10} {'total ms':>10}")
+    for name, send_ms in (("stdlib", stdlib_ms), ("orjson", codec_ms)):
+        print(
+            f"{name:>10} {build_ms:>10.1f} {send_ms:>10.1f} {build_ms + send_ms:>10.1f}"
+        )
+    print(f"encode speedup {stdlib_ms / codec_ms:.1f}x")
+
+    await adb.close_pool()
+    return 0
+
+
+# --------------------------------------------------------------------------- #
+# Entry point
+# --------------------------------------------------------------------------- #
+
+# name -> (coroutine, needs the seeded scratch schema)
+COMMANDS = {
+    "explain": (explain, True),
+    "albums": (albums, True),
+    "s3": (s3, False),
+    "presign": (presign, False),
+    "watcher": (watcher_load, False),
+    "encode": (encode, True),
+    "import": (import_photos, True),
+}
+
+
+def main() -> int:
+    logging.basicConfig(level=logging.WARNING)
+    name = sys.argv[1] if len(sys.argv) > 1 else ""
+    if name not in COMMANDS:
+        print(f"usage: python bench.py [{'|'.join(COMMANDS)}]")
+        return 2
+
+    command, needs_db = COMMANDS[name]
+    start = time.perf_counter()
+    if needs_db:
+        create_schema()
+    try:
+        if needs_db:
+            seed()
+        result = asyncio.run(command())
+    finally:
+        if needs_db:
+            drop_schema()
+    print(f"done in {time.perf_counter() - start:.1f}s")
+    return 1 if result else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
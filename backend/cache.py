@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import codec
+import env
+import redis.asyncio as redis
+
+redis_client = redis.from_url(env.REDIS_URL, decode_responses=True)
+
+# Prefix of the channels that carry invalidated keys, one per cache
+INVALIDATE_CHANNEL = "cache-invalidate:"
+# Lifetime of a key's version counter; far longer than any load takes
+VERSION_TTL = 24 * 3600
+
+
+class TwoLevelCache:
+    """Read-through cache: an in-process LRU in front of Redis.
+
+    get() looks in the local LRU, then in Redis, then calls the loader and
+    fills both.  invalidate() deletes the Redis copy and broadcasts the key
+    so every process drops its local copy; listen() applies those
+    broadcasts.  The short local TTL bounds staleness if one is missed.
+    Values must be JSON-serialisable; None is never cached.
+
+    Each key also has a version in Redis that invalidate() bumps.  get()
+    reads it before loading and fills Redis only if it is unchanged, so a
+    load that raced an invalidation in any process is not stored.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: int, local_ttl: int):
+        self.name = name
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._local_ttl = local_ttl
+        # key -> (expiry on the time.monotonic() clock, value)
+        self._local: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        # key -> [generation, get() calls in flight], kept while a get() of
+        # the key is running; an invalidation bumps the generation so a load
+        # that raced it is not stored
+        self._inflight: dict[str, list[int]] = {}
+        self._local_hits = 0
+        self._redis_hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    def _redis_key(self, key: str) -> str:
+        return f"{self.name}:{key}"
+
+    def _version_key(self, key: str) -> str:
+        return f"{self.name}:version:{key}"
+
+    def _store_local(self, key: str, value: dict) -> None:
+        self._local[key] = (time.monotonic() + self._local_ttl, value)
+        self._local.move_to_end(key)
+        if len(self._local) > self._maxsize:
+            self._local.popitem(last=False)
+
+    async def get(self, key: str, loader) -> dict | None:
+        entry = self._local.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._local.move_to_end(key)
+                self._local_hits += 1
+                return entry[1]
+            del self._local[key]
+
+        inflight = self._inflight.setdefault(key, [0, 0])
+        inflight[1] += 1
+        generation = inflight[0]
+        try:
+            try:
+                raw, version = await redis_client.mget(
+                    self._redis_key(key), self._version_key(key)
+                )
+            except Exception as e:
+                logging.error("%s cache read failed: %s", self.name, e)
+                raw = version = None
+            if raw is not None:
+                value = codec.loads(raw)
+                self._redis_hits += 1
+                if generation == inflight[0]:
+                    self._store_local(key, value)
+                return value
+
+            self._misses += 1
+            value = await loader()
+            if value is not None:
+                # Redis has its own fence in the version; only the local
+                # copy depends on this process having seen no invalidation
+                if generation == inflight[0]:
+                    self._store_local(key, value)
+                await self._fill(key, value, version)
+            return value
+        finally:
+            inflight[1] -= 1
+            if not inflight[1]:
+                del self._inflight[key]
+
+    async def _fill(self, key: str, value: dict, version: str | None) -> None:
+        """Store *value* in Redis unless *key* was invalidated since *version*."""
+        version_key = self._version_key(key)
+        try:
+            async with redis_client.pipeline(transaction=True) as pipe:
+                await pipe.watch(version_key)
+                if await pipe.get(version_key) != version:
+                    return
+                pipe.multi()
+                pipe.set(self._redis_key(key), codec.dumps(value), ex=self._ttl)
+                await pipe.execute()
+        except redis.WatchError:
+            # Invalidated while filling; the next get() loads afresh
+            pass
+        except Exception as e:
+            logging.error("%s cache write failed: %s", self.name, e)
+
+    def _drop_local(self, key: str) -> None:
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            inflight[0] += 1
+        self._local.pop(key, None)
+
+    async def invalidate(self, *keys: str) -> None:
+        """Drop *keys* here, in Redis, and in every other process."""
+        if not keys:
+            return
+        self._invalidations += len(keys)
+        for key in keys:
+            self._drop_local(key)
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                # Bump the versions first, so no fill that read the old one
+                # can land after the delete
+                for key in keys:
+                    pipe.incr(self._version_key(key))
+                    pipe.expire(self._version_key(key), VERSION_TTL)
+                pipe.delete(*(self._redis_key(key) for key in keys))
+                for key in keys:
+                    pipe.publish(INVALIDATE_CHANNEL + self.name, key)
+                await pipe.execute()
+        except Exception as e:
+            logging.error("%s cache invalidation failed: %s", self.name, e)
+
+    async def listen(self) -> None:
+        """Apply invalidations from other processes; runs for the app's lifetime."""
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(INVALIDATE_CHANNEL + self.name)
+        try:
+            while True:
+                try:
+                    message = await pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=1.0
+                    )
+                    if message and message["type"] == "message":
+                        self._drop_local(message["data"])
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.error("%s cache listener error: %s", self.name, e)
+                    await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
+
+    def metrics(self) -> dict:
+        lookups = self._local_hits + self._redis_hits + self._misses
+        return {
+            "size": len(self._local),
+            "local_hits": self._local_hits,
+            "redis_hits": self._redis_hits,
+            "misses": self._misses,
+            "hit_rate": round((lookups - self._misses) / lookups, 4)
+            if lookups
+            else None,
+            "invalidations": self._invalidations,
+        }
@@ -0,0 +1,30 @@
+"""JSON encoding for WebSocket frames and pub/sub messages.
+
+Everything the app sends to a browser goes through here, so each message
+is serialised exactly once, with orjson: handlers encode before sending
+or publishing, and Watcher forwards the published text to every socket
+as-is.  Frames stay JSON text frames.
+"""
+
+from contextvars import ContextVar
+
+import orjson
+from fastapi import WebSocket
+
+JSONDecodeError = orjson.JSONDecodeError
+loads = orjson.loads
+
+# Set by wsrouter while a request runs; send() echoes it on every reply
+request_id: ContextVar[str | int | None] = ContextVar("request_id", default=None)
+
+
+def dumps(obj) -> str:
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+async def send(websocket: WebSocket, message) -> None:
+    """Send *message* to *websocket* as one JSON text frame."""
+    rid = request_id.get()
+    if rid is not None:
+        message = {**message, "request_id": rid}
+    await websocket.send_text(dumps(message))
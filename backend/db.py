@@ -1,61 +1,26 @@
-import asyncio
-import datetime
+"""Synchronous psycopg2 layer used for schema setup and admin scripts.
+
+Request handlers and worker jobs use the asyncpg twin in adb.py.
+"""
+
 import hashlib
-import json
 import logging
 import random
-import uuid
 from contextlib import contextmanager
 
-import arq
 import aws
 import env
-from arq.connections import RedisSettings
 from psycopg2.pool import ThreadedConnectionPool
 
 # --------------------------------------------------------------------------- #
 # Database connection helpers
 # --------------------------------------------------------------------------- #
 
-_pool = None
 _db_pool = None
 
 
-async def _get_arq_pool():
-    """Helper to lazily initialize the arq Redis pool with correct DSN/Host settings."""
-    global _pool
-    if _pool is None:
-        # If it looks like a full DSN (or specifically for Amazon/Production), use from_dsn
-        if (
-            "redis://" in env.REDIS_URL2_DSN
-            or "rediss://" in env.REDIS_URL2_DSN
-            or "amazon" in env.REDIS_URL2_DSN
-        ):
-            redis_settings = RedisSettings.from_dsn(env.REDIS_URL2_DSN)
-        else:
-            # Otherwise treat as a bare host (common in local IP testing)
-            redis_settings = RedisSettings(host=env.REDIS_URL2_DSN)
-
-        _pool = await arq.create_pool(redis_settings)
-    return _pool
-
-
-async def enqueue_delete_key(key: str):
-    pool = await _get_arq_pool()
-    await pool.enqueue_job("delete_s3_object", key)
-
-
-async def enqueue_delete_keys(keys: list):
-    pool = await _get_arq_pool()
-    await pool.enqueue_job("delete_s3_objects", keys)
-
-
-async def enqueue_cleanup_deleted_photos(age_hours: int = 0):
-    pool = await _get_arq_pool()
-    await pool.enqueue_job("cleanup_deleted_photos", age_hours)
-
-
-def init_pool():
+def init_pool(**kwargs):
+    """Create the psycopg2 pool; extra kwargs are passed through to libpq."""
     global _db_pool
     if _db_pool is None:
         _db_pool = ThreadedConnectionPool(
@@ -66,6 +31,7 @@ def init_pool():
             dbname=env.DB_NAME,
             user=env.DB_USER,
             password=env.DB_PASSWORD,
+            **kwargs,
         )
 
 
@@ -200,6 +166,8 @@ def init_db() -> None:
                 """
             )
 
+            run_migrations(cursor)
+
             conn.commit()
 
     logging.info("Database schema initialized.")
@@ -229,6 +197,218 @@ def init_db() -> None:
     setUserData("anonymous", user_class="free")
 
 
+# Versioned migrations, applied in order and recorded in schema_migrations.
+# Append new steps at the end; never edit one that has already shipped.
+MIGRATIONS: list[tuple[int, str, str]] = [
+    (
+        1,
+        "indexes for hot photo/album/subscription queries",
+        """
+        -- getPhotos / getDownloadList / latest-thumbnail lookups (album_id, sort by created_at)
+        CREATE INDEX IF NOT EXISTS idx_photos_album_created
+            ON photos (album_id, created_at, id);
+        -- contributor checks, per-user filters and per-user counts (user_id, album_id)
+        CREATE INDEX IF NOT EXISTS idx_photos_user_album
+            ON photos (user_id, album_id);
+        -- shared-object count updates in deletePhoto/deleteAlbum/importPhotos
+        CREATE INDEX IF NOT EXISTS idx_photos_s3_key
+            ON photos (s3_key);
+        -- get_deleted_photos_to_clean only ever looks at soft-deleted rows
+        CREATE INDEX IF NOT EXISTS idx_photos_deleted
+            ON photos (deleted_at, count) WHERE deleted_at IS NOT NULL;
+        -- uncountedPhotos
+        CREATE INDEX IF NOT EXISTS idx_photos_size_null
+            ON photos (id) WHERE size IS NULL;
+        -- album listings per owner and ON DELETE CASCADE from users
+        CREATE INDEX IF NOT EXISTS idx_albums_user
+            ON albums (user_id, modified_at DESC);
+        -- subscription lookups by album and ON DELETE CASCADE from albums
+        CREATE INDEX IF NOT EXISTS idx_subscription_album
+            ON subscription (album_id, user_id);
+        -- Stripe webhooks resolve users by customer id
+        CREATE INDEX IF NOT EXISTS idx_users_stripe_customer
+            ON users (stripe_customer_id);
+        """,
+    ),
+    (
+        2,
+        "cached album photo counts and keyset indexes for getPhotos",
+        """
+        ALTER TABLE albums ADD COLUMN IF NOT EXISTS photo_count INTEGER NOT NULL DEFAULT 0;
+        UPDATE albums a
+        SET photo_count = c.n
+        FROM (
+            SELECT album_id, COUNT(*) AS n
+            FROM photos
+            WHERE album_id IS NOT NULL
+            GROUP BY album_id
+        ) c
+        WHERE a.id = c.album_id;
+        -- keyset pages for the filename and size sorts (created_at already has one)
+        CREATE INDEX IF NOT EXISTS idx_photos_album_filename
+            ON photos (album_id, filename, id);
+        CREATE INDEX IF NOT EXISTS idx_photos_album_size
+            ON photos (album_id, (COALESCE(size, 0)), id);
+        """,
+    ),
+    (
+        3,
+        "album cover thumbnail kept on the album row",
+        """
+        -- filled in by the worker's backfill_album_covers job
+        ALTER TABLE albums ADD COLUMN IF NOT EXISTS cover_thumb_key TEXT;
+        """,
+    ),
+    (
+        4,
+        "blobs: one reference-counted row per stored object",
+        """
+        CREATE TABLE IF NOT EXISTS blobs (
+            id SERIAL PRIMARY KEY,
+            s3_key TEXT NOT NULL UNIQUE,
+            thumb_key TEXT,
+            mid_key TEXT,
+            size INTEGER,
+            -- live (not soft-deleted) photos pointing here
+            refcount INTEGER NOT NULL DEFAULT 0,
+            -- when refcount last reached 0; cleanup deletes the objects after it
+            released_at TIMESTAMP
+        );
+        -- soft-deleted photos go with their blob once it is cleaned up
+        ALTER TABLE photos ADD COLUMN IF NOT EXISTS blob_id INTEGER
+            REFERENCES blobs(id) ON DELETE CASCADE;
+
+        INSERT INTO blobs (s3_key, thumb_key, mid_key, size, refcount, released_at)
+        SELECT s3_key, MAX(thumb_key), MAX(mid_key), MAX(size),
+               COUNT(*) FILTER (WHERE deleted_at IS NULL),
+               CASE WHEN COUNT(*) FILTER (WHERE deleted_at IS NULL) = 0
+                    THEN MAX(deleted_at) END
+        FROM photos
+        WHERE s3_key IS NOT NULL
+        GROUP BY s3_key
+        ON CONFLICT (s3_key) DO NOTHING;
+        UPDATE photos p SET blob_id = b.id
+        FROM blobs b
+        WHERE b.s3_key = p.s3_key AND p.blob_id IS NULL;
+
+        -- refcount updates and the ON DELETE CASCADE from blobs
+        CREATE INDEX IF NOT EXISTS idx_photos_blob ON photos (blob_id);
+        -- cleanup_deleted_photos only ever looks at released blobs
+        CREATE INDEX IF NOT EXISTS idx_blobs_released
+            ON blobs (released_at) WHERE refcount <= 0;
+        """,
+    ),
+    (
+        5,
+        "byte-ordered blob key indexes for the bucket reconciler",
+        """
+        -- The bucket lists keys in byte order; with "C" collation the
+        -- reconciler can read each key column in that order from an index
+        -- and merge them without sorting.
+        CREATE INDEX IF NOT EXISTS idx_blobs_s3_key_c
+            ON blobs (s3_key COLLATE "C");
+        CREATE INDEX IF NOT EXISTS idx_blobs_thumb_key_c
+            ON blobs (thumb_key COLLATE "C") WHERE thumb_key IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS idx_blobs_mid_key_c
+            ON blobs (mid_key COLLATE "C") WHERE mid_key IS NOT NULL;
+        """,
+    ),
+    (
+        6,
+        "storage statistics kept up to date by the writers",
+        """
+        -- getAccountData's counts per user.  Photos count while they are in
+        -- an album; a soft-deleted photo has left it.
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+            num_photos BIGINT NOT NULL DEFAULT 0,       -- photos they added
+            size_photos BIGINT NOT NULL DEFAULT 0,
+            num_albums BIGINT NOT NULL DEFAULT 0,
+            num_other_photos BIGINT NOT NULL DEFAULT 0, -- others' photos in their albums
+            size_albums BIGINT NOT NULL DEFAULT 0
+        );
+        -- totalSpaceUsed's totals, spread over a few rows so concurrent
+        -- writers do not queue on one; readers add the shards up.
+        CREATE TABLE IF NOT EXISTS storage_stats (
+            shard SMALLINT PRIMARY KEY,
+            total BIGINT NOT NULL DEFAULT 0,
+            thumbs BIGINT NOT NULL DEFAULT 0,
+            mids BIGINT NOT NULL DEFAULT 0,
+            no_size_count BIGINT NOT NULL DEFAULT 0,
+            total_files BIGINT NOT NULL DEFAULT 0,
+            total_albums BIGINT NOT NULL DEFAULT 0,
+            total_users BIGINT NOT NULL DEFAULT 0
+        );
+        INSERT INTO user_stats (user_id, num_photos, size_photos, num_albums,
+                                num_other_photos, size_albums)
+        SELECT u.id,
+               COALESCE(up.n, 0), COALESCE(up.size, 0),
+               (SELECT COUNT(*) FROM albums WHERE user_id = u.id),
+               COALESCE(ap.others, 0), COALESCE(ap.size, 0)
+        FROM users u
+        LEFT JOIN (
+            SELECT user_id, COUNT(*) AS n, SUM(COALESCE(size, 0)) AS size
+            FROM photos WHERE album_id IS NOT NULL
+            GROUP BY user_id
+        ) up ON up.user_id = u.id
+        LEFT JOIN (
+            SELECT a.user_id,
+                   COUNT(*) FILTER (WHERE p.user_id IS DISTINCT FROM a.user_id) AS others,
+                   SUM(COALESCE(p.size, 0)) AS size
+            FROM photos p JOIN albums a ON p.album_id = a.id
+            GROUP BY a.user_id
+        ) ap ON ap.user_id = u.id
+        ON CONFLICT (user_id) DO NOTHING;
+        INSERT INTO storage_stats (shard, total, thumbs, mids, no_size_count,
+                                   total_files, total_albums, total_users)
+        SELECT 0,
+               COALESCE(SUM(size), 0), COALESCE(SUM(thumb_size), 0),
+               COALESCE(SUM(mid_size), 0), COUNT(*) FILTER (WHERE size IS NULL),
+               COUNT(*),
+               (SELECT COUNT(*) FROM albums), (SELECT COUNT(*) FROM users)
+        FROM photos WHERE album_id IS NOT NULL
+        ON CONFLICT (shard) DO NOTHING;
+        """,
+    ),
+    (
+        7,
+        "claim released blobs before their objects are deleted",
+        """
+        -- Set by cleanup_deleted_photos before it deletes a blob's objects;
+        -- a claimed blob can no longer gain references.
+        ALTER TABLE blobs ADD COLUMN IF NOT EXISTS deleting_at TIMESTAMP;
+        """,
+    ),
+]
+
+
+def run_migrations(cursor) -> None:
+    """Apply any pending MIGRATIONS inside the caller's transaction."""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+    # Serialise concurrent app/worker startups; released at commit.
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'))")
+    cursor.execute("SELECT version FROM schema_migrations")
+    applied = {row[0] for row in cursor.fetchall()}
+
+    for version, description, sql in MIGRATIONS:
+        if version in applied:
+            continue
+        logging.info("Applying migration %s: %s", version, description)
+        cursor.execute(sql)
+        cursor.execute(
+            "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+            (version, description),
+        )
+
+
 def init_user_limits() -> None:
     """Initialize user_limits table with hardcoded defaults if empty."""
     initial_limits = {
@@ -278,33 +458,19 @@ def setUser(username: str, email: str, password: str, user_class: str = "free")
                 """,
                 (username, email, passhash, salt, user_class),
             )
+            # Counted like adb.setUser does; readers add up every shard,
+            # so this rarely used path can always use the first
+            cursor.execute(
+                """
+                INSERT INTO storage_stats AS s (shard, total_users)
+                VALUES (0, 1)
+                ON CONFLICT (shard) DO UPDATE
+                SET total_users = s.total_users + EXCLUDED.total_users;
+                """
+            )
             conn.commit()
 
 
-def update_user_password(username: str, new_password: str) -> bool:
-    """Update user's password with new hash and salt."""
-    salt = random.randbytes(16).hex()
-    passhash = hashlib.sha256((new_password + salt).encode()).hexdigest()
-
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                # Update user password
-                cursor.execute(
-                    "UPDATE users SET passhash = %s, salt = %s WHERE username = %s",
-                    (passhash, salt, username),
-                )
-                if cursor.rowcount == 0:
-                    return False
-
-                conn.commit()
-                return True
-            except Exception as e:
-                logging.error(f"Error updating password for {username}: {e}")
-                conn.rollback()
-                return False
-
-
 def getUser(username: str) -> dict | None:
     """Retrieve a user from the database by username."""
     with get_db_connection() as conn:
@@ -334,1230 +500,6 @@ def getUser(username: str) -> dict | None:
         return None
 
 
-def get_user_id(username: str) -> int | None:
-    """Retrieve only the user ID from the database by username."""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT id FROM users WHERE username = %s;", (username,))
-            row = cursor.fetchone()
-    return row[0] if row else None
-
-
-def check_password(username: str, password: str) -> bool:
-    """Check if the provided password matches the stored hash for the user."""
-    user = getUser(username)
-    if not user:
-        return False
-
-    salt = user["salt"]
-    expected_hash = user["passhash"]
-    provided_hash = hashlib.sha256((password + salt).encode()).hexdigest()
-    return provided_hash == expected_hash
-
-
-def check_user_has_photos_in_album(user_id: int, album_id: int) -> bool:
-    """Check if the user has any photos in the specified album."""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "SELECT 1 FROM photos WHERE user_id = %s AND album_id = %s LIMIT 1",
-                (user_id, album_id),
-            )
-            return cursor.fetchone() is not None
-
-
-def getAlbum(code: str) -> dict | None:
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                """
-                SELECT a.id, a.code, a.name, a.user_id, a.open, s.profile, a.private, a.created_at, u.username, a.modified_at, s.opened_at
-                FROM albums a
-                JOIN users u ON a.user_id = u.id
-                LEFT JOIN subscription s ON a.id = s.album_id AND s.user_id = a.user_id
-                WHERE a.code = %s;
-                """,
-                (code,),
-            )
-            row = cursor.fetchone()
-
-    if row:
-        return {
-            "id": row[0],
-            "code": row[1],
-            "name": row[2],
-            "user_id": row[3],
-            "open": bool(row[4]),
-            "profile": bool(row[5]) if row[5] is not None else False,
-            "private": bool(row[6]),
-            "created_at": row[7].isoformat()
-            if isinstance(row[7], datetime.datetime)
-            else row[7],
-            "username": row[8],
-            "modified_at": row[9].isoformat()
-            if isinstance(row[9], datetime.datetime)
-            else row[9],
-            "opened_at": row[10].isoformat()
-            if isinstance(row[10], datetime.datetime)
-            else row[10],
-        }
-    return None
-
-
-def get_upload_context(uploader_username: str, album_code: str) -> dict | None:
-    """
-    Consolidates multiple database calls into one for the get_presigned endpoint.
-    Retrieves album details, owner details, owner's space usage, and uploader's ID.
-    Includes the owner's storage limit from the user_limits table.
-    """
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                """
-                SELECT
-                    a.id, a.code, a.user_id, a.open,
-                    uo.username, uo.class,
-                    COALESCE(s.space, 0),
-                    (SELECT id FROM users WHERE username = %s),
-                    COALESCE(ul.max_size, (SELECT max_size FROM user_limits WHERE class = 'free'))
-                FROM albums a
-                JOIN users uo ON a.user_id = uo.id
-                LEFT JOIN spaceused s ON uo.id = s.user_id
-                LEFT JOIN user_limits ul ON LOWER(uo.class) = ul.class
-                WHERE a.code = %s;
-                """,
-                (uploader_username, album_code),
-            )
-            row = cursor.fetchone()
-
-    if row:
-        return {
-            "album_id": row[0],
-            "album_code": row[1],
-            "album_user_id": row[2],
-            "album_open": bool(row[3]),
-            "owner_username": row[4],
-            "owner_class": row[5],
-            "owner_space_used": row[6],
-            "uploader_id": row[7],
-            "owner_limit": row[8],
-        }
-    return None
-
-
-def getAlbumWithSub(code: str, authuser: str) -> dict | None:
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                """
-                SELECT a.id, a.code, a.name, a.user_id, a.open,
-                       COALESCE(s.profile, o_s.profile) AS display_profile,
-                       a.private, a.created_at, u.username,
-                       s.album_id IS NOT NULL AS subscribed,
-                       a.modified_at, o_s.opened_at, s.opened_at AS sub_opened_at,
-                       COALESCE(s.archive, FALSE) AS archived
-                FROM albums a
-                JOIN users u ON a.user_id = u.id
-                LEFT JOIN subscription o_s ON a.id = o_s.album_id AND o_s.user_id = a.user_id
-                LEFT JOIN subscription s ON a.id = s.album_id AND s.user_id = (SELECT id FROM users WHERE username = %s)
-                WHERE a.code = %s;
-                """,
-                (authuser, code),
-            )
-            row = cursor.fetchone()
-
-    if row:
-        return {
-            "id": row[0],
-            "code": row[1],
-            "name": row[2],
-            "user_id": row[3],
-            "open": bool(row[4]),
-            "profile": bool(row[5]),
-            "private": bool(row[6]),
-            "created_at": row[7].isoformat()
-            if isinstance(row[7], datetime.datetime)
-            else row[7],
-            "username": row[8],
-            "subscribed": bool(row[9]),
-            "modified_at": row[10].isoformat()
-            if isinstance(row[10], datetime.datetime)
-            else row[10],
-            "opened_at": row[11].isoformat()
-            if isinstance(row[11], datetime.datetime)
-            else row[11],
-            "sub_opened_at": row[12].isoformat()
-            if isinstance(row[12], datetime.datetime)
-            else row[12],
-            "archived": bool(row[13]),
-        }
-    return None
-
-
-def getPhotos(
-    album_id: int,
-    limit: int = 100,
-    offset: int = 0,
-    sort_field: str = "created_at",
-    sort_order: str = "desc",
-    user_id_filter: int | None = None,
-) -> dict | None:
-
-    # Whitelist sort fields/orders to prevent SQL injection
-    allowed_fields = {
-        "created_at": "p.created_at",
-        "filename": "p.filename",
-        "username": "u.username",
-        "size": "p.size",
-    }
-    field = allowed_fields.get(sort_field, "p.created_at")
-    order = "ASC" if sort_order.lower() == "asc" else "DESC"
-
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            # We also want to know the total count for pagination
-            if user_id_filter:
-                cursor.execute(
-                    "SELECT COUNT(*) FROM photos WHERE album_id = %s AND user_id = %s",
-                    (album_id, user_id_filter),
-                )
-            else:
-                cursor.execute(
-                    "SELECT COUNT(*) FROM photos WHERE album_id = %s", (album_id,)
-                )
-            total_count = cursor.fetchone()[0]
-
-            filter_clause = "AND p.user_id = %s" if user_id_filter else ""
-            query = f"""
-                SELECT p.id, p.user_id, p.album_id, p.s3_key, p.thumb_key, p.mid_key, p.filename,
-                       p.created_at, u.username, p.size, p.thumb_size, p.mid_size
-                FROM photos p
-                JOIN users u ON p.user_id = u.id
-                WHERE p.album_id = %s {filter_clause}
-                ORDER BY {field} {order}, p.id ASC
-                LIMIT %s OFFSET %s;
-            """
-            params = (
-                (album_id, user_id_filter, limit, offset)
-                if user_id_filter
-                else (album_id, limit, offset)
-            )
-            cursor.execute(query, params)
-            rows = cursor.fetchall()
-    # ... (rest of the processing)
-
-    photos = []
-    for row in rows:
-        created_at = row[7]
-        if isinstance(created_at, datetime.datetime):
-            created_at = created_at.isoformat()
-        photos.append(
-            {
-                "id": row[0],
-                "user_id": row[1],
-                "album_id": row[2],
-                "s3_key": row[3],
-                "thumb_key": row[4],
-                "mid_key": row[5],
-                "filename": row[6],
-                "created_at": created_at,
-                "username": row[8],
-                "size": row[9],
-                "thumb_size": row[10],
-                "mid_size": row[11],
-            }
-        )
-    return {
-        "photos": photos,
-        "total": total_count,
-        "limit": limit,
-        "offset": offset,
-    }
-
-
-def recordAlbumVisit(album_code: str, username: str) -> None:
-    """Update opened_at for the database record mapping the album and the user."""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                # Update subscription opened_at
-                cursor.execute(
-                    """
-                    UPDATE subscription
-                    SET opened_at = CURRENT_TIMESTAMP
-                    WHERE album_id = (SELECT id FROM albums WHERE code = %s)
-                      AND user_id = (SELECT id FROM users WHERE username = %s);
-                    """,
-                    (album_code, username),
-                )
-                conn.commit()
-            except Exception as e:
-                logging.error(f"Error recording album visit: {e}")
-                conn.rollback()
-
-
-def getDownloadList(
-    album_id: int,
-    user_id_filter: int | None = None,
-) -> dict | None:
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            filter_clause = "AND p.user_id = %s" if user_id_filter else ""
-            query = f"""
-                SELECT p.s3_key, p.filename, p.id
-                FROM photos p
-                WHERE p.album_id = %s {filter_clause}
-                ORDER BY p.created_at DESC;
-            """
-            params = (album_id, user_id_filter) if user_id_filter else (album_id,)
-            cursor.execute(query, params)
-            rows = cursor.fetchall()
-
-    photos = []
-    for row in rows:
-        photos.append(
-            {
-                "s3_key": row[0],
-                "filename": row[1],
-                "id": row[2],
-            }
-        )
-    return {"photos": photos}
-
-
-async def deleteAlbum(username: str, code: str) -> str:
-    user = getUser(username)
-    if not user:
-        return "user_not_found"
-
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                # 2. Get album id
-                cursor.execute(
-                    """
-                    SELECT id FROM albums
-                    WHERE code = %s AND user_id = %s
-                    """,
-                    (code, user["id"]),
-                )
-                album_row = cursor.fetchone()
-                if album_row is None:
-                    return "album_not_found"
-                album_id = album_row[0]
-
-                # 5. Get total size of all original photos in the album
-                cursor.execute(
-                    """
-                    SELECT id, user_id, size, filename FROM photos
-                    WHERE album_id = %s
-                    """,
-                    (album_id,),
-                )
-                photo_records = cursor.fetchall()
-                total_size = sum(r[2] or 0 for r in photo_records)
-
-                # 6. Remove that space from spaceused for the album owner
-                if total_size > 0:
-                    cursor.execute(
-                        """
-                        INSERT INTO spaceused (user_id, space)
-                        VALUES (%s, %s)
-                        ON CONFLICT (user_id) DO UPDATE
-                        SET space = spaceused.space - EXCLUDED.space;
-                        """,
-                        (user["id"], total_size),
-                    )
-
-                # 7. Soft delete photo records by matching s3_key
-                # Decrement 'count' for all records sharing keys with the deleted album.
-                # Mark 'album_id = NULL' only for records that were in this album.
-                cursor.execute(
-                    """
-                    WITH affected_keys AS (
-                        SELECT s3_key, count(*) as count_in_album
-                        FROM photos
-                        WHERE album_id = %s
-                        GROUP BY s3_key
-                    )
-                    UPDATE photos
-                    SET
-                        album_id = CASE WHEN album_id = %s THEN NULL ELSE album_id END,
-                        deleted_at = CASE WHEN album_id = %s THEN CURRENT_TIMESTAMP ELSE deleted_at END,
-                        count = count - affected_keys.count_in_album
-                    FROM affected_keys
-                    WHERE photos.s3_key = affected_keys.s3_key;
-                    """,
-                    (album_id, album_id, album_id),
-                )
-
-                # 6. Delete the album record itself
-                cursor.execute(
-                    """
-                    DELETE FROM albums
-                    WHERE id = %s
-                    """,
-                    (album_id,),
-                )
-
-                conn.commit()
-                await enqueue_cleanup_deleted_photos(0)
-                return code
-            except Exception as e:
-                conn.rollback()
-                logging.error("Error deleting album: %s", e)
-                return str(e)
-
-
-def addPhoto(data: dict) -> dict | None:
-    s3_key = data.get("s3_key")
-    thumb_key = data.get("thumb_key")
-
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                cursor.execute(
-                    """
-                    INSERT INTO photos (user_id, album_id, s3_key, thumb_key, mid_key, filename, size, thumb_size, mid_size)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    RETURNING id, user_id, album_id, s3_key, thumb_key, mid_key, filename, created_at, size, thumb_size, mid_size;
-                    """,
-                    (
-                        data.get("user_id"),
-                        data.get("album_id"),
-                        s3_key,
-                        thumb_key,
-                        data.get("mid_key"),
-                        data.get("filename"),
-                        data.get("size"),
-                        data.get("thumb_size"),
-                        data.get("mid_size"),
-                    ),
-                )
-                row = cursor.fetchone()
-                # Update the album's modified_at time
-                if row:
-                    cursor.execute(
-                        "UPDATE albums SET modified_at = CURRENT_TIMESTAMP WHERE id = %s RETURNING modified_at",
-                        (row[2],),  # row[2] is album_id
-                    )
-                    mod_row = cursor.fetchone()
-                    album_modified_at = mod_row[0] if mod_row else None
-                else:
-                    album_modified_at = None
-
-                # If we got a row, fetch the username for the user_id we just inserted.
-                if row:
-                    cursor.execute(
-                        """
-                        SELECT username
-                        FROM users
-                        WHERE id = %s;
-                        """,
-                        (row[1],),  # row[1] is user_id
-                    )
-                    user_row = cursor.fetchone()
-                    username = user_row[0] if user_row else None
-                else:
-                    username = None
-                conn.commit()
-            except Exception:
-                conn.rollback()
-                row = None
-                username = None
-                album_modified_at = None
-
-    if row is None:
-        return None
-
-    created_at = row[7]
-    if isinstance(created_at, datetime.datetime):
-        created_at = created_at.isoformat()
-
-    return {
-        "id": row[0],
-        "user_id": row[1],
-        "album_id": row[2],
-        "s3_key": aws.create_presigned_url(row[3]),
-        "thumb_key": aws.create_presigned_url(row[4]),
-        "mid_key": aws.create_presigned_url(row[5]),
-        "filename": row[6],
-        "created_at": created_at,
-        "size": row[8],
-        "thumb_size": row[9],
-        "mid_size": row[10],
-        "username": username,
-        "album_modified_at": album_modified_at.isoformat()
-        if isinstance(album_modified_at, datetime.datetime)
-        else album_modified_at,
-    }
-
-
-def importPhotos(photo_ids: list, target_album_id: int, username: str) -> list:
-    user = getUser(username)
-    if not user:
-        return []
-
-    user_id = user["id"]
-    imported_photos = []
-
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                total_imported_size = 0
-                for pid in photo_ids:
-                    # 1. Get original photo
-                    cursor.execute(
-                        """
-                        SELECT s3_key, thumb_key, mid_key, filename, size, thumb_size, mid_size
-                        FROM photos
-                        WHERE id = %s
-                        """,
-                        (pid,),
-                    )
-                    row = cursor.fetchone()
-                    if not row:
-                        continue
-
-                    s3_key, thumb_key, mid_key, filename, size, thumb_size, mid_size = (
-                        row
-                    )
-
-                    # 2. Insert new row
-                    cursor.execute(
-                        """
-                        INSERT INTO photos (user_id, album_id, s3_key, thumb_key, mid_key, filename, size, thumb_size, mid_size)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        RETURNING id, user_id, album_id, s3_key, thumb_key, mid_key, filename, created_at, size, thumb_size, mid_size;
-                        """,
-                        (
-                            user_id,
-                            target_album_id,
-                            s3_key,
-                            thumb_key,
-                            mid_key,
-                            filename,
-                            size,
-                            thumb_size,
-                            mid_size,
-                        ),
-                    )
-                    new_row = cursor.fetchone()
-
-                    # 3. Increment count for all photos with this s3_key
-                    if s3_key:
-                        cursor.execute(
-                            """
-                            UPDATE photos
-                            SET count = count + 1
-                            WHERE s3_key = %s
-                            """,
-                            (s3_key,),
-                        )
-
-                    # Update modified_at for the target album
-                    cursor.execute(
-                        "UPDATE albums SET modified_at = CURRENT_TIMESTAMP WHERE id = %s RETURNING modified_at",
-                        (target_album_id,),
-                    )
-                    mod_row = cursor.fetchone()
-                    album_modified_at = mod_row[0] if mod_row else None
-
-                    if new_row:
-                        created_at = new_row[7]
-                        if isinstance(created_at, datetime.datetime):
-                            created_at = created_at.isoformat()
-
-                        imported_photos.append(
-                            {
-                                "id": new_row[0],
-                                "user_id": new_row[1],
-                                "album_id": new_row[2],
-                                "s3_key": aws.create_presigned_url(new_row[3])
-                                if new_row[3]
-                                else None,
-                                "thumb_key": aws.create_presigned_url(new_row[4])
-                                if new_row[4]
-                                else None,
-                                "mid_key": aws.create_presigned_url(new_row[5])
-                                if new_row[5]
-                                else None,
-                                "filename": new_row[6],
-                                "created_at": created_at,
-                                "size": new_row[8],
-                                "thumb_size": new_row[9],
-                                "mid_size": new_row[10],
-                                "username": username,
-                                "album_modified_at": album_modified_at.isoformat()
-                                if isinstance(album_modified_at, datetime.datetime)
-                                else album_modified_at,
-                            }
-                        )
-
-                    if size:
-                        total_imported_size += size
-
-                if total_imported_size > 0:
-                    cursor.execute(
-                        """
-                        INSERT INTO spaceused (user_id, space)
-                        VALUES ((SELECT user_id FROM albums WHERE id = %s), %s)
-                        ON CONFLICT (user_id) DO UPDATE
-                        SET space = spaceused.space + EXCLUDED.space;
-                        """,
-                        (target_album_id, total_imported_size),
-                    )
-
-                conn.commit()
-            except Exception as e:
-                logging.error("importPhotos error: %s", e)
-                conn.rollback()
-                return []
-
-    return imported_photos
-
-
-async def deletePhoto(id: str, username: str) -> int | bool:
-    user = getUser(username)
-    if not user:
-        return False
-
-    try:
-        photo_id = int(id)
-    except (ValueError, TypeError):
-        return False
-
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                # Fetch photo details including S3 keys and size
-                cursor.execute(
-                    """
-                    SELECT user_id, album_id, s3_key, thumb_key, mid_key, size, filename
-                    FROM photos
-                    WHERE id = %s;
-                    """,
-                    (photo_id,),
-                )
-                photo_row = cursor.fetchone()
-                if not photo_row:
-                    return False
-
-                (
-                    photo_owner_id,
-                    album_id,
-                    s3_key,
-                    thumb_key,
-                    mid_key,
-                    photo_size,
-                    filename,
-                ) = photo_row
-
-                # Fetch album owner
-                cursor.execute(
-                    """
-                    SELECT user_id
-                    FROM albums
-                    WHERE id = %s;
-                    """,
-                    (album_id,),
-                )
-                album_row = cursor.fetchone()
-                if not album_row:
-                    return False
-
-                album_owner_id = album_row[0]
-
-                # Only the photo owner or album owner may delete
-                if user["id"] not in (photo_owner_id, album_owner_id):
-                    return False
-
-                # Enqueue S3 deletions if they exist
-
-                # S3 deletion logic removed for soft delete
-
-                # Perform the soft delete from DB
-                # This decrements 'count' for all records sharing this photo's s3_key.
-                cursor.execute(
-                    """
-                    UPDATE photos
-                    SET album_id = CASE WHEN id = %s THEN NULL ELSE album_id END,
-                        deleted_at = CASE WHEN id = %s THEN CURRENT_TIMESTAMP ELSE deleted_at END,
-                        count = count - 1
-                    WHERE s3_key = %s;
-                    """,
-                    (photo_id, photo_id, s3_key),
-                )
-
-                # Update spaceused: subtract the original photo size from the album owner's total
-                if photo_size and photo_size > 0:
-                    cursor.execute(
-                        """
-                        INSERT INTO spaceused (user_id, space)
-                        VALUES (%s, %s)
-                        ON CONFLICT (user_id) DO UPDATE
-                        SET space = spaceused.space - EXCLUDED.space;
-                        """,
-                        (album_owner_id, photo_size),
-                    )
-
-                # If UPDATE affected a row, commit
-                if cursor.rowcount == 0:
-                    conn.rollback()
-                    return False
-
-                conn.commit()
-                # await enqueue_cleanup_deleted_photos(0)
-                return album_id
-            except Exception:
-                conn.rollback()
-                return False
-
-
-def getAlbums(username: str, authuser: str) -> dict | None:
-    user = getUser(username)
-    if not user:
-        return None
-
-    # Determine if requester is the profile owner or an admin
-    is_profile_owner = username == authuser
-
-    auth_user_record = user if is_profile_owner else getUser(authuser)
-    is_admin = False
-    if auth_user_record and auth_user_record.get("class") == "admin":
-        is_admin = True
-
-    auth_user_id = auth_user_record.get("id") if auth_user_record else None
-
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                # Include owned and subscribed albums (owned by the user whose profile is being viewed)
-                # Also join with photos to get the latest thumbnail
-                cursor.execute(
-                    """
-                    SELECT a.id, a.code, a.name, a.user_id, a.open,
-                           s_prof.profile AS display_profile,
-                           a.private, a.created_at, u.username,
-                           (SELECT p.thumb_key FROM photos p
-                            WHERE p.album_id = a.id AND p.thumb_key IS NOT NULL
-                            ORDER BY p.created_at DESC LIMIT 1) as thumb_key,
-                           a.modified_at,
-                           CASE WHEN a.user_id = %s THEN s_prof.opened_at ELSE NULL END,
-                           s_auth.opened_at AS sub_opened_at
-                    FROM albums a
-                    JOIN users u ON a.user_id = u.id
-                    JOIN subscription s_prof ON a.id = s_prof.album_id AND s_prof.user_id = %s
-                    LEFT JOIN subscription s_auth ON a.id = s_auth.album_id AND s_auth.user_id = %s
-                    WHERE COALESCE(s_prof.archive, FALSE) = FALSE
-                    ORDER BY a.modified_at DESC;
-                    """,
-                    (user["id"], user["id"], auth_user_id),
-                )
-                rows = cursor.fetchall()
-            except Exception as e:
-                logging.error("Error fetching albums: %s", e)
-                rows = []
-
-    if not rows:
-        return None
-
-    albums = []
-    for row in rows:
-        album_id = row[0]
-        # Permissions check
-        album_owner = row[8]
-        is_owner = authuser == album_owner
-        is_profile = bool(row[5])
-        is_private = bool(row[6])
-
-        has_photos = False
-        if not is_owner and auth_user_record:
-            has_photos = check_user_has_photos_in_album(
-                auth_user_record["id"], album_id
-            )
-
-        # Allow if: admin OR profile owner OR album owner OR profile OR has photos
-        if not (is_admin or is_profile_owner or is_owner or is_profile or has_photos):
-            continue
-
-        created_at = row[7]
-        if isinstance(created_at, datetime.datetime):
-            created_at = created_at.isoformat()
-
-        # Privacy rule for thumbnails: only owners see thumbnails for private albums
-        thumb_key = row[9]
-        if is_private and not is_owner:
-            thumb_key = None
-
-        thumb_url = aws.create_presigned_url(thumb_key) if thumb_key else None
-
-        albums.append(
-            {
-                "id": row[0],
-                "code": row[1],
-                "name": row[2],
-                "username": row[8],
-                "open": bool(row[4]),
-                "profile": is_profile,
-                "private": is_private,
-                "created_at": created_at,
-                "thumbnail": thumb_url,
-                "modified_at": row[10].isoformat()
-                if isinstance(row[10], datetime.datetime)
-                else row[10],
-                "opened_at": row[11].isoformat()
-                if isinstance(row[11], datetime.datetime)
-                else row[11],
-                "sub_opened_at": row[12].isoformat()
-                if isinstance(row[12], datetime.datetime)
-                else row[12],
-            }
-        )
-    return {"albums": albums}
-
-
-def getAlbumsWithUserPhotos(authuser: str) -> dict | None:
-    user = getUser(authuser)
-    if not user:
-        return None
-
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                # Find distinct albums where this user has photos
-                # Also join with photos to get the latest thumbnail
-                cursor.execute(
-                    """
-                    SELECT DISTINCT a.id, a.code, a.name, a.user_id, a.open, o_s.profile, a.private, a.created_at, u.username,
-                           (SELECT p2.thumb_key FROM photos p2
-                            WHERE p2.album_id = a.id AND p2.thumb_key IS NOT NULL
-                            ORDER BY p2.created_at DESC LIMIT 1) as thumb_key,
-                           a.modified_at,
-                           CASE WHEN a.user_id = %s THEN o_s.opened_at ELSE NULL END,
-                           s.opened_at AS sub_opened_at,
-                           COALESCE(s.archive, FALSE) AS archived
-                    FROM albums a
-                    JOIN users u ON a.user_id = u.id
-                    LEFT JOIN photos p ON a.id = p.album_id AND p.user_id = %s
-                    LEFT JOIN subscription o_s ON a.id = o_s.album_id AND o_s.user_id = a.user_id
-                    LEFT JOIN subscription s ON a.id = s.album_id AND s.user_id = %s
-                    WHERE (p.user_id IS NOT NULL OR s.archive = TRUE)
-                      AND NOT (s.user_id IS NOT NULL AND COALESCE(s.archive, FALSE) = FALSE)
-                    ORDER BY a.modified_at DESC;
-                    """,
-                    (user["id"], user["id"], user["id"]),
-                )
-                rows = cursor.fetchall()
-            except Exception as e:
-                logging.error("Error fetching albums with user photos: %s", e)
-                rows = []
-
-    if not rows:
-        return {"albums": []}
-
-    albums = []
-    for row in rows:
-        created_at = row[7]
-        if isinstance(created_at, datetime.datetime):
-            created_at = created_at.isoformat()
-
-        is_owner = authuser == row[8]
-        is_private = bool(row[6])
-        thumb_key = row[9]
-        if is_private and not is_owner:
-            thumb_key = None
-
-        thumb_url = aws.create_presigned_url(thumb_key) if thumb_key else None
-
-        albums.append(
-            {
-                "id": row[0],
-                "code": row[1],
-                "name": row[2],
-                "username": row[8],
-                "open": bool(row[4]),
-                "profile": bool(row[5]),
-                "private": is_private,
-                "created_at": created_at,
-                "thumbnail": thumb_url,
-                "modified_at": row[10].isoformat()
-                if isinstance(row[10], datetime.datetime)
-                else row[10],
-                "opened_at": row[11].isoformat()
-                if isinstance(row[11], datetime.datetime)
-                else row[11],
-                "sub_opened_at": row[12].isoformat()
-                if isinstance(row[12], datetime.datetime)
-                else row[12],
-                "archived": bool(row[13]),
-            }
-        )
-    return {"albums": albums}
-
-
-def createAlbum(username: str, album_name: str) -> str | None:
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                cursor.execute(
-                    "SELECT id FROM users WHERE username = %s",
-                    (username,),
-                )
-                user_row = cursor.fetchone()
-                if user_row is None:
-                    return None
-                user_id = user_row[0]
-
-                album_code = uuid.uuid4().hex
-
-                cursor.execute(
-                    """
-                    INSERT INTO albums (name, user_id, code)
-                    VALUES (%s, %s, %s)
-                    RETURNING id;
-                    """,
-                    (album_name, user_id, album_code),
-                )
-                album_id = cursor.fetchone()[0]  # consume the returned id
-
-                cursor.execute(
-                    """
-                    INSERT INTO subscription (user_id, album_id, profile)
-                    VALUES (%s, %s, FALSE);
-                    """,
-                    (user_id, album_id),
-                )
-
-                conn.commit()
-                return album_code
-            except Exception:
-                conn.rollback()
-                return None
-
-
-def subscribe(username: str, albumcode: str) -> bool:
-    user = getUser(username)
-    album = getAlbum(albumcode)
-    if not user or not album:
-        return False
-
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                cursor.execute(
-                    """
-                    INSERT INTO subscription (user_id, album_id)
-                    VALUES (%s, %s)
-                    ON CONFLICT (user_id, album_id) DO NOTHING;
-                    """,
-                    (user["id"], album["id"]),
-                )
-                conn.commit()
-                return True
-            except Exception as e:
-                logging.error(
-                    "Error subscribing user %s to album %s: %s", username, albumcode, e
-                )
-                conn.rollback()
-                return False
-
-
-def unsubscribe(username: str, albumcode: str) -> bool:
-    user = getUser(username)
-    album = getAlbum(albumcode)
-    if not user or not album:
-        return False
-
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                cursor.execute(
-                    """
-                    DELETE FROM subscription
-                    WHERE user_id = %s AND album_id = %s;
-                    """,
-                    (user["id"], album["id"]),
-                )
-                conn.commit()
-                return True
-            except Exception as e:
-                logging.error(
-                    "Error unsubscribing user %s from album %s: %s",
-                    username,
-                    albumcode,
-                    e,
-                )
-                conn.rollback()
-                return False
-
-
-def toggleOpen(id: str, username: str) -> dict | None:
-    user = getUser(username)
-    if user is None:
-        return None
-
-    try:
-        album_id = int(id)
-    except (ValueError, TypeError):
-        return None
-
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                # Grab the album's current state and ownership.
-                cursor.execute(
-                    """
-                    SELECT user_id, code, open
-                    FROM albums
-                    WHERE id = %s;
-                    """,
-                    (album_id,),
-                )
-                row = cursor.fetchone()
-                if row is None:
-                    return None
-
-                album_owner_id, album_code, current_open = row
-
-                # Ensure the requesting user owns the album.
-                if user["id"] != album_owner_id:
-                    return None
-
-                # Toggle the `open` flag.
-                new_open = not current_open
-                cursor.execute(
-                    """
-                    UPDATE albums
-                    SET open = %s
-                    WHERE id = %s
-                    RETURNING id, code, open;
-                    """,
-                    (new_open, album_id),
-                )
-                updated_row = cursor.fetchone()
-                if updated_row is None:
-                    conn.rollback()
-                    return None
-
-                conn.commit()
-
-                return getAlbum(album_code)
-
-            except Exception:
-                conn.rollback()
-                return None
-
-
-def toggleArchive(id: str, username: str) -> dict | None:
-    user = getUser(username)
-    if user is None:
-        return None
-
-    try:
-        album_id = int(id)
-    except (ValueError, TypeError):
-        return None
-
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                # Toggle the `archive` flag for the user's subscription.
-                cursor.execute(
-                    """
-                    SELECT archive
-                    FROM subscription
-                    WHERE user_id = %s AND album_id = %s;
-                    """,
-                    (user["id"], album_id),
-                )
-                sub_row = cursor.fetchone()
-                if sub_row is None:
-                    return None
-
-                new_sub_archive = not sub_row[0]
-                cursor.execute(
-                    """
-                    UPDATE subscription
-                    SET archive = %s
-                    WHERE user_id = %s AND album_id = %s;
-                    """,
-                    (new_sub_archive, user["id"], album_id),
-                )
-                conn.commit()
-
-                # Return the updated album object to the client
-                cursor.execute("SELECT code FROM albums WHERE id = %s", (album_id,))
-                album_row = cursor.fetchone()
-                if album_row:
-                    return getAlbumWithSub(album_row[0], username)
-                return None
-            except Exception as e:
-                logging.error("Error toggling archive: %s", e)
-                conn.rollback()
-                return None
-
-
-def toggleProfile(id: str, username: str) -> dict | None:
-    user = getUser(username)
-    if user is None:
-        return None
-
-    try:
-        album_id = int(id)
-    except (ValueError, TypeError):
-        return None
-
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                # Toggle the `profile` flag for the user's subscription.
-                cursor.execute(
-                    """
-                    SELECT profile
-                    FROM subscription
-                    WHERE user_id = %s AND album_id = %s;
-                    """,
-                    (user["id"], album_id),
-                )
-                sub_row = cursor.fetchone()
-                if sub_row is None:
-                    return None
-
-                new_sub_profile = not sub_row[0]
-                cursor.execute(
-                    """
-                    UPDATE subscription
-                    SET profile = %s
-                    WHERE user_id = %s AND album_id = %s;
-                    """,
-                    (new_sub_profile, user["id"], album_id),
-                )
-                conn.commit()
-
-                # Return the updated album object to the client
-                cursor.execute("SELECT code FROM albums WHERE id = %s", (album_id,))
-                album_row = cursor.fetchone()
-                if album_row:
-                    album_obj = getAlbum(album_row[0])
-                    # Note: since getAlbum returns the owner's profile by default, if the current user isn't the owner,
-                    # we need to inject the sub_profile so the UI shows the modified profile properly
-                    if album_obj:
-                        album_obj["profile"] = new_sub_profile
-                    return album_obj
-                return None
-            except Exception:
-                conn.rollback()
-                return None
-
-
-def togglePrivate(id: str, username: str) -> dict | None:
-    user = getUser(username)
-    if user is None:
-        return None
-
-    try:
-        album_id = int(id)
-    except (ValueError, TypeError):
-        return None
-
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                # Grab the album's current state and ownership.
-                cursor.execute(
-                    """
-                    SELECT user_id, code, private
-                    FROM albums
-                    WHERE id = %s;
-                    """,
-                    (album_id,),
-                )
-                row = cursor.fetchone()
-                if row is None:
-                    return None
-
-                album_owner_id, album_code, current_private = row
-
-                # Ensure the requesting user owns the album.
-                if user["id"] != album_owner_id:
-                    return None
-
-                # Toggle the `private` flag.
-                new_private = not current_private
-                cursor.execute(
-                    """
-                    UPDATE albums
-                    SET private = %s
-                    WHERE id = %s
-                    RETURNING id, code, private;
-                    """,
-                    (new_private, album_id),
-                )
-                updated_row = cursor.fetchone()
-                if updated_row is None:
-                    conn.rollback()
-                    return None
-
-                conn.commit()
-
-                return getAlbum(album_code)
-
-            except Exception:
-                conn.rollback()
-                return None
-
-
-def search(term: str) -> str:
-    # 1. Check for a matching username.
-    user = getUser(term)
-    if user:
-        return f"/user/{user['username']}"
-
-    # 2. Check for a matching album code.
-    album = getAlbum(term)
-    if album:
-        return f"/album/{album['code']}"
-
-    # 3. Nothing matched.
-    return ""
-
-
-def setAlbumName(albumcode: str, albumname: str, username: str) -> bool:
-    user = getUser(username)
-    if user is None:
-        return False
-
-    album = getAlbum(albumcode)
-    if album is None:
-        return False
-
-    if album["user_id"] != user["id"]:
-        return False
-
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                cursor.execute(
-                    """
-                    UPDATE albums
-                    SET name = %s
-                    WHERE code = %s
-                    RETURNING id;
-                    """,
-                    (albumname, albumcode),
-                )
-                row = cursor.fetchone()
-                if row is None:
-                    return False
-
-                conn.commit()
-                return True
-            except Exception:
-                conn.rollback()
-                return False
-
-
 def setUserData(
     username: str,
     newusername: str | None = None,
@@ -1631,89 +573,6 @@ def setUserData(
                 return "error"
 
 
-def getEmail(username: str) -> str | None:
-
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                cursor.execute(
-                    "SELECT email FROM users WHERE username = %s", (username,)
-                )
-                row = cursor.fetchone()
-                if row is None:
-                    return None
-                return row[0]
-            except Exception:
-                return None
-
-
-def getAccountData(username: str) -> dict | None:
-    """
-    Consolidates getEmail, getUser, and getUsage into one call.
-    Returns a dictionary with comprehensive account and usage data.
-    """
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                """
-                SELECT
-                    u.id, u.username, u.email, u.class, u.notify_me,
-                    (SELECT COUNT(*) FROM photos WHERE user_id = u.id) as num_photos,
-                    (SELECT COUNT(*) FROM albums WHERE user_id = u.id) as num_albums,
-                    (SELECT COUNT(*) FROM photos p JOIN albums a ON p.album_id = a.id WHERE a.user_id = u.id AND p.user_id != u.id) as num_other_photos,
-                    (SELECT SUM(COALESCE(size, 0)) FROM photos WHERE user_id = u.id) as total_size_photos,
-                    (SELECT SUM(COALESCE(p.size, 0)) FROM photos p JOIN albums a ON p.album_id = a.id WHERE a.user_id = u.id) as total_size_albums,
-                    (SELECT space FROM spaceused WHERE user_id = u.id) as space_used_table,
-                    COALESCE(ul.max_size, (SELECT max_size FROM user_limits WHERE class = 'free')) as max_size
-                FROM users u
-                LEFT JOIN user_limits ul ON LOWER(u.class) = ul.class
-                WHERE u.username = %s;
-                """,
-                (username,),
-            )
-            row = cursor.fetchone()
-
-    if not row:
-        return None
-
-    (
-        user_id,
-        uname,
-        email,
-        uclass,
-        notify_me,
-        num_photos,
-        num_albums,
-        num_other_photos,
-        total_size_photos,
-        total_size_albums,
-        space_used_table,
-        max_size,
-    ) = row
-
-    # Calculate remaining space
-    remaining_space = max(0, max_size - (space_used_table or 0))
-
-    return {
-        "userInfo": {
-            "username": uname,
-            "email": email,
-            "class": uclass,
-            "notify_me": notify_me,
-        },
-        "usage": {
-            "number of photos": num_photos,
-            "number of albums": num_albums,
-            "number of other peoples photos in users albums": num_other_photos,
-            "total size of photos": int(total_size_photos or 0),
-            "total size in user albums": int(total_size_albums or 0),
-            "spaceused_table": int(space_used_table or 0),
-            "remaining space": int(remaining_space),
-        },
-        "email": email,
-    }
-
-
 # --------------------------------------------------------------------------- #
 # Admin functions
 # --------------------------------------------------------------------------- #
@@ -1769,383 +628,3 @@ def cleanup() -> None:
                     logging.error("[cleanup] Failed to delete %s – %r", key, exc)
 
     logging.info("completed")
-
-
-async def cleanup2(ctx=None) -> None:
-    """
-    Synchronise the S3 bucket with the database.
-
-    The function performs the following steps:
-    1. Retrieve all known keys from the photos table using fetchmany to save memory.
-    2. Enumerate objects in the R2 bucket.
-    3. Delete objects that do not exist in the database.
-    """
-
-    # --- Step 1: Collect all known keys from the database -----------------
-    def get_known_keys():
-        keys: set[str] = set()
-        with get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                # Use a larger fetch size to balance speed and memory
-                cursor.execute("SELECT s3_key, thumb_key, mid_key FROM photos")
-                while True:
-                    rows = cursor.fetchmany(10000)
-                    if not rows:
-                        break
-                    for r in rows:
-                        if r[0]:
-                            keys.add(r[0])
-                        if r[1]:
-                            keys.add(r[1])
-                        if r[2]:
-                            keys.add(r[2])
-        return keys
-
-    logging.info("Building known_keys set from database...")
-    known_keys = await asyncio.to_thread(get_known_keys)
-    logging.info("Known keys retrieved: %d", len(known_keys))
-
-    # --- Step 2: List objects in the S3 bucket ----------------------------
-    s3 = await asyncio.to_thread(aws.get_s3_client)
-    delete_buffer = []
-    continuation_token = None
-
-    while True:
-
-        def list_objects():
-            params = {"Bucket": aws.BUCKET_NAME, "MaxKeys": 1000}
-            if continuation_token:
-                params["ContinuationToken"] = continuation_token
-            return s3.list_objects_v2(**params)
-
-        page = await asyncio.to_thread(list_objects)
-        contents = page.get("Contents", [])
-
-        if not contents:
-            break
-
-        for obj in contents:
-            key = obj["Key"]
-
-            # Safeguard: Skip directory markers if they exist in R2
-            if key.endswith("/"):
-                continue
-
-            if key not in known_keys:
-                delete_buffer.append({"Key": key})
-
-            # Perform bulk delete at the 1,000 key limit
-            if len(delete_buffer) >= 1000:
-                logging.info(
-                    "Deleting batch of %d orphaned objects...", len(delete_buffer)
-                )
-                await asyncio.to_thread(
-                    s3.delete_objects,
-                    Bucket=aws.BUCKET_NAME,
-                    Delete={"Objects": delete_buffer},
-                )
-                delete_buffer = []
-
-        if not page.get("IsTruncated"):
-            break
-
-        continuation_token = page.get("NextContinuationToken")
-        # Yield control between pages
-        await asyncio.sleep(0.05)
-
-    # Clean up any remaining keys in the buffer
-    if delete_buffer:
-        logging.info(
-            "Deleting final batch of %d orphaned objects...", len(delete_buffer)
-        )
-        await asyncio.to_thread(
-            s3.delete_objects, Bucket=aws.BUCKET_NAME, Delete={"Objects": delete_buffer}
-        )
-
-    logging.info("Cleanup completed.")
-
-
-def totalSpaceUsed() -> dict:
-    """Get storage usage statistics including actual R2 bucket size."""
-    result = {
-        "total": 0,
-        "thumbs": 0,
-        "mids": 0,
-        "no_size_count": 0,
-        "total_files": 0,
-        "total_albums": 0,
-        "total_users": 0,
-    }
-
-    # Fetch actual R2 bucket usage
-    r2_usage = aws.get_bucket_usage()
-    if r2_usage:
-        result["totalr2"] = r2_usage.get("result", {}).get("payloadSize", 0)
-
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT SUM(size) FROM photos")
-            db_total = cursor.fetchone()[0]
-            if db_total is not None and result["total"] == 0:
-                result["total"] = db_total
-
-            cursor.execute("SELECT SUM(thumb_size) FROM photos")
-            result["thumbs"] = cursor.fetchone()[0] or 0
-            cursor.execute("SELECT SUM(mid_size) FROM photos")
-            result["mids"] = cursor.fetchone()[0] or 0
-            cursor.execute("SELECT COUNT(*) FROM photos WHERE size IS NULL")
-            result["no_size_count"] = cursor.fetchone()[0] or 0
-            cursor.execute("SELECT COUNT(*) FROM photos")
-            result["total_files"] = cursor.fetchone()[0] or 0
-            cursor.execute("SELECT COUNT(*) FROM albums")
-            result["total_albums"] = cursor.fetchone()[0] or 0
-            cursor.execute("SELECT COUNT(*) FROM users")
-            result["total_users"] = cursor.fetchone()[0] or 0
-
-    return result
-
-
-def updatePhotoSizes(
-    photo_id: int, size: int, thumb_size: int | None = None, mid_size: int | None = None
-):
-    # Update the photo sizes in the database - this is called by the worker
-    updates = ["size = %s"]
-    params = [size]
-
-    if thumb_size is not None:
-        updates.append("thumb_size = %s")
-        params.append(thumb_size)
-    if mid_size is not None:
-        updates.append("mid_size = %s")
-        params.append(mid_size)
-
-    params.append(photo_id)
-    query = f"UPDATE photos SET {', '.join(updates)} WHERE id = %s"
-
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                # Get metadata BEFORE updating
-                cursor.execute(
-                    """
-                    SELECT a.user_id, p.size, a.id, p.filename
-                    FROM photos p
-                    JOIN albums a ON p.album_id = a.id
-                    WHERE p.id = %s
-                    """,
-                    (photo_id,),
-                )
-                row = cursor.fetchone()
-                if not row:
-                    return
-
-                owner_id, current_size, album_id, filename = row
-
-                # If the new size is 0 or None, and we don't have a size yet,
-                # don't update the record so it can be picked up later.
-                if (size is None or size <= 0) and current_size is None:
-                    conn.rollback()
-                    return
-
-                cursor.execute(query, tuple(params))
-
-                # Only log to spaceused and photos_atomic if we are transitioning from NULL size to a known size
-                # This ensures we only count each photo once, even if the task is retried.
-                if current_size is None and size > 0:
-                    # Update spaceused for album owner
-                    cursor.execute(
-                        """
-                        INSERT INTO spaceused (user_id, space)
-                        VALUES (%s, %s)
-                        ON CONFLICT (user_id) DO UPDATE
-                        SET space = spaceused.space + EXCLUDED.space;
-                        """,
-                        (owner_id, size),
-                    )
-
-                conn.commit()
-            except Exception as e:
-                conn.rollback()
-                logging.error("Error updating photo sizes for %s: %s", photo_id, e)
-
-
-def uncountedPhotos() -> list:
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "SELECT id, s3_key, thumb_key, mid_key FROM photos WHERE size IS NULL"
-            )
-            return cursor.fetchall()
-
-
-def get_deleted_photos_to_clean(age_hours: int = 0) -> list:
-    """Fetch photos that were soft deleted older than 'age_hours' ago and have count=0."""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            # count <= 0 as a safety measure
-            cursor.execute(
-                """
-                SELECT id, s3_key, thumb_key, mid_key
-                FROM photos
-                WHERE deleted_at IS NOT NULL
-                  AND deleted_at < NOW() - INTERVAL '%s hours'
-                  AND count <= 0
-                """,
-                (age_hours,),
-            )
-            return cursor.fetchall()
-
-
-def hard_delete_photos(photo_ids: list[int]) -> None:
-    """Permanently remove photos from DB by ID."""
-    if not photo_ids:
-        return
-
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                # PostgreSQL requires tuple for IN clause
-                cursor.execute("DELETE FROM photos WHERE id = ANY(%s)", (photo_ids,))
-                conn.commit()
-            except Exception as e:
-                conn.rollback()
-                logging.error("Error hard deleting photos: %s", e)
-
-
-# --------------------------------------------------------------------------- #
-# Stripe helpers
-# --------------------------------------------------------------------------- #
-
-
-def getStripeCustomerId(username: str) -> str | None:
-    """Retrieve the Stripe customer ID for a given username."""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                cursor.execute(
-                    "SELECT stripe_customer_id FROM users WHERE username = %s",
-                    (username,),
-                )
-                row = cursor.fetchone()
-                return row[0] if row else None
-            except Exception as e:
-                logging.error(
-                    "Error getting stripe customer id for %s: %s", username, e
-                )
-                return None
-
-
-def updateUserStripeCustomerId(username: str, customer_id: str) -> None:
-    """Update the Stripe customer ID for a given username."""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                cursor.execute(
-                    """
-                    UPDATE users
-                    SET stripe_customer_id = %s
-                    WHERE username = %s;
-                    """,
-                    (customer_id, username),
-                )
-                conn.commit()
-            except Exception as e:
-                logging.error(
-                    "Error updating stripe customer id for %s: %s", username, e
-                )
-                conn.rollback()
-
-
-def updateUserPlan(customer_id: str, plan: str, event_id: str | None = None) -> None:
-    """Update the user's plan (class) based on their Stripe customer ID and log the event."""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                # Update users table (the 'class' column represents the plan level)
-                cursor.execute(
-                    """
-                    UPDATE users
-                    SET class = %s
-                    WHERE stripe_customer_id = %s;
-                    """,
-                    (plan, customer_id),
-                )
-
-                # Log to stripe1 table for transaction/plan history
-                cursor.execute(
-                    """
-                    INSERT INTO stripe1 (customer_id, plan, event_id)
-                    VALUES (%s, %s, %s);
-                    """,
-                    (customer_id, plan, event_id),
-                )
-                conn.commit()
-            except Exception as e:
-                logging.error("Error updating plan for customer %s: %s", customer_id, e)
-                conn.rollback()
-
-
-def dumpStripeEvent(event_id: str, event: dict) -> None:
-    """Store the raw Stripe event data in the stripedump table."""
-    customer_id = event.get("data", {}).get("object", {}).get("customer")
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                cursor.execute(
-                    """
-                    INSERT INTO stripedump (event_id, customer_id, data)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT (event_id) DO NOTHING;
-                    """,
-                    (event_id, customer_id, json.dumps(event)),
-                )
-                conn.commit()
-            except Exception as e:
-                logging.error("Error dumping stripe event %s: %s", event_id, e)
-                conn.rollback()
-
-
-async def delete_user(username: str) -> None:
-    """Delete a user and all associated data from the database."""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                # Get user ID
-                cursor.execute("SELECT id FROM users WHERE username = %s", (username,))
-                row = cursor.fetchone()
-                if not row:
-                    return
-                user_id = row[0]
-
-                # get all s3_keys for user's photos to delete from S3 after DB cleanup
-                cursor.execute(
-                    """
-                    SELECT p.s3_key, p.thumb_key, p.mid_key
-                    FROM photos p
-                    JOIN albums a ON p.album_id = a.id
-                    WHERE a.user_id = %s
-                    """,
-                    (user_id,),
-                )
-                photo_rows = cursor.fetchall()
-                killed_keys = []
-                for s3_key, thumb_key, mid_key in photo_rows:
-                    if s3_key:
-                        killed_keys.append(s3_key)
-                    if thumb_key:
-                        killed_keys.append(thumb_key)
-                    if mid_key:
-                        killed_keys.append(mid_key)
-
-                while killed_keys:
-                    batch = killed_keys[:100]
-                    killed_keys = killed_keys[100:]
-                    await enqueue_delete_keys(batch)
-
-                # Delete user record (cascades to albums, photos, subscriptions, etc.)
-                cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
-
-                conn.commit()
-            except Exception as e:
-                logging.error("Error deleting user %s: %s", username, e)
-                conn.rollback()
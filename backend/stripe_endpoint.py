@@ -1,7 +1,7 @@
 import datetime
 import logging
 
-import db
+import adb
 import env
 import stripe
 from fastapi import APIRouter, Depends, HTTPException, Request
@@ -45,7 +45,7 @@ async def stripe_webhook(request: Request):
     if event["type"] == "checkout.session.completed":
         customer_id = event["data"]["object"]["customer"]
         username = event["data"]["object"]["client_reference_id"]
-        db.updateUserStripeCustomerId(username, customer_id)
+        await adb.updateUserStripeCustomerId(username, customer_id)
         print(
             "WEBHOOK: checkout.session.completed - customer: {customer_id}, username: {username}"
         )
@@ -65,12 +65,12 @@ async def stripe_webhook(request: Request):
         if not plan:
             raise HTTPException(status_code=400, detail="Invalid product ID")
 
-        db.updateUserPlan(customer_id, plan, event["id"])
+        await adb.updateUserPlan(customer_id, plan, event["id"])
         print("WEBHOOK: invoice.paid - customer: {customer_id}, plan: {plan}")
 
     elif event["type"] == "customer.subscription.deleted":
         customer_id = event["data"]["object"]["customer"]
-        db.updateUserPlan(customer_id, "free", event["id"])
+        await adb.updateUserPlan(customer_id, "free", event["id"])
 
     # elif event["type"] == "customer.subscription.updated":
     #     customer_id = event["data"]["object"]["customer"]
@@ -86,17 +86,17 @@ async def create_customer_session(Authorize: AuthJWT = Depends()):
         current_user = Authorize.get_jwt_subject()
 
         # 1. Check for existing Stripe customer ID
-        stripe_customer_id = db.getStripeCustomerId(current_user)
+        stripe_customer_id = await adb.getStripeCustomerId(current_user)
 
         # 2. If no customer ID exists, create one and update the database
         if not stripe_customer_id:
-            email = db.getEmail(current_user)
+            email = await adb.getEmail(current_user)
             customer = stripe.Customer.create(
                 email=email,
                 metadata={"user_id": current_user, "username": current_user},
             )
             stripe_customer_id = customer.id
-            db.updateUserStripeCustomerId(current_user, stripe_customer_id)
+            await adb.updateUserStripeCustomerId(current_user, stripe_customer_id)
             print(
                 f"Created new Stripe customer {stripe_customer_id} for user {current_user}"
             )
@@ -118,7 +118,7 @@ async def create_portal_session(request: Request, Authorize: AuthJWT = Depends()
         Authorize.jwt_required()
         current_user = Authorize.get_jwt_subject()
 
-        stripe_customer_id = db.getStripeCustomerId(current_user)
+        stripe_customer_id = await adb.getStripeCustomerId(current_user)
         if not stripe_customer_id:
             raise HTTPException(status_code=400, detail="Stripe customer not found")
 
@@ -149,7 +149,7 @@ async def delete_customer(request: Request, Authorize: AuthJWT = Depends()):
 
         print("Deleting user from database", current_user)
 
-        stripe_customer_id = db.getStripeCustomerId(current_user)
+        stripe_customer_id = await adb.getStripeCustomerId(current_user)
         if stripe_customer_id:
             logging.warning(
                 "DELETE CUSTOMER", stripe.Customer.delete(stripe_customer_id)
@@ -157,7 +157,7 @@ async def delete_customer(request: Request, Authorize: AuthJWT = Depends()):
         else:
             logging.warning("No Stripe customer ID found for user %s", current_user)
 
-        await db.delete_user(current_user)
+        await adb.delete_user(current_user)
         return {"detail": "Customer and user deleted successfully"}
 
     except Exception as e:
@@ -1,12 +1,177 @@
 import asyncio
+import heapq
+import itertools
+import logging
 import time
+import zlib
+from collections import deque
 
+import codec
 import env
 import redis.asyncio as redis
 from fastapi import WebSocket
 
 redis_client = redis.from_url(env.REDIS_URL, decode_responses=True)
 
+# Number of Redis pub/sub connections per process; channels are spread over
+# them by hash.  One is plenty until a single connection becomes the bottleneck.
+PUBSUB_CONNECTIONS = getattr(env, "WATCHER_PUBSUB_CONNECTIONS", 1)
+# A socket that cannot take a message within this many seconds is dropped
+SEND_TIMEOUT = getattr(env, "WATCHER_SEND_TIMEOUT", 5.0)
+# Messages buffered per socket before the overflow policy applies
+SEND_QUEUE_SIZE = getattr(env, "WATCHER_SEND_QUEUE_SIZE", 256)
+# What to do when a socket's queue is full:
+#   "drop_oldest" - discard the oldest queued message
+#   "drop_newest" - discard the incoming message
+#   "disconnect"  - close the socket straight away
+OVERFLOW_POLICY = getattr(env, "WATCHER_OVERFLOW_POLICY", "drop_oldest")
+# A socket that has lost this many messages since its last successful send
+# is treated as a slow consumer and disconnected; the client reconnects and
+# reloads instead of silently missing updates.
+SLOW_CONSUMER_DROPS = getattr(env, "WATCHER_SLOW_CONSUMER_DROPS", SEND_QUEUE_SIZE)
+# Actions where only the latest message per subject matters; a newer one
+# replaces a still-queued older one instead of taking another slot.
+COALESCE_ACTIONS = {"albumModified"}
+# Seconds a subscription lives without a keep_alive
+SUBSCRIPTION_TTL = 600
+# How often the expiry task wakes; expired subscriptions go within this
+EXPIRY_INTERVAL = 1.0
+# Recent fan-out latencies kept for the metrics percentiles
+LATENCY_SAMPLES = 1000
+
+
+class _PubSubConnection:
+    """One Redis pub/sub connection and the task that reads from it."""
+
+    def __init__(self, watcher: "Watcher"):
+        self._watcher = watcher
+        self._pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        self._reader_task: asyncio.Task | None = None
+        self.channels: set[str] = set()
+
+    async def subscribe(self, channel: str) -> None:
+        self.channels.add(channel)
+        await self._pubsub.subscribe(channel)
+        if self._reader_task is None:
+            # The connection exists once the first SUBSCRIBE has been sent
+            self._reader_task = asyncio.create_task(self._reader())
+
+    async def unsubscribe(self, channel: str) -> None:
+        self.channels.discard(channel)
+        await self._pubsub.unsubscribe(channel)
+
+    async def _reader(self) -> None:
+        while True:
+            try:
+                message = await self._pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=1.0
+                )
+                if message and message["type"] == "message":
+                    await self._watcher._dispatch(message["channel"], message["data"])
+                    # Let the writers run before reading the next message
+                    await asyncio.sleep(0)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                # redis-py reconnects and resubscribes on the next read
+                logging.error("Watcher pub/sub reader error: %s", e)
+                await asyncio.sleep(1)
+
+    async def close(self) -> None:
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        await self._pubsub.aclose()
+
+
+class _SocketWriter:
+    """Bounded outbound queue for one websocket, drained by its own task.
+
+    Fan-out only appends to the queue, so a slow client delays nobody
+    but itself.
+    """
+
+    def __init__(self, watcher: "Watcher", websocket: WebSocket):
+        self._watcher = watcher
+        self._websocket = websocket
+        # Entries are [coalesce_key, data] lists so a coalesced message
+        # can be replaced in place without losing its position.
+        self._queue: deque[list] = deque()
+        self._coalesce: dict[str, list] = {}
+        self._ready = asyncio.Event()
+        self._dropped = 0
+        self._closed = False
+        self._task = asyncio.create_task(self._writer())
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def put(self, data: str, coalesce_key: str | None = None) -> None:
+        """Queue *data* for sending; never blocks."""
+        if self._closed:
+            return
+        if coalesce_key is not None:
+            entry = self._coalesce.get(coalesce_key)
+            if entry is not None:
+                entry[1] = data
+                self._watcher._coalesced += 1
+                return
+
+        if len(self._queue) >= SEND_QUEUE_SIZE:
+            if OVERFLOW_POLICY == "disconnect":
+                self._watcher._disconnect_slow(self._websocket)
+                return
+            self._dropped += 1
+            self._watcher._dropped += 1
+            if self._dropped >= SLOW_CONSUMER_DROPS:
+                self._watcher._disconnect_slow(self._websocket)
+                return
+            if OVERFLOW_POLICY == "drop_newest":
+                return
+            self._forget(self._queue.popleft())
+
+        entry = [coalesce_key, data]
+        self._queue.append(entry)
+        if coalesce_key is not None:
+            self._coalesce[coalesce_key] = entry
+        self._ready.set()
+
+    def _forget(self, entry: list) -> None:
+        if entry[0] is not None and self._coalesce.get(entry[0]) is entry:
+            del self._coalesce[entry[0]]
+
+    async def _writer(self) -> None:
+        while not self._closed:
+            if not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            entry = self._queue.popleft()
+            self._forget(entry)
+            try:
+                await asyncio.wait_for(
+                    self._websocket.send_text(entry[1]), SEND_TIMEOUT
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                self._watcher._send_errors += 1
+                logging.info("Error sending to websocket: %r", exc)
+                # Closed like a slow consumer, so the client reconnects and
+                # reloads rather than sitting on a socket that gets nothing
+                await self._watcher._close_slow(self._websocket)
+                return
+            self._dropped = 0
+            self._watcher._deliveries += 1
+
+    def close(self) -> None:
+        self._closed = True
+        self._queue.clear()
+        self._coalesce.clear()
+        # unsubscribe() may be reached from this writer's own error path
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
+
 
 class Watcher:
     """Pub/Sub manager for WebSocket connections.
@@ -14,89 +179,167 @@ class Watcher:
     Each WebSocket can be associated with multiple *subjects*.
     When a message is published to any of those subjects on Redis,
     it is forwarded to the WebSocket.
-    Subscriptions have a 10-minute expiration by default.
+    Subscriptions have a 10-minute expiration by default.  Deadlines are
+    kept in a min-heap, so expiring them costs only what actually expires.
+
+    All subjects share a small fixed pool of Redis pub/sub connections:
+    a subject is SUBSCRIBEd when its first websocket arrives and
+    UNSUBSCRIBEd when its last one leaves, and incoming messages are
+    dispatched by channel name.
+
+    Every websocket has its own bounded send queue and writer task, so
+    dispatching a message costs one enqueue per socket and a slow client
+    only holds up its own queue (see OVERFLOW_POLICY).
     """
 
-    def __init__(self):
-        # Map websocket -> { subject: expiration_timestamp }
+    def __init__(self, connections: int = PUBSUB_CONNECTIONS):
+        # Map websocket -> { subject: expiration (time.monotonic) }
         self._websocket_subscriptions: dict[WebSocket, dict[str, float]] = {}
         # Map subject -> set of websockets.
         self._subject_targets: dict[str, set[WebSocket]] = {}
-        # Map subject -> listener task.
-        self._subject_listeners: dict[str, asyncio.Task] = {}
+        # Map websocket -> its outbound queue
+        self._writers: dict[WebSocket, _SocketWriter] = {}
+        self._connections = [_PubSubConnection(self) for _ in range(connections)]
+        # Serialises SUBSCRIBE/UNSUBSCRIBE so a subject is never half-registered
+        self._channel_lock = asyncio.Lock()
+        # (expiration, seq, websocket, subject), lazily deleted: an entry is
+        # stale once the subscription is gone or has a newer expiration.
+        self._expiry_heap: list[tuple[float, int, WebSocket, str]] = []
+        self._expiry_seq = itertools.count()
         # Background task for cleanup
         self._cleanup_task = None
+        # Counters for metrics()
+        self._messages = 0
+        self._deliveries = 0
+        self._send_errors = 0
+        self._dropped = 0
+        self._coalesced = 0
+        self._slow_disconnects = 0
+        self._fanout_latency: deque[float] = deque(maxlen=LATENCY_SAMPLES)
+
+    def _connection_for(self, subject: str) -> _PubSubConnection:
+        index = zlib.crc32(subject.encode()) % len(self._connections)
+        return self._connections[index]
+
+    def _schedule_expiry(self, ws: WebSocket, subject: str, expiration: float) -> None:
+        heap = self._expiry_heap
+        heapq.heappush(heap, (expiration, next(self._expiry_seq), ws, subject))
+        # keep_alive and unsubscribe leave stale entries behind; rebuild once
+        # they outnumber the live subscriptions.
+        if len(heap) > 1024 and len(heap) > 2 * self._subscription_count():
+            self._expiry_heap = [
+                entry
+                for entry in heap
+                if self._websocket_subscriptions.get(entry[2], {}).get(entry[3])
+                == entry[0]
+            ]
+            heapq.heapify(self._expiry_heap)
+
+    def _subscription_count(self) -> int:
+        return sum(len(subs) for subs in self._websocket_subscriptions.values())
+
+    async def _expire(self, now: float) -> None:
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            expiration, _, ws, subject = heapq.heappop(heap)
+            subs = self._websocket_subscriptions.get(ws)
+            if subs is not None and subs.get(subject) == expiration:
+                await self.unsubscribe(ws, subject)
 
     async def _cleanup_loop(self) -> None:
         """Periodic task to remove expired subscriptions."""
         while True:
             try:
-                await asyncio.sleep(60)
-                now = time.time()
-                # Iterate over a copy of the keys because we'll be modifying the dict.
-                for ws in list(self._websocket_subscriptions.keys()):
-                    subs = self._websocket_subscriptions.get(ws, {})
-                    expired_subjects = [s for s, expire in subs.items() if expire < now]
-                    for subject in expired_subjects:
-                        await self.unsubscribe(ws, subject)
+                await asyncio.sleep(EXPIRY_INTERVAL)
+                await self._expire(time.monotonic())
             except asyncio.CancelledError:
                 break
             except Exception as e:
-                print(f"Error in Watcher cleanup loop: {e}")
+                logging.error("Error in Watcher cleanup loop: %s", e)
+
+    def _disconnect_slow(self, ws: WebSocket) -> None:
+        """Close a socket that cannot keep up; the client will reconnect."""
+        self._slow_disconnects += 1
+        self._close_writer(ws)
+        asyncio.create_task(self._close_slow(ws))
+
+    async def _close_slow(self, ws: WebSocket) -> None:
+        await self.unsubscribe(ws)
+        try:
+            await ws.close(code=1013)  # Try Again Later
+        except Exception as exc:
+            logging.info("Error closing slow websocket: %r", exc)
+
+    def _close_writer(self, ws: WebSocket) -> None:
+        writer = self._writers.pop(ws, None)
+        if writer is not None:
+            writer.close()
 
-    async def _listener(self, subject: str) -> None:
-        """Internal task that listens to Redis for *subject* and forwards
-        messages to all websockets subscribed to that subject."""
-        pubsub = redis_client.pubsub()
-        await pubsub.subscribe(subject)
+    @staticmethod
+    def _coalesce_key(subject: str, data: str) -> str | None:
         try:
-            async for message in pubsub.listen():
-                if message["type"] == "message":
-                    # Forward to all websockets currently subscribed to this subject.
-                    targets = list(self._subject_targets.get(subject, set()))
-                    for ws in targets:
-                        try:
-                            # Verify it hasn't expired since the last check
-                            subs = self._websocket_subscriptions.get(ws, {})
-                            if subject in subs and subs[subject] > time.time():
-                                await ws.send_text(message["data"])
-                            elif subject in subs:
-                                # Connection still exists but this sub expired
-                                await self.unsubscribe(ws, subject)
-                        except Exception as exc:
-                            await self.unsubscribe(ws)
-                            print(f"Error sending to websocket: {exc}")
-        finally:
-            await pubsub.unsubscribe(subject)
-            self._subject_listeners.pop(subject, None)
+            action = codec.loads(data).get("action")
+        except (ValueError, AttributeError):
+            return None
+        if action in COALESCE_ACTIONS:
+            return f"{subject}:{action}"
+        return None
+
+    async def _dispatch(self, subject: str, data: str) -> None:
+        """Queue one message for all websockets currently subscribed to *subject*."""
+        targets = self._subject_targets.get(subject)
+        if not targets:
+            return
+        start = time.perf_counter()
+        key = self._coalesce_key(subject, data)
+        # Expired subscriptions are removed by the cleanup task within
+        # EXPIRY_INTERVAL, so targets need no per-socket deadline check.
+        for ws in targets:
+            writer = self._writers.get(ws)
+            if writer is not None:
+                writer.put(data, key)
+        self._messages += 1
+        self._fanout_latency.append(time.perf_counter() - start)
 
     async def subscribe(self, websocket: WebSocket, subject: str) -> None:
         """Subscribe *websocket* to *subject* with a 10-minute expiration."""
         if self._cleanup_task is None:
             self._cleanup_task = asyncio.create_task(self._cleanup_loop())
 
-        now = time.time()
-        expiration = now + 600  # 10 minutes
+        expiration = time.monotonic() + SUBSCRIPTION_TTL
 
         subs = self._websocket_subscriptions.setdefault(websocket, {})
         subs[subject] = expiration
+        self._schedule_expiry(websocket, subject, expiration)
+        if websocket not in self._writers:
+            self._writers[websocket] = _SocketWriter(self, websocket)
 
-        targets = self._subject_targets.setdefault(subject, set())
-        targets.add(websocket)
-
-        if subject not in self._subject_listeners:
-            self._subject_listeners[subject] = asyncio.create_task(
-                self._listener(subject)
-            )
+        async with self._channel_lock:
+            targets = self._subject_targets.setdefault(subject, set())
+            first = not targets
+            targets.add(websocket)
+            if first:
+                await self._connection_for(subject).subscribe(subject)
 
     async def keep_alive(self, websocket: WebSocket, subjects: list[str]) -> None:
         """Refresh specified subscriptions for this websocket for another 10 minutes."""
         subs = self._websocket_subscriptions.get(websocket)
         if subs:
-            now = time.time()
+            expiration = time.monotonic() + SUBSCRIPTION_TTL
             for subject in subjects:
                 if subject in subs:
-                    subs[subject] = now + 600
+                    subs[subject] = expiration
+                    self._schedule_expiry(websocket, subject, expiration)
+
+    async def _drop_target(self, websocket: WebSocket, subject: str) -> None:
+        async with self._channel_lock:
+            targets = self._subject_targets.get(subject)
+            if targets is None:
+                return
+            targets.discard(websocket)
+            if not targets:
+                del self._subject_targets[subject]
+                await self._connection_for(subject).unsubscribe(subject)
 
     async def unsubscribe(
         self, websocket: WebSocket, subject: str | None = None
@@ -105,14 +348,9 @@ class Watcher:
         if subject is None:
             # Unsubscribe from ALL subjects for this websocket
             subs = self._websocket_subscriptions.pop(websocket, {})
+            self._close_writer(websocket)
             for sub in list(subs.keys()):
-                targets = self._subject_targets.get(sub)
-                if targets:
-                    targets.discard(websocket)
-                    if not targets:
-                        task = self._subject_listeners.pop(sub, None)
-                        if task and not task.done():
-                            task.cancel()
+                await self._drop_target(websocket, sub)
             return
 
         # Unsubscribe from a specific subject
@@ -121,11 +359,43 @@ class Watcher:
             subs.pop(subject, None)
             if not subs:
                 self._websocket_subscriptions.pop(websocket, None)
+                self._close_writer(websocket)
 
-        targets = self._subject_targets.get(subject)
-        if targets:
-            targets.discard(websocket)
-            if not targets:
-                task = self._subject_listeners.pop(subject, None)
-                if task and not task.done():
-                    task.cancel()
+        await self._drop_target(websocket, subject)
+
+    def metrics(self) -> dict:
+        """Snapshot of subscription counts and fan-out latency (milliseconds)."""
+        latencies = sorted(self._fanout_latency)
+
+        def percentile(p: float) -> float | None:
+            if not latencies:
+                return None
+            index = min(len(latencies) - 1, int(p * len(latencies)))
+            return round(latencies[index] * 1000, 3)
+
+        return {
+            "pubsub_connections": len(self._connections),
+            "channels": len(self._subject_targets),
+            "sockets": len(self._websocket_subscriptions),
+            "subscriptions": self._subscription_count(),
+            "expiry_heap": len(self._expiry_heap),
+            "messages": self._messages,
+            "deliveries": self._deliveries,
+            "send_errors": self._send_errors,
+            "queued": sum(len(writer) for writer in self._writers.values()),
+            "dropped": self._dropped,
+            "coalesced": self._coalesced,
+            "slow_disconnects": self._slow_disconnects,
+            "fanout_ms_p50": percentile(0.5),
+            "fanout_ms_p99": percentile(0.99),
+            "fanout_ms_max": percentile(1.0),
+        }
+
+    async def close(self) -> None:
+        if self._cleanup_task is not None:
+            self._cleanup_task.cancel()
+            self._cleanup_task = None
+        for ws in list(self._writers):
+            self._close_writer(ws)
+        for connection in self._connections:
+            await connection.close()
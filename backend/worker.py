@@ -1,12 +1,14 @@
 import asyncio
 import logging
 import smtplib
+import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
+import adb
 import aws
-import db
 import env
+from arq import cron
 from arq.connections import RedisSettings
 
 logging.basicConfig(
@@ -21,22 +23,54 @@ async def say_hello(ctx, name: str):
     return f"Said hello to {name}"
 
 
+# Size probing: HEAD requests in flight at once and per second across all
+# jobs in this worker, and photos per recount batch (one UPDATE each)
+SIZE_PROBE_CONCURRENCY = getattr(env, "SIZE_PROBE_CONCURRENCY", 16)
+SIZE_PROBE_RATE = getattr(env, "SIZE_PROBE_RATE", 100)
+SIZE_PROBE_BATCH = getattr(env, "SIZE_PROBE_BATCH", 500)
+# Last photo id a recount has written, so an interrupted run can resume
+RECOUNT_PROGRESS_KEY = "recount_missing_sizes:last_id"
+RECOUNT_PROGRESS_TTL = 7 * 86400
+
+_probe_slots = asyncio.Semaphore(SIZE_PROBE_CONCURRENCY)
+_probe_bucket = aws.TokenBucket(SIZE_PROBE_RATE)
+
+
+async def _head_size(key):
+    if not key:
+        return None
+    await _probe_bucket.acquire()
+    async with _probe_slots:
+        # Failed HEADs are retried by the shared client's retry config
+        return await aws.s3size_async(key)
+
+
+async def _probe_sizes(photos) -> list[tuple]:
+    """HEAD every key of (photo_id, s3_key, thumb_key, mid_key) rows concurrently.
+
+    Returns (photo_id, size, thumb_size, mid_size) rows for
+    adb.updatePhotoSizesBatch; a size of 0 means the probe failed.
+    """
+
+    async def probe(photo):
+        photo_id, s3_key, thumb_key, mid_key = photo
+        size, thumb_size, mid_size = await asyncio.gather(
+            _head_size(s3_key), _head_size(thumb_key), _head_size(mid_key)
+        )
+        return photo_id, size or 0, thumb_size, mid_size
+
+    return await asyncio.gather(*(probe(photo) for photo in photos))
+
+
 async def check_photo_sizes(
     ctx, photo_id: int, s3_key: str, thumb_key: str = None, mid_key: str = None
 ):
     # print(f"Checking sizes for photo {photo_id}: {s3_key}, {thumb_key}")
 
-    # Run blocking S3 calls in threads
-    size = await asyncio.to_thread(aws.s3size, s3_key)
-    thumb_size = None
-    if thumb_key:
-        thumb_size = await asyncio.to_thread(aws.s3size, thumb_key)
-    mid_size = None
-    if mid_key:
-        mid_size = await asyncio.to_thread(aws.s3size, mid_key)
-
-    # Run blocking DB call in thread
-    await asyncio.to_thread(db.updatePhotoSizes, photo_id, size, thumb_size, mid_size)
+    [(photo_id, size, thumb_size, mid_size)] = await _probe_sizes(
+        [(photo_id, s3_key, thumb_key, mid_key)]
+    )
+    await adb.updatePhotoSizes(photo_id, size, thumb_size, mid_size)
 
     logging.info(
         "Updated sizes for photo %s: size=%s, thumb_size=%s, mid_size=%s",
@@ -53,56 +87,93 @@ async def check_photo_sizes(
     }
 
 
-async def recount_missing_sizes(ctx):
-    logging.info("Starting re-count of missing photo sizes...")
-    # Fetch list (blocking, but fast)
-    photos = await asyncio.to_thread(db.uncountedPhotos)
-    logging.info("Found %s photos with missing sizes.", len(photos))
-
-    count = 0
-    for photo_id, s3_key, thumb_key, mid_key in photos:
-        # Run blocking S3/DB calls in threads to keep the worker responsive
-        size = await asyncio.to_thread(aws.s3size, s3_key)
-        thumb_size = None
-        if thumb_key:
-            thumb_size = await asyncio.to_thread(aws.s3size, thumb_key)
-        mid_size = None
-        if mid_key:
-            mid_size = await asyncio.to_thread(aws.s3size, mid_key)
-
-        await asyncio.to_thread(
-            db.updatePhotoSizes, photo_id, size, thumb_size, mid_size
-        )
+async def check_photo_sizes_batch(ctx, photos: list):
+    """check_photo_sizes for every (photo_id, s3_key, thumb_key, mid_key) in a batch."""
+    rows = await _probe_sizes(photos)
+    await adb.updatePhotoSizesBatch(rows)
+    return [
+        {
+            "photo_id": photo_id,
+            "size": size,
+            "thumb_size": thumb_size,
+            "mid_size": mid_size,
+        }
+        for photo_id, size, thumb_size, mid_size in rows
+    ]
 
-        count += 1
-        if count % 10 == 0:
-            logging.info("Processed %s/%s photos...", count, len(photos))
 
-        # Pace the task - 0.1s ensures we don't hog the CPU/Network
-        await asyncio.sleep(0.1)
+async def recount_missing_sizes(ctx):
+    """
+    Probe and record the size of every photo that has none yet.
+    Works in id order, SIZE_PROBE_BATCH photos at a time, and checkpoints
+    the last id written in Redis so an interrupted run resumes there.
+    Photos whose probe fails stay NULL for the next run.
+    """
+    redis = ctx.get("redis")
+    last_id = 0
+    if redis:
+        last_id = int(await redis.get(RECOUNT_PROGRESS_KEY) or 0)
+    if last_id:
+        logging.info("Resuming re-count of missing photo sizes after %s...", last_id)
+    else:
+        logging.info("Starting re-count of missing photo sizes...")
+
+    start = time.monotonic()
+    probed = updated = requests = 0
+    while True:
+        photos = await adb.uncountedPhotos(last_id, SIZE_PROBE_BATCH)
+        if not photos:
+            break
+        rows = await _probe_sizes(photos)
+        updated += await adb.updatePhotoSizesBatch(rows)
+        probed += len(photos)
+        requests += sum(1 for photo in photos for key in photo[1:] if key)
+        last_id = photos[-1][0]
+        if redis:
+            await redis.set(RECOUNT_PROGRESS_KEY, last_id, ex=RECOUNT_PROGRESS_TTL)
+        logging.info("Processed %s photos, up to id %s...", probed, last_id)
 
-    logging.info("Re-count completed. Updated %s photos.", count)
-    return {"updated": count}
+    if redis:
+        await redis.delete(RECOUNT_PROGRESS_KEY)
+
+    elapsed = time.monotonic() - start
+    result = {
+        "probed": probed,
+        "updated": updated,
+        "skipped": probed - updated,
+        "head_requests": requests,
+        "seconds": round(elapsed, 3),
+        "photos_per_second": round(probed / elapsed, 1) if elapsed else None,
+        "requests_per_second": round(requests / elapsed, 1) if elapsed else None,
+    }
+    logging.info("Re-count completed: %s", result)
+    return result
 
 
 async def delete_s3_object(ctx, key: str):
     if key:
         logging.info("Deleting %s from S3", key)
-        await asyncio.to_thread(aws.delete_file_from_s3, key)
+        await aws.delete_file_from_s3_async(key)
     return True
 
 
 async def delete_s3_objects(ctx, keys: list):
-    if keys:
-        logging.info("Deleting %s objects from S3", len(keys))
-        await asyncio.to_thread(aws.delete_files_from_s3, keys)
-    return True
+    if not keys:
+        return {"deleted": 0, "failed": 0}
+    logging.info("Deleting %s objects from S3", len(keys))
+    result = await aws.bulk_delete(keys)
+    logging.info(
+        "Deleted %s objects from S3, %s failed", result["deleted"], result["failed"]
+    )
+    return {"deleted": result["deleted"], "failed": result["failed"]}
 
 
 async def cleanup_deleted_photos(ctx, age_hours: int = 0):
     """
-    Search the database for photos where deleted_at < now - age_hours and count <= 0.
-    Delete the relevant keys from object storage, and then remove those entries from the photos table.
+    Claim the blobs whose refcount reached 0 more than age_hours ago, so they
+    cannot gain a reference again, then delete their objects from storage and
+    remove the blobs along with the soft-deleted photos pointing at them.
+    Blobs with an object that could not be deleted stay claimed for the next run.
     """
     # Rate limit: ensure this doesn't run more than once per minute
     redis = ctx.get("redis")
@@ -114,42 +185,53 @@ async def cleanup_deleted_photos(ctx, age_hours: int = 0):
         await redis.setex(lock_key, 60, "true")
 
     logging.info(
-        "Starting cleanup of old deleted photos (older than %s hours)...", age_hours
+        "Starting cleanup of unreferenced objects (released over %s hours ago)...",
+        age_hours,
     )
 
-    photos_to_delete = await asyncio.to_thread(
-        db.get_deleted_photos_to_clean, age_hours
-    )
+    blobs = await adb.claim_released_blobs(age_hours)
 
-    if not photos_to_delete:
-        logging.info("No photos found to clean up.")
+    if not blobs:
+        logging.info("No objects found to clean up.")
         return {"deleted_count": 0}
 
-    logging.info("Found %s photos to hard delete.", len(photos_to_delete))
+    logging.info("Found %s unreferenced objects to delete.", len(blobs))
 
-    keys_to_delete = []
-    photo_ids_to_delete = []
+    result = await aws.bulk_delete(key for _, *keys in blobs for key in keys if key)
+    failed = set(result["failed_keys"])
 
-    for photo_id, s3_key, thumb_key, mid_key in photos_to_delete:
-        photo_ids_to_delete.append(photo_id)
-        if s3_key:
-            keys_to_delete.append(s3_key)
-        if thumb_key:
-            keys_to_delete.append(thumb_key)
-        if mid_key:
-            keys_to_delete.append(mid_key)
+    # Delete from DB
+    deleted_count = await adb.delete_released_blobs(
+        [blob_id for blob_id, *keys in blobs if not failed.intersection(keys)]
+    )
 
-    # Delete from S3 in batches
-    while keys_to_delete:
-        batch = keys_to_delete[:100]
-        keys_to_delete = keys_to_delete[100:]
-        await asyncio.to_thread(aws.delete_files_from_s3, batch)
+    logging.info(
+        "Cleaned up %s objects; deleted %s keys, %s failed.",
+        deleted_count,
+        result["deleted"],
+        result["failed"],
+    )
+    return {
+        "deleted_count": deleted_count,
+        "objects_deleted": result["deleted"],
+        "objects_failed": result["failed"],
+    }
 
-    # Delete from DB
-    await asyncio.to_thread(db.hard_delete_photos, photo_ids_to_delete)
 
-    logging.info("Successfully cleaned up %s photos.", len(photo_ids_to_delete))
-    return {"deleted_count": len(photo_ids_to_delete)}
+async def backfill_album_covers(ctx, batch_size: int = 500):
+    """
+    Recompute the cached cover thumbnail and photo count of every album.
+    Safe to re-run; each batch is its own short transaction.
+    """
+    logging.info("Backfilling album covers...")
+    last_id = 0
+    while True:
+        batch_last = await adb.backfillAlbumCovers(last_id, batch_size)
+        if batch_last is None:
+            break
+        last_id = batch_last
+    logging.info("Album cover backfill done up to album %s.", last_id)
+    return {"last_album_id": last_id}
 
 
 async def send_reset_code_email(ctx, email: str, code: int):
@@ -217,12 +299,38 @@ async def send_contact_email(
         return False
 
 
+# Bucket listing pages reconciled every ten minutes; 0 turns the sweep off
+ORPHAN_SWEEP_PAGES = getattr(env, "ORPHAN_SWEEP_PAGES", 20)
+
+
+async def sweep_orphans(ctx):
+    """Reconcile the next slice of the bucket, continuing the last one."""
+    if not ORPHAN_SWEEP_PAGES:
+        return None
+    return await adb.cleanup2(ctx, max_pages=ORPHAN_SWEEP_PAGES)
+
+
+async def refresh_bucket_usage(ctx):
+    """Cache the R2 bucket size for /api/space-used."""
+    size = await adb.refreshBucketUsage()
+    if size is None:
+        logging.warning("Could not refresh R2 bucket usage")
+    return size
+
+
 async def startup(ctx):
-    db.init_pool()
+    await adb.init_pool()
+    await aws.open_async_s3_client()
+    # Albums created before covers were cached need one backfill pass
+    if await adb.albumCoversMissing():
+        await ctx["redis"].enqueue_job(
+            "backfill_album_covers", _job_id="backfill_album_covers"
+        )
 
 
 async def shutdown(ctx):
-    db.close_pool()
+    await aws.close_async_s3_client()
+    await adb.close_pool()
 
 
 # 2. Worker settings
@@ -230,11 +338,13 @@ class WorkerSettings:
     functions = [
         say_hello,
         check_photo_sizes,
+        check_photo_sizes_batch,
         recount_missing_sizes,
         delete_s3_object,
-        db.cleanup2,
+        adb.cleanup2,
         delete_s3_objects,
         cleanup_deleted_photos,
+        backfill_album_covers,
         send_reset_code_email,
         send_contact_email,
     ]
@@ -243,5 +353,9 @@ class WorkerSettings:
         redis_settings = RedisSettings.from_dsn(env.REDIS_URL2_DSN)
     else:
         redis_settings = RedisSettings(env.REDIS_URL2_DSN)
+    cron_jobs = [
+        cron(sweep_orphans, minute=set(range(0, 60, 10))),
+        cron(refresh_bucket_usage, minute={5, 20, 35, 50}, run_at_startup=True),
+    ]
     on_startup = startup
     on_shutdown = shutdown
@@ -0,0 +1,247 @@
+import asyncio
+import inspect
+import logging
+import time
+from typing import Awaitable, Callable, Generic, TypeVar
+
+import codec
+import env
+from fastapi import WebSocket
+from pydantic import BaseModel, ValidationError
+from starlette.websockets import WebSocketDisconnect
+
+P = TypeVar("P", bound=BaseModel)
+
+# Requests one connection may have running at once; past this the
+# connection stops reading until one finishes.
+MAX_INFLIGHT = getattr(env, "WS_MAX_INFLIGHT", 8)
+
+
+class NoPayload(BaseModel):
+    pass
+
+
+class WsRequest(BaseModel, Generic[P]):
+    """One client message: the action's typed payload plus the envelope."""
+
+    action: str
+    payload: P
+    wssecret: str | None = None
+    # Echoed on every reply to this request so the client can match them up
+    request_id: str | int | None = None
+
+
+Handler = Callable[[WebSocket, WsRequest, dict | None], Awaitable[None]]
+Identify = Callable[[str | None], Awaitable[dict | None]]
+Lane = Callable[[BaseModel], str | None | Awaitable[str | None]]
+
+
+async def send_error(
+    websocket: WebSocket,
+    action,
+    error: str,
+    detail: list | None = None,
+    request_id: str | int | None = None,
+) -> None:
+    message = {"action": "error", "payload": {"action": action, "error": error}}
+    if detail:
+        message["payload"]["detail"] = detail
+    if request_id is not None:
+        message["request_id"] = request_id
+    await codec.send(websocket, message)
+
+
+class Router:
+    """Maps WebSocket actions to handlers and their payload schemas.
+
+    Each action's request model is built once at registration, so
+    dispatch is a dict lookup plus one validation.  A payload that fails
+    validation, an unknown action or a handler exception is answered with
+    an ``{"action": "error"}`` message instead of closing the socket.
+
+    Actions that mutate an album name a *lane*: a function of the payload
+    returning a key such as ``"album:<id>"``, or an awaitable of one when
+    the key has to be looked up.  A connection runs requests concurrently
+    (see Connection) except that requests in the same lane run one after
+    another, in the order they arrived.
+
+    *identify* turns the connection's username into the user handed to
+    handlers, once per request, so they can pass it down instead of
+    looking the name up again.
+    """
+
+    def __init__(self, identify: Identify):
+        self._identify = identify
+        # action -> (handler, request model, lane)
+        self._routes: dict[str, tuple[Handler, type[WsRequest], Lane | None]] = {}
+        # action -> counters for metrics()
+        self._stats: dict[str, dict] = {}
+        self._unknown = 0
+
+    def action(
+        self,
+        name: str,
+        payload: type[BaseModel] = NoPayload,
+        lane: Lane | None = None,
+    ):
+        """Register the decorated handler for *name* with a *payload* schema."""
+        model = WsRequest[payload]
+
+        def register(handler: Handler) -> Handler:
+            self._routes[name] = (handler, model, lane)
+            self._stats[name] = {
+                "count": 0,
+                "invalid": 0,
+                "errors": 0,
+                "total_seconds": 0.0,
+                "max_seconds": 0.0,
+            }
+            return handler
+
+        return register
+
+    async def prepare(self, websocket: WebSocket, message: dict):
+        """Validate *message*; returns (request, lane key) or None after replying."""
+        action = message.get("action")
+        request_id = message.get("request_id")
+        if not isinstance(request_id, (str, int)):
+            request_id = None
+        if not isinstance(action, str):
+            logging.error("websocket - bad action %r", action)
+            await send_error(websocket, None, "invalid_message", request_id=request_id)
+            return None
+        route = self._routes.get(action)
+        if route is None:
+            self._unknown += 1
+            logging.error("websocket - unknown action %s", action)
+            await send_error(websocket, action, "unknown_action", request_id=request_id)
+            return None
+
+        _, model, lane = route
+        if message.get("payload") is None:
+            message = {**message, "payload": {}}
+        try:
+            request = model.model_validate(message)
+        except ValidationError as e:
+            self._stats[action]["invalid"] += 1
+            detail = e.errors(
+                include_url=False, include_context=False, include_input=False
+            )
+            await send_error(
+                websocket, action, "invalid_payload", detail, request_id=request_id
+            )
+            return None
+        try:
+            lane_key = lane(request.payload) if lane else None
+            if inspect.isawaitable(lane_key):
+                lane_key = await lane_key
+        except Exception as e:
+            self._stats[action]["errors"] += 1
+            logging.error("websocket - %s lane lookup failed: %s", action, e)
+            await send_error(
+                websocket, action, "internal_error", request_id=request.request_id
+            )
+            return None
+        return request, lane_key
+
+    async def run(
+        self, websocket: WebSocket, request: WsRequest, username: str | None
+    ) -> None:
+        """Run the handler for a prepared *request*, replying on failure."""
+        action = request.action
+        handler = self._routes[action][0]
+        stats = self._stats[action]
+        # Every codec.send from this request's task carries its request id
+        codec.request_id.set(request.request_id)
+        start = time.perf_counter()
+        try:
+            user = await self._identify(username)
+            await handler(websocket, request, user)
+        except WebSocketDisconnect:
+            raise
+        except Exception as e:
+            stats["errors"] += 1
+            logging.error("websocket - %s failed: %s", action, e)
+            await send_error(websocket, action, "internal_error")
+        finally:
+            elapsed = time.perf_counter() - start
+            stats["count"] += 1
+            stats["total_seconds"] += elapsed
+            stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+
+    def metrics(self) -> dict:
+        """Per-action counts and timings (milliseconds), busiest first."""
+        actions = {}
+        for name, stats in sorted(
+            self._stats.items(), key=lambda item: -item[1]["total_seconds"]
+        ):
+            if not (stats["count"] or stats["invalid"]):
+                continue
+            count = stats["count"]
+            actions[name] = {
+                "count": count,
+                "invalid": stats["invalid"],
+                "errors": stats["errors"],
+                "total_ms": round(stats["total_seconds"] * 1000, 3),
+                "mean_ms": round(stats["total_seconds"] * 1000 / count, 3)
+                if count
+                else None,
+                "max_ms": round(stats["max_seconds"] * 1000, 3),
+            }
+        return {"actions": actions, "unknown": self._unknown}
+
+
+class Connection:
+    """Runs one websocket's requests as concurrent tasks.
+
+    At most *limit* requests are in flight; submit() waits for a free slot,
+    which stops the read loop and pushes back on the client.  Requests that
+    share a lane are serialised in arrival order.
+    """
+
+    def __init__(self, router: Router, websocket: WebSocket, limit: int = MAX_INFLIGHT):
+        self._router = router
+        self._websocket = websocket
+        self._slots = asyncio.Semaphore(limit)
+        self._tasks: set[asyncio.Task] = set()
+        # lane key -> [lock, requests holding or waiting for it]
+        self._lanes: dict[str, list] = {}
+
+    async def submit(self, message: dict, username: str | None) -> None:
+        prepared = await self._router.prepare(self._websocket, message)
+        if prepared is None:
+            return
+        request, lane_key = prepared
+
+        await self._slots.acquire()
+        lane = None
+        if lane_key is not None:
+            lane = self._lanes.setdefault(lane_key, [asyncio.Lock(), 0])
+            lane[1] += 1
+        task = asyncio.create_task(self._run(request, username, lane_key, lane))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, request, username, lane_key, lane) -> None:
+        try:
+            if lane is None:
+                await self._router.run(self._websocket, request, username)
+            else:
+                # Tasks start in creation order and asyncio.Lock is FIFO,
+                # so a lane runs its requests in the order they arrived.
+                async with lane[0]:
+                    await self._router.run(self._websocket, request, username)
+        except WebSocketDisconnect:
+            # The read loop sees the disconnect too and shuts the connection
+            pass
+        finally:
+            if lane is not None:
+                lane[1] -= 1
+                if not lane[1]:
+                    del self._lanes[lane_key]
+            self._slots.release()
+
+    async def drain(self) -> None:
+        """Wait for in-flight requests so none outlives the connection."""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
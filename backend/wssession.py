@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import time
+
+import env
+import redis.asyncio as redis
+
+redis_client = redis.from_url(env.REDIS_URL, decode_responses=True)
+
+# Seconds a connection trusts its resolved username before asking Redis again
+SESSION_TTL = getattr(env, "WSSECRET_SESSION_TTL", 30)
+# Carries wssecrets whose mapping changed; every process drops them at once
+INVALIDATE_CHANNEL = "wssecret-invalidate"
+
+# wssecret -> time.monotonic() of its last invalidation.  Entries older than
+# SESSION_TTL can go: any session resolved before them has expired anyway.
+_invalidated: dict[str, float] = {}
+
+
+class WsSession:
+    """The user a websocket connection's wssecret resolves to.
+
+    The first message does a Redis GET wssecret:<secret>; later messages
+    with the same secret reuse the answer until SESSION_TTL passes or the
+    secret is invalidated, so a chatty client costs no Redis round trips.
+    """
+
+    def __init__(self):
+        self._secret: str | None = None
+        self._username: str | None = None
+        self._resolved_at = 0.0
+
+    async def resolve(self, wssecret: str | None) -> str | None:
+        # Straight from the client's JSON, so it may be any type
+        if not isinstance(wssecret, str) or not wssecret:
+            return None
+        now = time.monotonic()
+        if (
+            wssecret == self._secret
+            and now - self._resolved_at < SESSION_TTL
+            and _invalidated.get(wssecret, 0.0) < self._resolved_at
+        ):
+            return self._username
+
+        self._username = await redis_client.get(f"wssecret:{wssecret}")
+        self._secret = wssecret
+        self._resolved_at = now
+        return self._username
+
+
+def _mark_invalidated(wssecret: str) -> None:
+    now = time.monotonic()
+    _invalidated[wssecret] = now
+    for secret, at in list(_invalidated.items()):
+        if now - at > SESSION_TTL:
+            del _invalidated[secret]
+
+
+async def invalidate(wssecret: str) -> None:
+    """Make every connection using *wssecret* re-resolve it on its next message."""
+    # Locally first, so the caller's own connection sees the change at once
+    _mark_invalidated(wssecret)
+    await redis_client.publish(INVALIDATE_CHANNEL, wssecret)
+
+
+async def listen_invalidations() -> None:
+    """Apply invalidations published by any process; runs for the app's lifetime."""
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    await pubsub.subscribe(INVALIDATE_CHANNEL)
+    try:
+        while True:
+            try:
+                message = await pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=1.0
+                )
+                if message and message["type"] == "message":
+                    _mark_invalidated(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error("wssecret invalidation listener error: %s", e)
+                await asyncio.sleep(1)
+    finally:
+        await pubsub.aclose()
@@ -24,6 +24,7 @@ function Albumview({ currentUser }) {
   const [photos, setPhotos] = useState([]);
   const [totalPhotos, setTotalPhotos] = useState(0);
   const [hasMore, setHasMore] = useState(true);
+  const [nextCursor, setNextCursor] = useState(null);
   const [isFetching, setIsFetching] = useState(false);
   const [selectMode, setSelectMode] = useState(false);
   const [selected, setSelected] = useState([]);
@@ -119,7 +120,7 @@ function Albumview({ currentUser }) {
     return () => clearInterval(keepAliveInterval);
   }, [albumcode, sendJsonMessage]);
 
-  const fetchPhotos = useCallback((offset) => {
+  const fetchPhotos = useCallback((cursor) => {
     if (!albumcode) return;
     setIsFetching(true);
     sendJsonMessage({
@@ -127,7 +128,7 @@ function Albumview({ currentUser }) {
       payload: {
         albumcode: albumcode,
         limit: limit,
-        offset: offset,
+        cursor: cursor,
         sortField: sortField,
         sortOrder: sortOrder,
       },
@@ -136,8 +137,8 @@ function Albumview({ currentUser }) {
 
   const loadMore = useCallback(() => {
     if (isFetching || !hasMore) return;
-    fetchPhotos(photos.length);
-  }, [isFetching, hasMore, photos.length, fetchPhotos]);
+    fetchPhotos(nextCursor);
+  }, [isFetching, hasMore, nextCursor, fetchPhotos]);
 
   const loadMoreRef = useRef(loadMore);
   useEffect(() => {
@@ -148,7 +149,8 @@ function Albumview({ currentUser }) {
     setPhotos([]);
     setTotalPhotos(0);
     setHasMore(true);
-    fetchPhotos(0);
+    setNextCursor(null);
+    fetchPhotos(null);
   }, [albumcode, sortField, sortOrder, fetchPhotos]);
 
   const lastPhotoElementRef = useCallback(
@@ -183,11 +185,12 @@ function Albumview({ currentUser }) {
       case "getPhotos": {
         const batch = payload?.photos ?? [];
         setPhotos((prev) => {
-          const newPhotos = payload.offset === 0 ? batch : [...prev, ...batch];
+          const newPhotos = payload.cursor ? [...prev, ...batch] : batch;
           return newPhotos;
         });
         setTotalPhotos(payload.total ?? 0);
-        setHasMore(payload.offset + batch.length < payload.total);
+        setNextCursor(payload.next_cursor ?? null);
+        setHasMore(Boolean(payload.next_cursor));
         setIsFetching(false);
         break;
       }
@@ -221,6 +224,22 @@ function Albumview({ currentUser }) {
         }
         break;
 
+      case "addPhotos":
+        if (payload && payload.album_id === album?.id) {
+          const batch = payload.photos ?? [];
+          setPhotos((prev) => {
+            const known = new Set(prev.map((p) => p.id));
+            const fresh = batch.filter((p) => !known.has(p.id));
+            if (sortOrder === "desc") {
+              return [...fresh.reverse(), ...prev];
+            } else {
+              return [...prev, ...fresh];
+            }
+          });
+          setTotalPhotos((prev) => prev + batch.length);
+        }
+        break;
+
       case "deletePhoto": {
         if (payload && payload.album_id === album?.id) {
           const deletedId = payload.id;
@@ -1,7 +1,6 @@
 import { useState, useImperativeHandle, forwardRef, useRef, memo } from "react";
 import { useMessage } from "../MessageBoxContext";
 import { createPortal } from "react-dom";
-import { useParams } from "react-router-dom";
 import "./Uploader.css";
 
 /**
@@ -146,7 +145,6 @@ const Uploader = memo(forwardRef(
   ({ album, isOwner, userLoggedIn, disabled, setPhotos, setTotalPhotos, sortOrder },
     ref) => {
     const { showMessage, showConfirm } = useMessage();
-    const { albumcode } = useParams();
 
     const isUploadingRef = useRef(false);
     const timeoutRef = useRef(null);
@@ -165,15 +163,26 @@ const Uploader = memo(forwardRef(
       return parseFloat((bytes / Math.pow(k, i)).toFixed(2)) + " " + sizes[i];
     };
 
-    async function uploadFile(file) {
+    // Files are presigned and registered this many at a time
+    const UPLOAD_BATCH = 20;
+
+    function authHeaders() {
       const token = localStorage.getItem("access_token");
-      const headers = { "Content-Type": "application/x-www-form-urlencoded" };
+      const headers = { "Content-Type": "application/json" };
       if (token) headers["Authorization"] = `Bearer ${token}`;
+      return headers;
+    }
 
-      const presignRes = await fetch("/api/s3-presigned", {
+    async function startSession(files) {
+      const presignRes = await fetch("/api/upload-session", {
         method: "POST",
-        headers,
-        body: new URLSearchParams({ filename: file.name, album_code: album.code }),
+        headers: authHeaders(),
+        body: JSON.stringify({
+          album_code: album.code,
+          filenames: files.map((file) => file.name),
+          // Signed into each original's PUT, so the server needs no HEAD
+          sizes: files.map((file) => file.size),
+        }),
       });
 
       if (!presignRes.ok) {
@@ -185,10 +194,41 @@ const Uploader = memo(forwardRef(
         throw new Error(`Presigned request failed: ${presignRes.status}`);
       }
 
+      const data = await presignRes.json();
+      setSpaceRemaining(data.space_remaining);
+      return data;
+    }
+
+    async function commitSession(sessionId, uploaded) {
+      if (uploaded.length === 0) return;
+      const commitRes = await fetch(`/api/upload-session/${sessionId}/commit`, {
+        method: "POST",
+        headers: authHeaders(),
+        body: JSON.stringify({ photos: uploaded }),
+      });
+      if (!commitRes.ok) {
+        throw new Error(`Commit failed: ${commitRes.status}`);
+      }
+
+      const respData = await commitRes.json();
+      const newPhotos = respData.photos ?? [];
+      if (newPhotos.length && setPhotos) {
+        setPhotos((prev) => {
+          const known = new Set(prev.map((p) => p.id));
+          const fresh = newPhotos.filter((p) => !known.has(p.id));
+          return sortOrder === "desc"
+            ? [...fresh.reverse(), ...prev]
+            : [...prev, ...fresh];
+        });
+        if (setTotalPhotos) setTotalPhotos((prev) => prev + newPhotos.length);
+      }
+    }
+
+    // Upload one file's renditions; returns its entry for the session commit
+    async function uploadFile(file, presign) {
       const {
-        s3_key, presigned, thumb_key, thumb_presigned, mid_key, mid_presigned, space_remaining
-      } = await presignRes.json();
-      setSpaceRemaining(space_remaining);
+        s3_key, presigned, thumb_key, thumb_presigned, mid_key, mid_presigned
+      } = presign;
 
       let thumbnailBlob = null;
       let final_thumb_key = null;
@@ -236,37 +276,14 @@ const Uploader = memo(forwardRef(
 
       await Promise.all(uploadTasks);
 
-      const metaHeaders = { "Content-Type": "application/json" };
-      if (token) metaHeaders["Authorization"] = `Bearer ${token}`;
-
-      const metadataRes = await fetch("/api/add-photo-metadata", {
-        method: "POST",
-        headers: metaHeaders,
-        body: JSON.stringify({
-          album_id: album.id,
-          filename: file.name,
-          s3_key,
-          thumb_key: final_thumb_key || null,
-          mid_key: final_mid_key || null,
-          albumcode,
-          size: file.size,
-          thumb_size: thumbnailBlob ? thumbnailBlob.size : null,
-          mid_size: midBlob ? midBlob.size : null,
-          username: userLoggedIn ? undefined : "anonymous",
-        }),
-      });
-
-      if (metadataRes.ok) {
-        const respData = await metadataRes.json();
-        const newPhoto = respData.photo_id;
-        if (newPhoto && setPhotos) {
-          setPhotos((prev) => {
-            if (prev.find((p) => p.id === newPhoto.id)) return prev;
-            return sortOrder === "desc" ? [newPhoto, ...prev] : [...prev, newPhoto];
-          });
-          if (setTotalPhotos) setTotalPhotos((prev) => prev + 1);
-        }
-      }
+      return {
+        filename: file.name,
+        s3_key,
+        thumb_key: final_thumb_key || null,
+        mid_key: final_mid_key || null,
+        thumb_size: thumbnailBlob ? thumbnailBlob.size : null,
+        mid_size: midBlob ? midBlob.size : null,
+      };
     }
 
     const handleFiles = async (files) => {
@@ -290,13 +307,33 @@ const Uploader = memo(forwardRef(
         setTotalFiles(fileArray.length);
         setCompletedFiles(0);
 
-        for (const file of fileArray) {
+        for (let i = 0; i < fileArray.length; i += UPLOAD_BATCH) {
+          const chunk = fileArray.slice(i, i + UPLOAD_BATCH);
+          let session;
           try {
-            await uploadFile(file);
-            setCompletedFiles((prev) => prev + 1);
+            session = await startSession(chunk);
           } catch (err) {
-            console.error("Upload failed for file:", file.name, err);
+            console.error("Upload session failed for batch starting at:", chunk[0].name, err);
             if (err.message === "QUOTA_EXCEEDED") break;
+            continue;
+          }
+
+          const uploaded = [];
+          for (let j = 0; j < chunk.length; j++) {
+            const file = chunk[j];
+            try {
+              uploaded.push(await uploadFile(file, session.files[j]));
+              setCompletedFiles((prev) => prev + 1);
+            } catch (err) {
+              console.error("Upload failed for file:", file.name, err);
+              if (err.message === "QUOTA_EXCEEDED") break;
+            }
+          }
+
+          try {
+            await commitSession(session.session_id, uploaded);
+          } catch (err) {
+            console.error("Commit failed for batch starting at:", chunk[0].name, err);
           }
         }
 